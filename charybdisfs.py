@@ -19,16 +19,25 @@ import errno
 import atexit
 import logging
 import threading
+from typing import TYPE_CHECKING, Tuple, Optional
 
 import trio
 import click
 import pyfuse3
 
 from core.faults import ErrorFault, SysCall
-from core.rest_api import start_charybdisfs_api_server, stop_charybdisfs_api_server, DEFAULT_PORT
-from core.operations import CharybdisOperations
+from core.mounts import MountOptions, MountRegistry, create_operations, get_fuse_options, get_shards, charybdisfs_main
+from core.constants import DEFAULT_PORT
+from core.direct_io import DEFAULT_POOL_SIZE
+from core.block_cache import DEFAULT_MAX_READ_AHEAD
+from core.xattr_cache import DEFAULT_TTL as DEFAULT_XATTR_CACHE_TTL
+from core.io_scheduler import POLICIES as IO_SCHEDULER_POLICIES
+from core.watchdog import DEFAULT_SLOW_REQUEST_THRESHOLD, DEFAULT_LOOP_STALL_THRESHOLD
+from core.readiness import Readiness, WarmUp, DEFAULT_WARM_UP_CONCURRENCY
 from core.configuration import Configuration, generate_fault_id
-from core.pyfuse3_types import wrap as pyfuse3_types_wrap
+
+if TYPE_CHECKING:
+    from core.operations import CharybdisOperations
 
 
 LOGGER = logging.getLogger("charybdisfs")
@@ -36,21 +45,37 @@ AUDIT = logging.getLogger("charybdisfs.audit")
 LOG_FORMAT = ">>> %(asctime)s -%(levelname).1s- [%(processName)s:%(threadName)s] %(name)s  %(message)s"
 
 
+# Audit events logged with their arguments as is.
+AUDIT_FORMATS = {
+    "charybdisfs.fault": "CharybdisFS fault applied: %s",
+    "charybdisfs.crash": "CharybdisFS crash simulated: %s dirty pages discarded",
+    "charybdisfs.ready": "CharybdisFS is ready",
+    "charybdisfs.profiler": "CharybdisFS profiler %s in %s mode",
+}
+
+# Audit events of calls: a name of the call followed by its arguments.
+AUDIT_CALL_FORMATS = {
+    "charybdisfs.config": "CharybdisFS configuration call `%s' made with args=%s",
+    "charybdisfs.mounts": "CharybdisFS mounts call `%s' made with args=%s",
+}
+
+
 def sys_audit_hook(name: str, args: tuple) -> None:
-    if name.startswith("charybdisfs."):
-        if name == "charybdisfs.syscall":
-            AUDIT.debug(
-                "CharybdisFS call made: name=%s, args=%s, kwargs=%s",
-                args[0],
-                [pyfuse3_types_wrap(arg) for arg in args[1]],
-                {arg: pyfuse3_types_wrap(value) for arg, value in args[2].items()}
-            )
-        elif name == "charybdisfs.fault":
-            AUDIT.debug("CharybdisFS fault applied: %s", args[0])
-        elif name == "charybdisfs.config":
-            AUDIT.debug("CharybdisFS configuration call `%s' made with args=%s", args[0], args[1:])
-        elif name == "charybdisfs.api":
-            AUDIT.debug("CharybdisFS API %s called for fault_id=%s: %s", args[0], args[1], args[2].params)
+    if name == "charybdisfs.syscall":
+        from core.pyfuse3_types import wrap as pyfuse3_types_wrap  # lazy import: wrapt is needed for debug only.
+
+        AUDIT.debug(
+            "CharybdisFS call made: name=%s, args=%s, kwargs=%s",
+            args[0],
+            [pyfuse3_types_wrap(arg) for arg in args[1]],
+            {arg: pyfuse3_types_wrap(value) for arg, value in args[2].items()}
+        )
+    elif name == "charybdisfs.api":
+        AUDIT.debug("CharybdisFS API %s called for fault_id=%s: %s", args[0], args[1], args[2].params)
+    elif (audit_format := AUDIT_FORMATS.get(name)) is not None:
+        AUDIT.debug(audit_format, *args)
+    elif (audit_format := AUDIT_CALL_FORMATS.get(name)) is not None:
+        AUDIT.debug(audit_format, args[0], args[1:])
     elif name.startswith("os."):
         AUDIT.debug("os call made: name=%s, args=%s", name[3:], args)
 
@@ -62,6 +87,35 @@ def sys_audit_hook(name: str, args: tuple) -> None:
 @click.option("--mount/--no-mount", default=True)
 @click.option("--static-enospc/--no-static-enospc", default=False)
 @click.option("--static-enospc-probability", type=float, default=0.1)
+@click.option("--capacity", type=int, default=0)  # MiB, ENOSPC on writes beyond it; 0 to use the backing FS capacity
+@click.option("--page-cache/--no-page-cache", default=False)
+@click.option("--page-cache-size", type=int, default=64)  # MiB
+@click.option("--block-cache/--no-block-cache", default=False)
+@click.option("--block-cache-size", type=int, default=256)  # MiB
+@click.option("--max-read-ahead", type=int, default=DEFAULT_MAX_READ_AHEAD)  # blocks
+@click.option("--lazy-forget/--no-lazy-forget", default=False)
+@click.option("--direct-io-buffers", type=int, default=DEFAULT_POOL_SIZE)
+@click.option("--io-workers", type=int, default=0)  # threads to offload the data path only, 0 to use the event loop
+@click.option("--shard", type=str, multiple=True)  # subdirectories of the source served by own child processes
+@click.option("--max-backing-fds", type=int, default=None)  # 0 for no limit, by default RLIMIT_NOFILE with headroom
+@click.option("--queue-depth", type=int, default=0)  # in-flight read/write/flush/fsync requests, 0 for no limit
+@click.option("--io-scheduler", type=click.Choice(IO_SCHEDULER_POLICIES), default=IO_SCHEDULER_POLICIES[0])
+@click.option("--request-timeout", type=float, default=0)  # seconds, fail requests with EINTR after it; 0 for none
+@click.option("--fsync-coalescing/--no-fsync-coalescing", default=False)  # concurrent fsyncs of a file share one
+@click.option("--watchdog/--no-watchdog", default=True)  # log slow requests and event loop stalls
+@click.option("--slow-request-threshold", type=float, default=DEFAULT_SLOW_REQUEST_THRESHOLD)  # seconds
+@click.option("--loop-stall-threshold", type=float, default=DEFAULT_LOOP_STALL_THRESHOLD)  # seconds
+@click.option("--xattr-cache/--no-xattr-cache", default=False)
+@click.option("--xattr-cache-ttl", type=float, default=DEFAULT_XATTR_CACHE_TTL)  # seconds
+@click.option("--fault-snapshot", type=click.Path(dir_okay=False))  # publish faults to a memory-mapped file
+@click.option("--trace", type=click.Path(dir_okay=False))  # record FS calls to a memory-mapped ring file
+@click.option("--trace-capacity", type=int, default=None)  # records, core.trace.DEFAULT_CAPACITY if not set
+@click.option("--ready-fd", type=int, default=None)  # write "READY\n" to this fd and close it when the mount is ready
+@click.option("--warm-up", type=str, multiple=True)  # subtrees of the source to walk before the mount is ready
+@click.option("--warm-up-concurrency", type=int, default=DEFAULT_WARM_UP_CONCURRENCY)  # directories
+@click.option("--warm-up-prefetch/--no-warm-up-prefetch", default=True)  # read data of files into the page cache
+@click.option("--add-mount", type=(click.Path(exists=True, dir_okay=True), click.Path(exists=True, dir_okay=True)),
+              multiple=True)  # additional SOURCE TARGET pairs served by child processes
 @click.argument("source", type=click.Path(exists=True, dir_okay=True), required=False)
 @click.argument("target", type=click.Path(exists=True, dir_okay=True), required=False)
 def start_charybdisfs(source: str,  # noqa: C901  # ignore "is too complex" message
@@ -71,15 +125,54 @@ def start_charybdisfs(source: str,  # noqa: C901  # ignore "is too complex" mess
                       rest_api_port: int,
                       mount: bool,
                       static_enospc: bool,
-                      static_enospc_probability: float) -> None:
+                      static_enospc_probability: float,
+                      capacity: int,
+                      page_cache: bool,
+                      page_cache_size: int,
+                      block_cache: bool,
+                      block_cache_size: int,
+                      max_read_ahead: int,
+                      lazy_forget: bool,
+                      direct_io_buffers: int,
+                      io_workers: int,
+                      shard: Tuple[str, ...],
+                      max_backing_fds: Optional[int],
+                      queue_depth: int,
+                      io_scheduler: str,
+                      request_timeout: float,
+                      fsync_coalescing: bool,
+                      watchdog: bool,
+                      slow_request_threshold: float,
+                      loop_stall_threshold: float,
+                      xattr_cache: bool,
+                      xattr_cache_ttl: float,
+                      fault_snapshot: Optional[str],
+                      trace: Optional[str],
+                      trace_capacity: Optional[int],
+                      ready_fd: Optional[int],
+                      warm_up: Tuple[str, ...],
+                      warm_up_concurrency: int,
+                      warm_up_prefetch: bool,
+                      add_mount: Tuple[Tuple[str, str], ...]) -> None:
     logging.basicConfig(stream=sys.stdout, level=logging.DEBUG if debug else logging.INFO, format=LOG_FORMAT)
 
-    if not rest_api and not mount:
+    if not rest_api and not mount and not add_mount:
         raise click.UsageError(message="can't run --no-rest-api and --no-mount simultaneously")
 
+    if shard and not mount:
+        raise click.UsageError(message="--shard can be used with --mount only")
+
     if debug:
         sys.addaudithook(sys_audit_hook)
 
+    if fault_snapshot:
+        from core.fault_snapshot import FaultSnapshotWriter
+
+        LOGGER.info("Going to publish faults configuration to %s", fault_snapshot)
+        snapshot_writer = FaultSnapshotWriter(path=fault_snapshot)
+        Configuration.listeners.append(snapshot_writer)
+        snapshot_writer()
+
     if static_enospc:
         static_enospc_probability = max(0, min(100, round(static_enospc_probability * 100)))
         LOGGER.info("Going to add ENOSPC fault for all syscalls with probability %s%%", static_enospc_probability)
@@ -87,38 +180,102 @@ def start_charybdisfs(source: str,  # noqa: C901  # ignore "is too complex" mess
         Configuration.add_fault(fault_id=generate_fault_id(), fault=enospc_fault)
         LOGGER.debug("Faults added: %s", Configuration.get_all_faults())
 
-    if rest_api:
-        api_server_thread = \
-            threading.Thread(target=start_charybdisfs_api_server,
-                             kwargs={"port": rest_api_port, },
-                             name="RestServerApi",
-                             daemon=True)
-        api_server_thread.start()
-        atexit.register(stop_charybdisfs_api_server)
+    MountRegistry.default_options = mount_options = MountOptions(
+        page_cache_size=page_cache_size if page_cache else 0,
+        block_cache_size=block_cache_size if block_cache else 0,
+        max_read_ahead=max_read_ahead,
+        lazy_forget=lazy_forget,
+        direct_io_buffers=direct_io_buffers,
+        io_workers=io_workers,
+        xattr_cache_ttl=xattr_cache_ttl if xattr_cache else 0,
+        capacity=capacity,
+        max_backing_fds=max_backing_fds,
+        queue_depth=queue_depth,
+        io_scheduler=io_scheduler,
+        request_timeout=request_timeout,
+        fsync_coalescing=fsync_coalescing,
+        slow_request_threshold=slow_request_threshold if watchdog else 0,
+        loop_stall_threshold=loop_stall_threshold,
+        debug=debug,
+    )
+
+    Readiness.ready_fd = ready_fd
+
+    atexit.register(MountRegistry.remove_all_mounts)
+    for mount_source, mount_target in add_mount:
+        LOGGER.info("Mount %s to %s in a child process", mount_source, mount_target)
+        MountRegistry.add_mount(source=mount_source, target=mount_target)
 
     if mount:
         if source is None or target is None:
             raise click.BadArgumentUsage("both source and target parameters are required for CharybdisFS mount")
 
-        fuse_options = set(pyfuse3.default_options)
-        fuse_options.add("fsname=charybdisfs")
-        if debug:
-            fuse_options.add("debug")
+        try:
+            shards = get_shards(source=source, target=target, subdirs=shard)
+        except ValueError as exc:
+            raise click.BadParameter(str(exc), param_hint="--shard") from None
 
-        operations = CharybdisOperations(source=source)
+        operations = create_operations(source=source, options=mount_options)
 
-        pyfuse3.init(operations, target, fuse_options)
+        pyfuse3.init(operations, target, get_fuse_options(debug=debug))
         atexit.register(pyfuse3.close)
+        if shards:
+            atexit.register(MountRegistry.remove_all_mounts)  # shards are mounted inside the mount: unmount them first.
+        if operations.page_cache is not None:
+            atexit.register(operations.page_cache.flush_all)  # clean unmount shouldn't lose data.
+        if trace:
+            from core.trace import TraceRecorder, DEFAULT_CAPACITY as DEFAULT_TRACE_CAPACITY
+
+            LOGGER.info("Going to record FS calls to %s", trace)
+            operations.recorder = TraceRecorder(path=trace, capacity=trace_capacity or DEFAULT_TRACE_CAPACITY)
+            atexit.register(operations.recorder.close)
+        if warm_up:
+            try:
+                Readiness.warm_up = WarmUp(operations=operations,
+                                           subtrees=warm_up,
+                                           concurrency=warm_up_concurrency,
+                                           prefetch_data=warm_up_prefetch)
+            except ValueError as exc:
+                raise click.BadParameter(str(exc), param_hint="--warm-up") from None
+    else:
+        operations = None
+
+    if rest_api:
+        # CherryPy is imported in the server thread, so the mount doesn't wait for it.
+        api_server_thread = \
+            threading.Thread(target=_run_charybdisfs_api_server,
+                             kwargs={"port": rest_api_port, "operations": operations, },
+                             name="RestServerApi",
+                             daemon=True)
+        api_server_thread.start()
+        atexit.register(_stop_charybdisfs_api_server)
+
+    if not mount:
+        Readiness.set_ready()  # the mount signals readiness from the event loop.
 
     try:
         if mount:
-            trio.run(pyfuse3.main)
-        else:
+            trio.run(charybdisfs_main, operations, None, shards)
+        elif rest_api:
             api_server_thread.join()
+        else:
+            for mount_process in list(MountRegistry.mounts.values()):
+                mount_process.process.join()
     except KeyboardInterrupt:
         LOGGER.info("Interrupted by user...")
         sys.exit(0)
 
 
+def _run_charybdisfs_api_server(port: int, operations: Optional["CharybdisOperations"]) -> None:
+    from core.rest_api import start_charybdisfs_api_server
+
+    start_charybdisfs_api_server(port=port, operations=operations)
+
+
+def _stop_charybdisfs_api_server() -> None:
+    if (rest_api_module := sys.modules.get("core.rest_api")) is not None:
+        rest_api_module.stop_charybdisfs_api_server()
+
+
 if __name__ == "__main__":
     start_charybdisfs(prog_name="charybdisfs")
@@ -14,13 +14,17 @@
 
 from __future__ import annotations
 
-from typing import List, Tuple
+import json
+import time
+from typing import List, Tuple, Optional, Dict, Any, Iterator, Union
 
 import requests
 
 from core.faults import BaseFault
-from core.rest_api import DEFAULT_PORT
-from core.configuration import FaultID
+from core.constants import DEFAULT_PORT
+from core.profiler import SAMPLING, DEFAULT_INTERVAL as DEFAULT_PROFILER_INTERVAL
+from core.configuration import FaultID, MountID
+from core.scenarios import Scenario, ScenarioID
 
 
 class CharybdisFsClient:
@@ -44,8 +48,11 @@ class CharybdisFsClient:
     def url(self, fault_id: FaultID = FaultID("")) -> str:
         return f"{self.base_url}/{self.rest_resource}/{fault_id}".rstrip("/")
 
-    def add_fault(self, fault: BaseFault) -> Tuple[FaultID, requests.Response]:
-        response = requests.post(url=self.url(), json=fault.to_dict(), timeout=self.timeout)
+    def add_fault(self, fault: BaseFault, mount_id: Optional[MountID] = None) -> Tuple[FaultID, requests.Response]:
+        data: Dict[str, Any] = fault.to_dict()
+        if mount_id:
+            data["mount_id"] = mount_id
+        response = requests.post(url=self.url(), json=data, timeout=self.timeout)
 
         if not response.ok:
             return FaultID(""), response
@@ -66,6 +73,84 @@ class CharybdisFsClient:
     def get_active_faults(self) -> requests.Response:
         return requests.get(url=self.url(), timeout=self.timeout)
 
+    def get_faults_stats(self) -> requests.Response:
+        return requests.get(url=f"{self.base_url}/faults_stats", timeout=self.timeout)
+
     def remove_all_active_faults(self) -> None:
         for fault_id in self.active_faults:
             self.remove_fault(fault_id=fault_id)
+
+    def add_scenario(self,
+                     scenario: Union[Scenario, Dict[str, Any]],
+                     mount_id: Optional[MountID] = None) -> Tuple[ScenarioID, requests.Response]:
+        data = scenario.to_dict() if isinstance(scenario, Scenario) else dict(scenario)
+        if mount_id:
+            data["mount_id"] = mount_id
+        response = requests.post(url=f"{self.base_url}/scenarios", json=data, timeout=self.timeout)
+        return ScenarioID(response.json().get("scenario_id", "") if response.ok else ""), response
+
+    def remove_scenario(self, scenario_id: ScenarioID) -> requests.Response:
+        return requests.delete(url=f"{self.base_url}/scenarios/{scenario_id}", timeout=self.timeout)
+
+    def get_scenario(self, scenario_id: ScenarioID) -> requests.Response:
+        return requests.get(url=f"{self.base_url}/scenarios/{scenario_id}", timeout=self.timeout)
+
+    def get_stats(self, mount_id: Optional[MountID] = None) -> requests.Response:
+        return requests.get(url=f"{self.base_url}/stats", params={"mount_id": mount_id}, timeout=self.timeout)
+
+    def crash(self, mount_id: Optional[MountID] = None) -> requests.Response:
+        return requests.post(url=f"{self.base_url}/crash", params={"mount_id": mount_id}, timeout=self.timeout)
+
+    def cancel_requests(self, min_age: float = 0, mount_id: Optional[MountID] = None) -> requests.Response:
+        return requests.post(url=f"{self.base_url}/cancel",
+                             params={"mount_id": mount_id, "min_age": min_age},
+                             timeout=self.timeout)
+
+    def get_profile(self,
+                    seconds: float = 10,
+                    mode: str = SAMPLING,
+                    interval: float = DEFAULT_PROFILER_INTERVAL,
+                    mount_id: Optional[MountID] = None) -> requests.Response:
+        """Profile the mount for `seconds': the content is collapsed stacks or a pstats dump for deterministic mode."""
+
+        return requests.get(url=f"{self.base_url}/profile",
+                            params={"seconds": seconds, "mode": mode, "interval": interval, "mount_id": mount_id},
+                            timeout=self.timeout + seconds)
+
+    def add_mount(self, source: str, target: str) -> Tuple[MountID, requests.Response]:
+        response = requests.post(url=f"{self.base_url}/mounts",
+                                 json={"source": source, "target": target},
+                                 timeout=self.timeout)
+        return MountID(response.json().get("mount_id", "") if response.ok else ""), response
+
+    def remove_mount(self, mount_id: MountID) -> requests.Response:
+        return requests.delete(url=f"{self.base_url}/mounts/{mount_id}", timeout=self.timeout)
+
+    def get_mounts(self) -> requests.Response:
+        return requests.get(url=f"{self.base_url}/mounts", timeout=self.timeout)
+
+    def get_ready(self) -> requests.Response:
+        return requests.get(url=f"{self.base_url}/ready", timeout=self.timeout)
+
+    def wait_ready(self, timeout: float = 60, interval: float = 0.1) -> bool:
+        """Wait until the mount is ready (including the warm-up): return False on timeout."""
+
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                if self.get_ready().ok:
+                    return True
+            except requests.ConnectionError:  # the REST API server isn't started yet.
+                pass
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+
+    def stream_events(self) -> Iterator[Dict[str, Any]]:
+        """Yield batches of fault-fired and syscall error events until the connection is closed."""
+
+        with requests.get(url=f"{self.base_url}/events", stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
@@ -0,0 +1,142 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import os
+import logging
+import threading
+from typing import TYPE_CHECKING, Dict, Tuple, Set, List
+from collections import OrderedDict
+
+if TYPE_CHECKING:
+    from core.operations import INode, FileDescriptor, FileHandle
+
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DEFAULT_MAX_READ_AHEAD = 16  # blocks
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ReadAheadState:
+    """Sequential access detector for a file handle."""
+
+    __slots__ = ("next_off", "window", )
+
+    def __init__(self):
+        self.next_off = -1
+        self.window = 0
+
+
+class BlockCache:
+    """Read cache for the backing store with adaptive read-ahead."""
+
+    def __init__(self,
+                 max_blocks: int,
+                 block_size: int = DEFAULT_BLOCK_SIZE,
+                 max_read_ahead: int = DEFAULT_MAX_READ_AHEAD):
+        assert max_blocks > max_read_ahead, "Block cache should have room for a full read-ahead window"
+
+        self.max_blocks = max_blocks
+        self.block_size = block_size
+        self.max_read_ahead = max_read_ahead
+        self.blocks: OrderedDict[Tuple[INode, int], bytes] = OrderedDict()  # in LRU order
+        self.inode_blocks: Dict[INode, Set[int]] = {}
+        self.read_ahead: Dict[FileHandle, ReadAheadState] = {}
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.read_ahead_blocks = 0
+        self.evicted_blocks = 0
+
+    def read(self, inode: INode, fh: FileHandle, fd: FileDescriptor, off: int, size: int) -> bytes:
+        if size <= 0:
+            return b""
+        block_size = self.block_size
+        with self.lock:
+            first, last = off // block_size, (off + size - 1) // block_size
+            window = self._update_read_ahead(fh=fh, off=off, size=size)
+            chunks: List[bytes] = []
+            for index in range(first, last + 1):
+                if (block := self.blocks.get((inode, index))) is None:
+                    self.misses += 1
+                    block = self._fetch(inode=inode, fd=fd, first=index, last=last + window)
+                    if index == last:
+                        self.read_ahead_blocks += window
+                else:
+                    self.hits += 1
+                    self.blocks.move_to_end((inode, index))
+                chunks.append(block)
+                if len(block) < block_size:  # EOF
+                    break
+            self._shrink()
+        start = off - first * block_size
+        return b"".join(chunks)[start:start + size]
+
+    def invalidate(self, inode: INode) -> None:
+        with self.lock:
+            for index in self.inode_blocks.pop(inode, ()):
+                del self.blocks[(inode, index)]
+
+    def release(self, fh: FileHandle) -> None:
+        with self.lock:
+            self.read_ahead.pop(fh, None)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "read_ahead_blocks": self.read_ahead_blocks,
+                "evicted_blocks": self.evicted_blocks,
+                "cached_blocks": len(self.blocks),
+            }
+
+    def _update_read_ahead(self, fh: FileHandle, off: int, size: int) -> int:
+        """Return the read-ahead window size: it grows exponentially while access is sequential."""
+
+        if (state := self.read_ahead.get(fh)) is None:
+            state = self.read_ahead[fh] = ReadAheadState()
+        if off == state.next_off:
+            state.window = min(max(state.window * 2, 1), self.max_read_ahead)
+        else:
+            state.window = 0
+        state.next_off = off + size
+        return state.window
+
+    def _fetch(self, inode: INode, fd: FileDescriptor, first: int, last: int) -> bytes:
+        """Read blocks [first, last] from the backing store by one call and return the first one."""
+
+        block_size = self.block_size
+        data = os.pread(fd, (last - first + 1) * block_size, first * block_size)
+        inode_blocks = self.inode_blocks.setdefault(inode, set())
+        for index, block_off in enumerate(range(0, max(len(data), 1), block_size), start=first):
+            self.blocks[(inode, index)] = data[block_off:block_off + block_size]
+            self.blocks.move_to_end((inode, index))
+            inode_blocks.add(index)
+        return self.blocks[(inode, first)]
+
+    def _shrink(self) -> None:
+        while len(self.blocks) > self.max_blocks:
+            (inode, index), _ = self.blocks.popitem(last=False)
+            inode_blocks = self.inode_blocks[inode]
+            inode_blocks.discard(index)
+            if not inode_blocks:
+                del self.inode_blocks[inode]
+            self.evicted_blocks += 1
+
+
+__all__ = ("BlockCache", "DEFAULT_BLOCK_SIZE", "DEFAULT_MAX_READ_AHEAD", )
@@ -0,0 +1,132 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import os
+import stat
+import errno
+import logging
+from typing import TYPE_CHECKING, Dict, Set, Union
+
+if TYPE_CHECKING:
+    from core.operations import INode, FileDescriptor
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CapacityLimit:
+    """Virtual size of a mount: usage is the sum of apparent sizes of regular files.
+
+    Usage is scanned once on start and then updated by deltas of file sizes: writes beyond EOF and truncates grow
+    it, truncates and removal of the last link of a file shrink it.
+    """
+
+    def __init__(self, capacity: int, used: int = 0):
+        self.capacity = capacity
+        self.used = used
+        self.sizes: Dict[INode, int] = {}  # known sizes of files
+        self.orphans: Set[INode] = set()  # unlinked files which are still open
+        self.enospc_errors = 0
+
+    @property
+    def free(self) -> int:
+        return max(0, self.capacity - self.used)
+
+    def check_free(self) -> None:
+        if self.used >= self.capacity:
+            self._no_space()
+
+    def get_size(self, inode: INode, target: Union[FileDescriptor, str]) -> int:
+        if (size := self.sizes.get(inode)) is None:
+            size = self.sizes[inode] = os.stat(target).st_size
+        return size
+
+    def resize(self, inode: INode, target: Union[FileDescriptor, str], size: int) -> None:
+        """Set a new size of a file: raise ENOSPC if there is no room for the growth."""
+
+        delta = size - self.get_size(inode=inode, target=target)
+        if delta > 0 and self.used + delta > self.capacity:
+            self._no_space()
+        self.used += delta
+        self.sizes[inode] = size
+
+    def extend(self, inode: INode, target: Union[FileDescriptor, str], end: int) -> int:
+        """Grow a file up to `end' if it's smaller: return the previous size."""
+
+        if end > (size := self.get_size(inode=inode, target=target)):
+            self.resize(inode=inode, target=target, size=end)
+        return size
+
+    def rollback(self, inode: INode, end: int, size: int) -> None:
+        """Set a file resized to `end' back to `size' unless it's resized since then."""
+
+        if size != end and self.sizes.get(inode) == end:
+            self.used += size - end
+            self.sizes[inode] = size
+
+    def unlink(self, inode: INode, stat_result: os.stat_result, is_open: bool) -> None:
+        """Account removal of a link: space is freed when the last link is removed and the file is closed."""
+
+        if not stat.S_ISREG(stat_result.st_mode) or stat_result.st_nlink > 1:
+            return
+        if is_open:
+            self.sizes.setdefault(inode, stat_result.st_size)
+            self.orphans.add(inode)
+        else:
+            self.used -= self.sizes.pop(inode, stat_result.st_size)
+
+    def close(self, inode: INode) -> None:
+        """Called when the last file handle of the inode released."""
+
+        if inode in self.orphans:
+            self.orphans.remove(inode)
+            self.used -= self.sizes.pop(inode, 0)
+
+    def forget(self, inode: INode) -> None:
+        self.sizes.pop(inode, None)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "capacity": self.capacity,
+            "used": self.used,
+            "free": self.free,
+            "enospc_errors": self.enospc_errors,
+        }
+
+    def _no_space(self) -> None:
+        self.enospc_errors += 1
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+
+def get_tree_usage(root: str) -> int:
+    """Return the sum of apparent sizes of regular files under the root: hard links are counted once."""
+
+    used = 0
+    inodes = set()
+    for dir_path, _, file_names in os.walk(root):
+        for name in file_names:
+            try:
+                stat_result = os.lstat(os.path.join(dir_path, name))
+            except OSError:
+                continue
+            if stat.S_ISREG(stat_result.st_mode) and stat_result.st_ino not in inodes:
+                if stat_result.st_nlink > 1:
+                    inodes.add(stat_result.st_ino)
+                used += stat_result.st_size
+    return used
+
+
+__all__ = ("CapacityLimit", "get_tree_usage", )
@@ -16,25 +16,38 @@ import sys
 import uuid
 import logging
 import threading
-from typing import NewType, Dict, Optional, List
+from typing import NewType, Dict, Optional, List, Callable, Set, Tuple, Any
 
 from core.faults import BaseFault, SysCall
 
 
 FaultID = NewType("FaultID", str)
+MountID = NewType("MountID", str)
+
+NO_FAULTS: Tuple[BaseFault, ...] = ()
 
 LOGGER = logging.getLogger(__name__)
 
 
 class Configuration:
-    """Global faults configuration."""
+    """Global faults configuration.
+
+    A fault can be scoped to one mount: such fault applied to the mount on top of global ones.
+
+    Faults are precompiled into a per-syscall table on every change: the table is replaced, not changed, so FS
+    calls read it without the lock.
+    """
 
     syscalls_conf: Dict[FaultID, BaseFault] = {}
     syscalls_conf_lock = threading.RLock()
+    mount_faults: Dict[FaultID, MountID] = {}
+    listeners: List[Callable[[], None]] = []  # called on every configuration change
+    table: Dict[Tuple[SysCall, Optional[MountID]], Tuple[BaseFault, ...]] = {}
+    fault_ids: Dict[int, FaultID] = {}  # by id() of faults
 
     @classmethod
-    def add_fault(cls, fault_id: FaultID, fault: BaseFault) -> None:
-        sys.audit("charybdisfs.config", "add_fault", fault_id, fault)
+    def add_fault(cls, fault_id: FaultID, fault: BaseFault, mount_id: Optional[MountID] = None) -> None:
+        sys.audit("charybdisfs.config", "add_fault", fault_id, fault, mount_id)
 
         with cls.syscalls_conf_lock:
             if fault_id in cls.syscalls_conf:
@@ -45,20 +58,73 @@ class Configuration:
             else:
                 all_sys_calls = {fault.sys_call, }
 
-            for sys_call in all_sys_calls:
-                faults_by_sys_call = cls.get_faults_by_sys_call(sys_call=sys_call)
-                if sum(f.probability for f in faults_by_sys_call) + fault.probability > 100:
-                    raise ValueError(f"Can't add {fault=} with {fault_id=} because fault probability for FS call "
-                                     f"`{sys_call.value}' will exceed 100%")
+            # A global fault affects all mounts, so we need to check all of them.
+            mount_ids: Set[Optional[MountID]] = {mount_id, } if mount_id else {None, *cls.mount_faults.values()}
+
+            for scope in mount_ids:
+                for sys_call in all_sys_calls:
+                    faults_by_sys_call = cls.get_faults_by_sys_call(sys_call=sys_call, mount_id=scope)
+                    if sum(f.probability for f in faults_by_sys_call if f.may_overlap(fault)) + fault.probability > 100:
+                        raise ValueError(f"Can't add {fault=} with {fault_id=} because fault probability for FS call "
+                                         f"`{sys_call.value}' will exceed 100%")
 
             cls.syscalls_conf[fault_id] = fault
+            if mount_id:
+                cls.mount_faults[fault_id] = mount_id
+            cls.compile()
+            cls.notify_listeners()
 
     @classmethod
     def remove_fault(cls, fault_id: FaultID) -> Optional[BaseFault]:
         sys.audit("charybdisfs.config", "remove_fault", fault_id)
 
         with cls.syscalls_conf_lock:
-            return cls.syscalls_conf.pop(fault_id, None)
+            cls.mount_faults.pop(fault_id, None)
+            if (fault := cls.syscalls_conf.pop(fault_id, None)) is not None:
+                cls.compile()
+                cls.notify_listeners()
+            return fault
+
+    @classmethod
+    def replace_all_faults(cls, faults: Dict[FaultID, BaseFault], mount_faults: Dict[FaultID, MountID]) -> None:
+        sys.audit("charybdisfs.config", "replace_all_faults", list(faults))
+
+        with cls.syscalls_conf_lock:
+            for fault_id, fault in faults.items():
+                if (old_fault := cls.syscalls_conf.get(fault_id)) is not None:
+                    fault.stats = old_fault.stats  # counters of a fault are kept when it's set again.
+            cls.syscalls_conf = faults
+            cls.mount_faults = mount_faults
+            cls.compile()
+            cls.notify_listeners()
+
+    @classmethod
+    def compile(cls) -> None:
+        """Rebuild the table of faults by syscall and mount: mounts without own faults use the global entries."""
+
+        with cls.syscalls_conf_lock:
+            table = {}
+            for scope in {None, *cls.mount_faults.values()}:
+                scope_faults = [fault for fault_id, fault in cls.syscalls_conf.items()
+                                if cls.mount_faults.get(fault_id) in (None, scope)]
+                for sys_call in SysCall:
+                    table[(sys_call, scope)] = \
+                        tuple(fault for fault in scope_faults if fault.sys_call in (sys_call, SysCall.ALL, ))
+            cls.table = table
+            cls.fault_ids = {id(fault): fault_id for fault_id, fault in cls.syscalls_conf.items()}
+
+    @classmethod
+    def notify_listeners(cls) -> None:
+        for listener in cls.listeners:
+            try:
+                listener()
+            except Exception:  # a broken listener shouldn't break the configuration.
+                LOGGER.exception("Configuration listener %s failed", listener)
+
+    @classmethod
+    def get_mount_id(cls, fault_id: FaultID) -> Optional[MountID]:
+        with cls.syscalls_conf_lock:
+            return cls.mount_faults.get(fault_id)
 
     @classmethod
     def get_fault_by_uuid(cls, fault_id: FaultID) -> Optional[BaseFault]:
@@ -66,10 +132,16 @@ class Configuration:
             return cls.syscalls_conf.get(fault_id)
 
     @classmethod
-    def get_faults_by_sys_call(cls, sys_call: SysCall) -> List[BaseFault]:
-        with cls.syscalls_conf_lock:
-            # For sys_call == SysCall.ALL it returns faults with exactly SysCall.ALL type, not all.
-            return [fault for fault in cls.syscalls_conf.values() if fault.sys_call in (sys_call, SysCall.ALL,)]
+    def get_fault_id(cls, fault: BaseFault) -> Optional[FaultID]:
+        return cls.fault_ids.get(id(fault))
+
+    @classmethod
+    def get_faults_by_sys_call(cls, sys_call: SysCall, mount_id: Optional[MountID] = None) -> Tuple[BaseFault, ...]:
+        # For sys_call == SysCall.ALL it returns faults with exactly SysCall.ALL type, not all.
+        table = cls.table
+        if (faults := table.get((sys_call, mount_id))) is None:
+            faults = table.get((sys_call, None), NO_FAULTS)
+        return faults
 
     @classmethod
     def get_all_faults(cls) -> List[BaseFault]:
@@ -81,6 +153,11 @@ class Configuration:
         with cls.syscalls_conf_lock:
             return list(cls.syscalls_conf.keys())
 
+    @classmethod
+    def get_all_faults_stats(cls) -> Dict[FaultID, Dict[str, Any]]:
+        with cls.syscalls_conf_lock:
+            return {fault_id: fault.stats.to_dict() for fault_id, fault in cls.syscalls_conf.items()}
+
 
 def generate_fault_id() -> FaultID:
     return FaultID(str(uuid.uuid4()))
@@ -0,0 +1,104 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import os
+import mmap
+import logging
+import threading
+from typing import TYPE_CHECKING, Dict, List, Iterator
+from contextlib import contextmanager
+
+if TYPE_CHECKING:
+    from core.operations import FileDescriptor
+
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+DEFAULT_POOL_SIZE = 8
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AlignedBufferPool:
+    """Pool of page-aligned buffers for I/O on file descriptors opened with O_DIRECT.
+
+    Python bytes objects have no alignment guarantees, so O_DIRECT reads and writes go through mmap-backed
+    buffers instead.  The alignment of offsets and sizes is up to the caller: the backing store replies with
+    EINVAL for unaligned requests in the same way as without CharybdisFS.
+    """
+
+    def __init__(self, size: int = DEFAULT_POOL_SIZE, buffer_size: int = DEFAULT_BUFFER_SIZE):
+        assert buffer_size % mmap.PAGESIZE == 0, "Buffer size should be a multiple of the page size"
+
+        self.size = size
+        self.buffer_size = buffer_size
+        self.free: List[mmap.mmap] = [mmap.mmap(-1, buffer_size) for _ in range(size)]
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.extra_allocations = 0
+
+    @contextmanager
+    def buffer(self) -> Iterator[mmap.mmap]:
+        with self.lock:
+            self.requests += 1
+            buf = self.free.pop() if self.free else None
+        if buf is None:
+            LOGGER.debug("Aligned buffer pool is exhausted, allocate a new buffer")
+            self.extra_allocations += 1
+            buf = mmap.mmap(-1, self.buffer_size)
+        try:
+            yield buf
+        finally:
+            with self.lock:
+                if len(self.free) < self.size:
+                    self.free.append(buf)
+                    buf = None
+            if buf is not None:
+                buf.close()
+
+    def read(self, fd: FileDescriptor, off: int, size: int) -> bytes:
+        chunks = []
+        with self.buffer() as buf, memoryview(buf) as view:
+            while size > 0:
+                chunk_size = min(size, self.buffer_size)
+                count = os.preadv(fd, [view[:chunk_size]], off)
+                chunks.append(view[:count].tobytes())
+                if count < chunk_size:  # EOF
+                    break
+                off += count
+                size -= count
+        return b"".join(chunks)
+
+    def write(self, fd: FileDescriptor, off: int, data: bytes) -> int:
+        written = 0
+        with self.buffer() as buf, memoryview(buf) as view, memoryview(data) as data_view:
+            while written < len(data):
+                chunk_size = min(len(data) - written, self.buffer_size)
+                view[:chunk_size] = data_view[written:written + chunk_size]
+                if (count := os.pwritev(fd, [view[:chunk_size]], off + written)) == 0:
+                    break
+                written += count
+        return written
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "extra_allocations": self.extra_allocations,
+            "free_buffers": len(self.free),
+        }
+
+
+__all__ = ("AlignedBufferPool", "DEFAULT_BUFFER_SIZE", "DEFAULT_POOL_SIZE", )
@@ -0,0 +1,111 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import time
+import logging
+import threading
+from typing import Dict, List, Any, Optional
+from collections import deque
+
+
+DEFAULT_QUEUE_SIZE = 10000  # events per subscriber
+DEFAULT_BATCH_SIZE = 1000
+
+FAULT_EVENT = "fault"
+SYSCALL_ERROR_EVENT = "syscall_error"
+
+LOGGER = logging.getLogger(__name__)
+
+
+class EventSubscriber:
+    """Bounded queue of events: new events are dropped and counted while the consumer is too slow."""
+
+    def __init__(self, queue_size: int = DEFAULT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.queue: deque[Dict[str, Any]] = deque()
+        self.condition = threading.Condition(threading.Lock())
+        self.dropped = 0
+        self.reported_dropped = 0
+
+    def put(self, event: Dict[str, Any]) -> None:
+        with self.condition:
+            if len(self.queue) >= self.queue_size:
+                self.dropped += 1
+                return
+            self.queue.append(event)
+            if len(self.queue) == 1:
+                self.condition.notify()
+
+    def add_dropped(self, count: int) -> None:
+        with self.condition:
+            self.dropped += count
+
+    def get_batch(self, max_size: int = DEFAULT_BATCH_SIZE, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Wait for events and return them with number of events dropped since the previous batch."""
+
+        with self.condition:
+            if not self.queue:
+                self.condition.wait(timeout=timeout)
+            events = [self.queue.popleft() for _ in range(min(max_size, len(self.queue)))]
+            dropped, self.reported_dropped = self.dropped - self.reported_dropped, self.dropped
+        return {"events": events, "dropped": dropped}
+
+
+class EventStream:
+    """Global stream of fault-fired and syscall error events."""
+
+    subscribers: List[EventSubscriber] = []
+    subscribers_lock = threading.Lock()
+
+    @classmethod
+    def subscribe(cls,
+                  queue_size: int = DEFAULT_QUEUE_SIZE,
+                  max_subscribers: Optional[int] = None) -> Optional[EventSubscriber]:
+        """Return None if there are `max_subscribers' already."""
+
+        subscriber = EventSubscriber(queue_size=queue_size)
+        with cls.subscribers_lock:
+            if max_subscribers is not None and len(cls.subscribers) >= max_subscribers:
+                return None
+            cls.subscribers = [*cls.subscribers, subscriber]
+        return subscriber
+
+    @classmethod
+    def unsubscribe(cls, subscriber: EventSubscriber) -> None:
+        with cls.subscribers_lock:
+            cls.subscribers = [s for s in cls.subscribers if s is not subscriber]
+
+    @classmethod
+    def publish(cls, event_type: str, **data: Any) -> None:
+        # The subscribers list is replaced on change, so it's safe to iterate without the lock.
+        if not (subscribers := cls.subscribers):
+            return
+        event = {"type": event_type, "timestamp": time.time(), **data}
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    @classmethod
+    def forward(cls, events: List[Dict[str, Any]], dropped: int = 0) -> None:
+        """Publish events of a child process: they have timestamps already."""
+
+        for subscriber in cls.subscribers:
+            for event in events:
+                subscriber.put(event)
+            if dropped:
+                subscriber.add_dropped(dropped)
+
+
+__all__ = ("EventStream", "EventSubscriber", "FAULT_EVENT", "SYSCALL_ERROR_EVENT", )
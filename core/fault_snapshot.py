@@ -0,0 +1,219 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Binary snapshot of the faults configuration in a memory-mapped file.
+
+Layout (little-endian):
+
+    header: magic "CHFS", format version (u16), record size (u16), sequence (u64), generation (u64),
+            number of records (u32), capacity (u32)
+    record: fault_id (uuid, 16 bytes), mount_id (uuid, 16 bytes, zeros for a global fault), fault type (u8),
+            syscall (u8), probability (u8), status (u8), error_no (i32), delay (f64, microseconds),
+            scope (u8, bits of SCOPE_* for targeted faults and faults conditional on names),
+            offset_min, offset_max, size_min, size_max (i64, -1 if not set), open flags (u32, 0 if not set)
+
+Sets of processes and names of files are variable-length, so a record has bits of the scope only: a reader which
+needs them gets the fault from the REST API.
+
+The sequence is a seqlock counter: it's odd while the writer updates the file.  A reader copies the whole snapshot
+and retries if the sequence was odd or changed in the meantime.
+"""
+
+from __future__ import annotations
+
+import os
+import mmap
+import time
+import uuid
+import struct
+import logging
+from typing import Dict, List, Optional, NamedTuple
+
+from core.faults import BaseFault, SysCall, Status
+from core.configuration import Configuration, FaultID, MountID
+
+
+MAGIC = b"CHFS"
+FORMAT_VERSION = 2
+DEFAULT_CAPACITY = 1024  # faults
+
+HEADER = struct.Struct("<4sHHQQII")
+SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET = 8
+RECORD = struct.Struct("<16s16sBBBBidBqqqqI")
+
+SCOPE_PIDS = 1 << 0
+SCOPE_UIDS = 1 << 1
+SCOPE_COMMS = 1 << 2
+SCOPE_NAMES = 1 << 3
+SCOPE_ARGS = (("pids", SCOPE_PIDS), ("uids", SCOPE_UIDS), ("comms", SCOPE_COMMS), ("names", SCOPE_NAMES), )
+RANGE_ARGS = ("offset_min", "offset_max", "size_min", "size_max", )
+
+# Order is a part of the format: append only.
+FAULT_TYPES = ("", "ErrorFault", "LatencyFault", )
+SYS_CALLS = tuple(SysCall)
+STATUSES = tuple(Status)
+
+MAX_READ_ATTEMPTS = 1000
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FaultRecord(NamedTuple):
+    fault_id: FaultID
+    mount_id: Optional[MountID]
+    fault_type: str
+    sys_call: SysCall
+    probability: int
+    status: Status
+    error_no: int = 0
+    delay: float = 0
+    scope: int = 0
+    offset_min: Optional[int] = None
+    offset_max: Optional[int] = None
+    size_min: Optional[int] = None
+    size_max: Optional[int] = None
+    flags: Optional[int] = None
+
+    @property
+    def targeted(self) -> bool:
+        return bool(self.scope & (SCOPE_PIDS | SCOPE_UIDS | SCOPE_COMMS))
+
+
+class FaultSnapshot(NamedTuple):
+    generation: int
+    faults: List[FaultRecord]
+
+
+class FaultSnapshotWriter:
+    """Publish the faults configuration on every change: add it to `Configuration.listeners'."""
+
+    def __init__(self, path: str, capacity: int = DEFAULT_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        size = HEADER.size + RECORD.size * capacity
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.sequence = 0
+        self.generation = 0
+        self.mmap[:HEADER.size] = HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size, 0, 0, 0, capacity)
+
+    def __call__(self) -> None:
+        with Configuration.syscalls_conf_lock:
+            self.publish(faults=Configuration.syscalls_conf, mount_faults=Configuration.mount_faults)
+
+    def publish(self, faults: Dict[FaultID, BaseFault], mount_faults: Dict[FaultID, MountID]) -> None:
+        if len(faults) > self.capacity:
+            LOGGER.error("Fault snapshot has room for %s faults only, %s faults skipped",
+                         self.capacity, len(faults) - self.capacity)
+        records = [_pack_record(fault_id=fault_id, fault=fault, mount_id=mount_faults.get(fault_id))
+                   for fault_id, fault in list(faults.items())[:self.capacity]]
+
+        self.generation += 1
+        self._set_sequence(self.sequence + 1)  # odd: readers should retry.
+        for index, record in enumerate(records):
+            offset = HEADER.size + index * RECORD.size
+            self.mmap[offset:offset + RECORD.size] = record
+        self.mmap[:HEADER.size] = HEADER.pack(
+            MAGIC, FORMAT_VERSION, RECORD.size, self.sequence, self.generation, len(records), self.capacity)
+        self._set_sequence(self.sequence + 1)
+
+    def close(self) -> None:
+        self.mmap.close()
+
+    def _set_sequence(self, sequence: int) -> None:
+        self.sequence = sequence
+        SEQUENCE.pack_into(self.mmap, SEQUENCE_OFFSET, sequence)
+
+
+class FaultSnapshotReader:
+    """Lock-free reader of a snapshot published by `FaultSnapshotWriter'."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as snapshot_file:
+            self.mmap = mmap.mmap(snapshot_file.fileno(), 0, prot=mmap.PROT_READ)
+        magic, version, record_size, *_ = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or version != FORMAT_VERSION or record_size != RECORD.size:
+            self.mmap.close()
+            raise ValueError(f"{path} is not a fault snapshot of version {FORMAT_VERSION}")
+        self.last: Optional[FaultSnapshot] = None
+
+    def get_generation(self) -> int:
+        """Cheap check for changes: the generation is incremented on every publish."""
+
+        return self.read().generation if self.last is None else self._read_header()[1]
+
+    def read(self) -> FaultSnapshot:
+        for _ in range(MAX_READ_ATTEMPTS):
+            sequence, generation, count = self._read_header()
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            if self.last is not None and self.last.generation == generation:
+                return self.last
+            data = self.mmap[HEADER.size:HEADER.size + count * RECORD.size]
+            if SEQUENCE.unpack_from(self.mmap, SEQUENCE_OFFSET)[0] == sequence:
+                self.last = FaultSnapshot(generation=generation,
+                                          faults=[_unpack_record(record) for record in RECORD.iter_unpack(data)])
+                return self.last
+        raise RuntimeError(f"Unable to read a consistent fault snapshot in {MAX_READ_ATTEMPTS} attempts")
+
+    def close(self) -> None:
+        self.mmap.close()
+
+    def _read_header(self):
+        _, _, _, sequence, generation, count, _ = HEADER.unpack_from(self.mmap)
+        return sequence, generation, count
+
+
+def _pack_record(fault_id: FaultID, fault: BaseFault, mount_id: Optional[MountID]) -> bytes:
+    fault_type = type(fault).__name__
+    return RECORD.pack(
+        uuid.UUID(fault_id).bytes,
+        uuid.UUID(mount_id).bytes if mount_id else bytes(16),
+        FAULT_TYPES.index(fault_type) if fault_type in FAULT_TYPES else 0,
+        SYS_CALLS.index(fault.sys_call),
+        fault.probability,
+        STATUSES.index(fault.status),
+        getattr(fault, "error_no", 0),
+        getattr(fault, "delay", 0),
+        sum(bit for attr, bit in SCOPE_ARGS if getattr(fault, attr) is not None),
+        *(-1 if (value := getattr(fault, attr)) is None else value for attr in RANGE_ARGS),
+        fault.flags or 0,
+    )
+
+
+def _unpack_record(record: tuple) -> FaultRecord:
+    fault_id, mount_id, fault_type, sys_call, probability, status, error_no, delay, scope, *ranges, flags = record
+    return FaultRecord(
+        fault_id=FaultID(str(uuid.UUID(bytes=fault_id))),
+        mount_id=MountID(str(uuid.UUID(bytes=mount_id))) if any(mount_id) else None,
+        fault_type=FAULT_TYPES[fault_type],
+        sys_call=SYS_CALLS[sys_call],
+        probability=probability,
+        status=STATUSES[status],
+        error_no=error_no,
+        delay=delay,
+        scope=scope,
+        **{attr: None if value == -1 else value for attr, value in zip(RANGE_ARGS, ranges)},
+        flags=flags or None,
+    )
+
+
+__all__ = ("FaultSnapshotWriter", "FaultSnapshotReader", "FaultSnapshot", "FaultRecord",
+           "SCOPE_PIDS", "SCOPE_UIDS", "SCOPE_COMMS", "SCOPE_NAMES", )
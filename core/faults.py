@@ -14,16 +14,22 @@
 
 from __future__ import annotations
 
+import os
+import re
 import abc
 import sys
+import math
 import time
+import fnmatch
 import inspect
 import logging
+import functools
 from enum import Enum, auto
-from typing import Optional, Dict, Any, Union, NamedTuple, Type, Set, final
+from typing import Optional, Dict, Any, Union, NamedTuple, Type, Set, Iterable, Callable, Sequence, List, final
 
-from pyfuse3 import FUSEError
 
+TARGET_ARGS = ("pids", "uids", "comms", )
+CONDITION_ARGS = ("offset_min", "offset_max", "size_min", "size_max", "flags", "names", )
 
 LOGGER = logging.getLogger(__name__)
 
@@ -81,6 +87,155 @@ class Status(AutoLowerName):
         return cls.NEW
 
 
+class FaultStats:
+    """Counters of a fault: plain attributes updated without locks, a torn read is fine for stats."""
+
+    __slots__ = ("evaluations", "hits", "affected_bytes", "first_fired", "last_fired", )
+
+    def __init__(self,
+                 evaluations: int = 0,
+                 hits: int = 0,
+                 affected_bytes: int = 0,
+                 first_fired: Optional[float] = None,
+                 last_fired: Optional[float] = None):
+        self.evaluations = evaluations  # how many times the fault was checked for a matching FS call
+        self.hits = hits
+        self.affected_bytes = affected_bytes  # size of data in read and write calls the fault fired for
+        self.first_fired = first_fired
+        self.last_fired = last_fired
+
+    def fired(self, nbytes: int = 0) -> None:
+        self.last_fired = time.time()
+        if self.first_fired is None:
+            self.first_fired = self.last_fired
+        self.hits += 1
+        self.affected_bytes += nbytes
+
+    def add(self, other: FaultStats) -> None:
+        """Sum counters of copies of a fault, e.g., ones which run in child processes."""
+
+        self.evaluations += other.evaluations
+        self.hits += other.hits
+        self.affected_bytes += other.affected_bytes
+        if other.first_fired is not None and (self.first_fired is None or other.first_fired < self.first_fired):
+            self.first_fired = other.first_fired
+        if other.last_fired is not None and (self.last_fired is None or other.last_fired > self.last_fired):
+            self.last_fired = other.last_fired
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{key}={value}' for key, value in self.to_dict().items())})"
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+
+class Caller:
+    """Process which made an FS call."""
+
+    __slots__ = ("pid", "uid", "gid", )
+
+    def __init__(self, pid: int, uid: int, gid: int):
+        self.pid = pid
+        self.uid = uid
+        self.gid = gid
+
+    @property
+    def comm(self) -> str:
+        return get_comm(pid=self.pid)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(pid={self.pid}, uid={self.uid}, gid={self.gid})"
+
+
+@functools.lru_cache(maxsize=4096)
+def get_comm(pid: int) -> str:
+    """Return the name of a process: it's cached, so a name of a reused pid can be stale."""
+
+    try:
+        with open(f"/proc/{pid}/comm") as comm_file:
+            return comm_file.read().rstrip("\n")
+    except OSError:
+        return ""
+
+
+class Call:
+    """Arguments of an FS call which conditions of faults are checked against: None if not applicable."""
+
+    __slots__ = ("offset", "size", "flags", "name", )
+
+    def __init__(self,
+                 offset: Optional[int] = None,
+                 size: Optional[int] = None,
+                 flags: Optional[int] = None,
+                 name: Optional[str] = None):
+        self.offset = offset
+        self.size = size
+        self.flags = flags  # open flags of the file
+        self.name = name  # name of the file
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{attr}={getattr(self, attr)!r}' for attr in self.__slots__)})"
+
+
+Predicate = Callable[[Call], bool]
+
+
+def compile_predicate(offset_min: Optional[int] = None,
+                      offset_max: Optional[int] = None,
+                      size_min: Optional[int] = None,
+                      size_max: Optional[int] = None,
+                      flags: int = 0,
+                      names: Sequence[str] = ()) -> Optional[Predicate]:
+    """Build a check of all conditions: a call without an argument needed for a condition doesn't match it.
+
+    Offsets are in the range [offset_min, offset_max), sizes are in [size_min, size_max], all flags should be set,
+    and a name should match any of glob patterns.
+    """
+
+    checks: List[Predicate] = []
+    if offset_min is not None or offset_max is not None:
+        offset_min, offset_max = offset_min or 0, math.inf if offset_max is None else offset_max
+        checks.append(lambda call: call.offset is not None and offset_min <= call.offset < offset_max)
+    if size_min is not None or size_max is not None:
+        size_min, size_max = size_min or 0, math.inf if size_max is None else size_max
+        checks.append(lambda call: call.size is not None and size_min <= call.size <= size_max)
+    if flags:
+        checks.append(lambda call: call.flags is not None and call.flags & flags == flags)
+    if names:
+        match_name = re.compile("|".join(fnmatch.translate(pattern) for pattern in names)).match
+        checks.append(lambda call: call.name is not None and match_name(call.name) is not None)
+
+    if not checks:
+        return None
+    if len(checks) == 1:
+        return checks[0]
+
+    def check_all(call: Call) -> bool:
+        for check in checks:
+            if not check(call):
+                return False
+        return True
+    return check_all
+
+
+def parse_flags(flags: Union[int, str, Iterable[str], None]) -> int:
+    """Convert open flags given by names (e.g., ["O_DIRECT", "O_SYNC"] or "O_DIRECT|O_SYNC") to an integer."""
+
+    if flags is None or isinstance(flags, int):
+        return flags or 0
+    if isinstance(flags, str):
+        flags = flags.split("|")
+    value = 0
+    for name in flags:
+        assert isinstance(getattr(os, name.strip(), None), int) and name.strip().startswith("O_"), \
+            f"Unknown open flag: `{name}'"
+        value |= getattr(os, name.strip())
+    return value
+
+
 class FaultRegistryItem(NamedTuple):
     fault_type: Type[BaseFault] = None
     fault_args: Set[str] = None
@@ -95,33 +250,115 @@ class BaseFault(abc.ABC):
     _fault_registry = FaultRegistry()
 
     def __init_subclass__(cls):
+        fault_args = {name for name, parameter in inspect.signature(cls).parameters.items()
+                      if parameter.kind != parameter.VAR_KEYWORD}
         cls._fault_registry[cls.__name__] = \
-            FaultRegistryItem(fault_type=cls, fault_args=set(inspect.signature(cls).parameters))
-
-    def __init__(self, sys_call: Union[str, SysCall], probability: int):
+            FaultRegistryItem(fault_type=cls, fault_args=fault_args | set(TARGET_ARGS) | set(CONDITION_ARGS))
+
+    def __init__(self,  # noqa: C901  # ignore "is too complex" message
+                 sys_call: Union[str, SysCall],
+                 probability: int,
+                 pids: Optional[Iterable[int]] = None,
+                 uids: Optional[Iterable[int]] = None,
+                 comms: Optional[Iterable[str]] = None,
+                 offset_min: Optional[int] = None,
+                 offset_max: Optional[int] = None,
+                 size_min: Optional[int] = None,
+                 size_max: Optional[int] = None,
+                 flags: Union[int, str, Iterable[str], None] = None,
+                 names: Optional[Iterable[str]] = None):
         self.sys_call = SysCall(sys_call)
         assert self.sys_call != SysCall.UNKNOWN, f"Try to create a fault for an unknown syscall: `{sys_call}'"
 
         assert 0 <= probability <= 100, "A fault probability should be an integer in the interval [0, 100]"
         self.probability = probability
 
+        # A targeted fault affects only calls made by processes which match any of pids, uids or comms (names.)
+        self.pids = None if pids is None else frozenset(pids)
+        self.uids = None if uids is None else frozenset(uids)
+        self.comms = None if comms is None else frozenset(comms)
+
+        # A conditional fault affects only calls with matching arguments: offset and size of data for read and write,
+        # open flags of the file, and name of the file.  Conditions are compiled once here.
+        assert offset_min is None or offset_max is None or offset_min < offset_max, "Empty offsets range"
+        assert size_min is None or size_max is None or size_min <= size_max, "Empty sizes range"
+        self.offset_min = offset_min
+        self.offset_max = offset_max
+        self.size_min = size_min
+        self.size_max = size_max
+        self.flags = parse_flags(flags) or None
+        self.names = None if names is None else tuple(names)
+        self._predicate = compile_predicate(offset_min=offset_min,
+                                            offset_max=offset_max,
+                                            size_min=size_min,
+                                            size_max=size_max,
+                                            flags=self.flags or 0,
+                                            names=self.names or ())
+
         self.status = Status.NEW
+        self.stats = FaultStats()
+
+    @property
+    def targeted(self) -> bool:
+        return self.pids is not None or self.uids is not None or self.comms is not None
+
+    def may_overlap(self, other: BaseFault) -> bool:
+        """Return False if faults never match the same call: both target disjoint sets of the same kind."""
+
+        kinds = [attr for attr in TARGET_ARGS if getattr(self, attr) is not None]
+        if not kinds or kinds != [attr for attr in TARGET_ARGS if getattr(other, attr) is not None]:
+            return True
+        return any(getattr(self, attr) & getattr(other, attr) for attr in kinds)
+
+    @property
+    def conditional(self) -> bool:
+        return self._predicate is not None
+
+    def check(self, call: Call) -> bool:
+        """Check conditions of the fault against arguments of a call."""
+
+        return self._predicate is None or self._predicate(call)
+
+    def matches(self, caller: Optional[Caller]) -> bool:
+        if self.pids is None and self.uids is None and self.comms is None:
+            return True
+        if caller is None:  # a call which can't be attributed to a process.
+            return False
+        return self.pids is not None and caller.pid in self.pids \
+            or self.uids is not None and caller.uid in self.uids \
+            or self.comms is not None and caller.comm in self.comms
 
     @abc.abstractmethod
     def _apply(self) -> None:
         ...
 
-    def apply(self) -> None:
+    async def _apply_async(self) -> None:
+        self._apply()
+
+    def apply(self, nbytes: int = 0) -> None:
+        self._fire(nbytes=nbytes)
+        self._apply()
+
+    async def apply_async(self, nbytes: int = 0) -> None:
+        """Version of `apply()' for the event loop: it can be cancelled."""
+
+        self._fire(nbytes=nbytes)
+        await self._apply_async()
+
+    def _fire(self, nbytes: int) -> None:
         sys.audit("charybdisfs.fault", self)
         self.status = Status.APPLIED
-        self._apply()
+        self.stats.fired(nbytes=nbytes)
 
     def to_dict(self) -> Dict[str, Any]:
         return {
             "fault_type": type(self).__name__,
-            **vars(self),
+            **self._get_public_vars(),
+            **{attr: None if (value := getattr(self, attr)) is None else sorted(value) for attr in TARGET_ARGS},
+            "names": None if self.names is None else list(self.names),
             "sys_call": self.sys_call.value,
             "status": self.status.value,
+            "stats": self.stats.to_dict(),
         }
 
     @classmethod
@@ -136,7 +373,7 @@ class BaseFault(abc.ABC):
 
         try:
             fault = fault_type(**{arg: data[arg] for arg in set(data) & fault_args})
-        except TypeError as exc:
+        except (TypeError, AssertionError) as exc:
             LOGGER.error("Unable to create a %s object: %s", fault_type_name, exc)
             return None
 
@@ -146,29 +383,40 @@ class BaseFault(abc.ABC):
 
     def update_internal_state_from_dict(self, data: Dict[str, Any]) -> None:
         self.status = Status(data.get("status"))
+        self.stats = FaultStats(**data.get("stats", {}))
+
+    def _get_public_vars(self) -> Dict[str, Any]:
+        return {key: value for key, value in vars(self).items() if not key.startswith("_")}
 
     def __repr__(self):
-        return f"{type(self).__name__}({', '.join(f'{key}={value}' for key, value in self.__dict__.items())})"
+        return f"{type(self).__name__}({', '.join(f'{key}={value}' for key, value in self._get_public_vars().items())})"
 
     def __eq__(self, other):
-        return type(self) == type(other) and vars(self) == vars(other)
+        return type(self) == type(other) and self._get_public_vars() == other._get_public_vars()
 
 
 class LatencyFault(BaseFault):
-    def __init__(self, sys_call: Union[str, SysCall], probability: int, delay: float = 0):
-        super().__init__(sys_call=sys_call, probability=probability)
+    def __init__(self, sys_call: Union[str, SysCall], probability: int, delay: float = 0, **kwargs: Any):
+        super().__init__(sys_call=sys_call, probability=probability, **kwargs)
         self.delay = delay  # us - microseconds
 
     def _apply(self) -> None:
         time.sleep(self.delay / 1e6)
 
+    async def _apply_async(self) -> None:
+        import trio  # lazy import: faults are used by the client too, it doesn't need trio.
+
+        await trio.sleep(self.delay / 1e6)
+
 
 class ErrorFault(BaseFault):
-    def __init__(self, sys_call: Union[str, SysCall], probability: int, error_no: int):
-        super().__init__(sys_call=sys_call, probability=probability)
+    def __init__(self, sys_call: Union[str, SysCall], probability: int, error_no: int, **kwargs: Any):
+        super().__init__(sys_call=sys_call, probability=probability, **kwargs)
         self.error_no = error_no
 
     def _apply(self) -> None:
+        from pyfuse3 import FUSEError  # lazy import: faults are used by the client too, it doesn't need pyfuse3.
+
         raise FUSEError(self.error_no)
 
 
@@ -0,0 +1,122 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import os
+import errno
+import logging
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, Any, Optional
+
+import trio
+
+if TYPE_CHECKING:
+    from core.operations import INode
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FsyncBatch:
+    __slots__ = ("size", "datasync", "done", "error", )
+
+    def __init__(self, datasync: bool):
+        self.size = 1
+        self.datasync = datasync  # a full fsync if any caller in the batch asked for it
+        self.done = trio.Event()
+        self.error: Optional[OSError] = None
+
+    def join(self, datasync: bool) -> None:
+        self.size += 1
+        self.datasync = self.datasync and datasync
+
+    def raise_error(self) -> None:
+        if self.error is not None:
+            raise OSError(self.error.errno, self.error.strerror)
+
+
+class INodeFsyncs:
+    __slots__ = ("running", "next", )
+
+    def __init__(self):
+        self.running: Optional[FsyncBatch] = None
+        self.next: Optional[FsyncBatch] = None  # waits for the running one
+
+
+class FsyncCoalescer:
+    """Group commit of fsyncs: concurrent fsyncs of an inode share one backing fsync.
+
+    A backing fsync covers only data written before it's started, so calls which arrive while one is in flight
+    join the next batch.  The next batch starts when the running one is finished and serves all its callers at once.
+    An error of a backing fsync is reported to all callers of the batch.
+    """
+
+    def __init__(self):
+        self.inodes: Dict[INode, INodeFsyncs] = {}
+        self.calls = 0
+        self.backing_fsyncs = 0
+        self.max_batch_size = 0
+        self.batch_sizes: Dict[int, int] = {}  # batches by size rounded up to a power of 2
+
+    async def fsync(self, inode: INode, datasync: bool, sync: Callable[[bool], Awaitable[None]]) -> None:
+        """Wait for a backing fsync of the inode which is started after this call: `sync(datasync)' does it."""
+
+        self.calls += 1
+        if (fsyncs := self.inodes.get(inode)) is None:
+            fsyncs = self.inodes[inode] = INodeFsyncs()
+
+        if (batch := fsyncs.next) is not None:
+            batch.join(datasync=datasync)
+            await batch.done.wait()
+        else:
+            batch = FsyncBatch(datasync=datasync)
+            # Callers which join the batch depend on its leader, so the leader can't be cancelled.
+            with trio.CancelScope(shield=True):
+                if (running := fsyncs.running) is not None:
+                    fsyncs.next = batch
+                    await running.done.wait()
+                    fsyncs.next = None
+                fsyncs.running = batch
+                try:
+                    await sync(batch.datasync)
+                except OSError as exc:
+                    batch.error = exc
+                except BaseException:  # callers which joined the batch shouldn't think that their data is synced.
+                    batch.error = OSError(errno.EIO, os.strerror(errno.EIO))
+                    raise
+                finally:
+                    self._finish(inode=inode, fsyncs=fsyncs, batch=batch)
+        batch.raise_error()
+
+    def _finish(self, inode: INode, fsyncs: INodeFsyncs, batch: FsyncBatch) -> None:
+        fsyncs.running = None
+        if fsyncs.next is None:
+            del self.inodes[inode]
+        self.backing_fsyncs += 1
+        if batch.size > self.max_batch_size:
+            self.max_batch_size = batch.size
+        bucket = 1 << (batch.size - 1).bit_length()
+        self.batch_sizes[bucket] = self.batch_sizes.get(bucket, 0) + 1
+        batch.done.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "backing_fsyncs": self.backing_fsyncs,
+            "max_batch_size": self.max_batch_size,
+            "batch_sizes": {f"<={size}": count for size, count in sorted(self.batch_sizes.items())},
+        }
+
+
+__all__ = ("FsyncCoalescer", )
@@ -0,0 +1,151 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import math
+import time
+import reprlib
+import logging
+from typing import Dict, Any, Optional, Sequence, Tuple
+
+import trio
+
+from core.faults import BaseFault, SysCall
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+ARGS_REPR = reprlib.Repr()
+ARGS_REPR.maxstring = ARGS_REPR.maxother = 64
+
+
+class InFlightRequest:
+    __slots__ = ("request_id", "sys_call", "started", "cancel_scope", "cancelled", "arg_names", "args", "kwargs",
+                 "fault", "reported", )
+
+    def __init__(self,
+                 request_id: int,
+                 sys_call: SysCall,
+                 cancel_scope: trio.CancelScope,
+                 arg_names: Sequence[str] = (),
+                 args: Tuple[Any, ...] = (),
+                 kwargs: Optional[Dict[str, Any]] = None,
+                 fault: Optional[BaseFault] = None):
+        self.request_id = request_id
+        self.sys_call = sys_call
+        self.started = time.monotonic()
+        self.cancel_scope = cancel_scope
+        self.cancelled = False  # explicitly, not by the timeout
+
+        # Arguments are kept as is and formatted only when the request is reported.
+        self.arg_names = arg_names
+        self.args = args
+        self.kwargs = kwargs
+        self.fault = fault  # a fault fired for this request
+        self.reported = False  # as a slow one
+
+    def get_args(self) -> Dict[str, Any]:
+        call_args = dict(zip(self.arg_names, self.args))
+        if self.kwargs:
+            call_args.update(self.kwargs)
+        call_args.pop("ctx", None)
+        return call_args
+
+    def to_dict(self, now: float) -> Dict[str, Any]:
+        call_args = self.get_args()
+        return {
+            "request_id": self.request_id,
+            "sys_call": self.sys_call.value,
+            "age": now - self.started,
+            "inode": call_args.get("inode", call_args.get("parent_inode")),
+            "args": {name: ARGS_REPR.repr(value) for name, value in call_args.items()},
+            "fault": None if self.fault is None else self.fault.to_dict(),
+        }
+
+
+class InFlightRequests:
+    """Requests which are being served: each one runs in own cancel scope.
+
+    A cancelled request (by the timeout or explicitly) stops waiting in the device queue, in a latency fault or
+    for a read in an I/O worker thread immediately and fails with EINTR.
+    """
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.timeout = timeout
+        self.requests: Dict[int, InFlightRequest] = {}
+        self.last_request_id = 0
+        self.cancelled: Dict[str, int] = {}  # by syscall
+        self.timed_out: Dict[str, int] = {}  # by syscall
+
+    def start(self,
+              sys_call: SysCall,
+              arg_names: Sequence[str] = (),
+              args: Tuple[Any, ...] = (),
+              kwargs: Optional[Dict[str, Any]] = None,
+              fault: Optional[BaseFault] = None) -> InFlightRequest:
+        """Should be called from the event loop thread."""
+
+        deadline = trio.current_time() + self.timeout if self.timeout else math.inf
+        self.last_request_id += 1
+        request = InFlightRequest(request_id=self.last_request_id,
+                                  sys_call=sys_call,
+                                  cancel_scope=trio.CancelScope(deadline=deadline),
+                                  arg_names=arg_names,
+                                  args=args,
+                                  kwargs=kwargs,
+                                  fault=fault)
+        self.requests[request.request_id] = request
+        return request
+
+    def finish(self, request: InFlightRequest) -> None:
+        del self.requests[request.request_id]
+        if request.cancel_scope.cancelled_caught:
+            counters = self.cancelled if request.cancelled else self.timed_out
+            counters[request.sys_call.value] = counters.get(request.sys_call.value, 0) + 1
+
+    def cancel(self, min_age: float = 0) -> int:
+        """Cancel requests which are in flight for `min_age' seconds at least: return number of them.
+
+        Should be called from the event loop thread.
+        """
+
+        started_before = time.monotonic() - min_age
+        cancelled = 0
+        for request in list(self.requests.values()):
+            if request.started <= started_before and not request.cancel_scope.cancel_called:
+                request.cancelled = True
+                request.cancel_scope.cancel()
+                cancelled += 1
+        if cancelled:
+            LOGGER.info("%s in-flight requests cancelled", cancelled)
+        return cancelled
+
+    def get_oldest(self) -> Optional[InFlightRequest]:
+        for request in list(self.requests.values()):  # in order of start
+            return request
+        return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        oldest = self.get_oldest()
+        return {
+            "in_flight": len(self.requests),
+            "oldest": None if oldest is None else oldest.to_dict(now=time.monotonic()),
+            "cancelled": dict(self.cancelled),
+            "timed_out": dict(self.timed_out),
+        }
+
+
+__all__ = ("InFlightRequests", "InFlightRequest", )
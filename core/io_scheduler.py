@@ -0,0 +1,155 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Emulation of a device queue: a limited number of data path requests are in flight, others wait in a queue.
+
+Requests are dispatched from the queue by a scheduling policy:
+
+    fifo           in order of arrival
+    deadline       earliest deadline first: reads expire after `read_deadline', writes after `write_deadline'
+    read-priority  reads first, but a write is dispatched when it waits longer than `write_deadline'
+"""
+
+from __future__ import annotations
+
+import time
+import logging
+from typing import Dict, Any, Optional
+from collections import deque
+
+import trio
+
+from core.faults import SysCall
+
+
+FIFO = "fifo"
+DEADLINE = "deadline"
+READ_PRIORITY = "read-priority"
+POLICIES = (FIFO, DEADLINE, READ_PRIORITY, )
+
+DEFAULT_READ_DEADLINE = 0.5  # seconds
+DEFAULT_WRITE_DEADLINE = 5.0  # seconds
+
+READ_CALLS = frozenset({SysCall.READ, })
+WRITE_CALLS = frozenset({SysCall.WRITE, SysCall.FLUSH, SysCall.FSYNC, })
+SCHEDULED_CALLS = READ_CALLS | WRITE_CALLS
+
+LOGGER = logging.getLogger(__name__)
+
+
+class QueuedRequest:
+    __slots__ = ("enqueued", "deadline", "dispatched", )
+
+    def __init__(self, enqueued: float, deadline: float):
+        self.enqueued = enqueued
+        self.deadline = deadline
+        self.dispatched = trio.Event()
+
+
+class QueueStats:
+    __slots__ = ("dispatched", "wait_time", "max_wait_time", )
+
+    def __init__(self):
+        self.dispatched = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def add(self, wait_time: float) -> None:
+        self.dispatched += 1
+        self.wait_time += wait_time
+        if wait_time > self.max_wait_time:
+            self.max_wait_time = wait_time
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "dispatched": self.dispatched,
+            "avg_wait_time": self.wait_time / self.dispatched if self.dispatched else 0.0,
+            "max_wait_time": self.max_wait_time,
+        }
+
+
+class IOScheduler:
+    def __init__(self,
+                 queue_depth: int,
+                 policy: str = FIFO,
+                 read_deadline: float = DEFAULT_READ_DEADLINE,
+                 write_deadline: float = DEFAULT_WRITE_DEADLINE):
+        if queue_depth < 1:
+            raise ValueError(f"Queue depth should be positive: {queue_depth}")
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown I/O scheduler policy {policy!r}, should be one of {POLICIES}")
+        self.queue_depth = queue_depth
+        self.policy = policy
+        self.read_deadline = read_deadline
+        self.write_deadline = write_deadline
+        self.in_flight = 0
+
+        # Both queues are FIFO with the same timeout for all requests, so heads have the earliest deadlines.
+        self.reads: deque[QueuedRequest] = deque()
+        self.writes: deque[QueuedRequest] = deque()
+        self.read_stats = QueueStats()
+        self.write_stats = QueueStats()
+
+    async def acquire(self, sys_call: SysCall) -> None:
+        """Wait for a free slot in the device queue."""
+
+        is_read = sys_call in READ_CALLS
+        stats = self.read_stats if is_read else self.write_stats
+        if self.in_flight < self.queue_depth and not self.reads and not self.writes:
+            self.in_flight += 1
+            stats.add(0.0)
+            return
+        now = time.monotonic()
+        request = QueuedRequest(enqueued=now, deadline=now + (self.read_deadline if is_read else self.write_deadline))
+        queue = self.reads if is_read else self.writes
+        queue.append(request)
+        try:
+            await request.dispatched.wait()
+        except BaseException:
+            if request.dispatched.is_set():  # cancelled after dispatch: pass the slot to the next request.
+                self.release()
+            else:
+                queue.remove(request)
+            raise
+        stats.add(time.monotonic() - request.enqueued)
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        while self.in_flight < self.queue_depth and (request := self._next()) is not None:
+            self.in_flight += 1
+            request.dispatched.set()
+
+    def _next(self) -> Optional[QueuedRequest]:
+        if not self.reads or not self.writes:
+            queue = self.reads or self.writes
+        elif self.policy == FIFO:
+            queue = self.reads if self.reads[0].enqueued <= self.writes[0].enqueued else self.writes
+        elif self.policy == DEADLINE:
+            queue = self.reads if self.reads[0].deadline <= self.writes[0].deadline else self.writes
+        else:  # READ_PRIORITY
+            queue = self.writes if self.writes[0].deadline <= time.monotonic() else self.reads
+        return queue.popleft() if queue else None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "policy": self.policy,
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "queued": {"reads": len(self.reads), "writes": len(self.writes)},
+            "reads": self.read_stats.to_dict(),
+            "writes": self.write_stats.to_dict(),
+        }
+
+
+__all__ = ("IOScheduler", "POLICIES", "SCHEDULED_CALLS", "FIFO", "DEADLINE", "READ_PRIORITY", )
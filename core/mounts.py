@@ -0,0 +1,517 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import os
+import sys
+import time
+import signal
+import logging
+import resource
+import threading
+import multiprocessing
+from typing import Optional, Dict, List, Set, Any, Tuple, NamedTuple, Iterable, Sequence
+from multiprocessing.connection import Connection
+
+import trio
+import pyfuse3
+
+from core.faults import FaultStats, create_fault_from_dict
+from core.events import EventStream, EventSubscriber, DEFAULT_QUEUE_SIZE
+from core.direct_io import AlignedBufferPool, DEFAULT_POOL_SIZE
+from core.page_cache import PageCache, DEFAULT_PAGE_SIZE
+from core.readiness import Readiness
+from core.operations import CharybdisOperations
+from core.block_cache import BlockCache, DEFAULT_BLOCK_SIZE, DEFAULT_MAX_READ_AHEAD
+from core.xattr_cache import XattrCache
+from core.capacity import CapacityLimit, get_tree_usage
+from core.io_scheduler import IOScheduler, FIFO
+from core.watchdog import DEFAULT_SLOW_REQUEST_THRESHOLD, DEFAULT_LOOP_STALL_THRESHOLD
+from core.configuration import Configuration, FaultID, MountID, generate_fault_id
+from core.scenarios import Scenarios, ScenarioID
+
+
+MOUNT_START_TIMEOUT = 30  # seconds
+MOUNT_STOP_TIMEOUT = 30  # seconds
+MOUNT_CALL_TIMEOUT = 10  # seconds
+EVENTS_FORWARD_INTERVAL = 0.1  # seconds
+
+# File descriptors left for the REST API server, page cache duplicates, directories, etc.
+FD_LIMIT_HEADROOM = 256
+
+# Methods of CharybdisOperations which can be called for a mount served by a child process.
+MOUNT_COMMANDS = frozenset({
+    "get_stats", "get_faults_stats", "crash", "cancel_requests", "start_profiler", "stop_profiler",
+})
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MountOptions(NamedTuple):
+    page_cache_size: int = 0  # MiB, 0 to disable
+    block_cache_size: int = 0  # MiB, 0 to disable
+    max_read_ahead: int = DEFAULT_MAX_READ_AHEAD  # blocks
+    lazy_forget: bool = False
+    direct_io_buffers: int = DEFAULT_POOL_SIZE
+    io_workers: int = 0  # 0 to do all I/O in the event loop thread
+    xattr_cache_ttl: float = 0  # seconds, 0 to disable
+    capacity: int = 0  # MiB, 0 for the capacity of the backing FS
+    queue_depth: int = 0  # in-flight data path requests, 0 for no limit
+    io_scheduler: str = FIFO
+    request_timeout: float = 0  # seconds, 0 for no timeout
+    max_backing_fds: Optional[int] = None  # 0 for no limit, None to derive it from RLIMIT_NOFILE
+    slow_request_threshold: float = DEFAULT_SLOW_REQUEST_THRESHOLD  # seconds, 0 to disable the watchdog
+    loop_stall_threshold: float = DEFAULT_LOOP_STALL_THRESHOLD  # seconds
+    fsync_coalescing: bool = False
+    debug: bool = False
+
+
+def create_operations(source: str,
+                      options: MountOptions = MountOptions(),
+                      mount_id: Optional[MountID] = None) -> CharybdisOperations:
+    page_cache = block_cache = capacity = None
+    if options.page_cache_size:
+        page_cache = PageCache(max_pages=options.page_cache_size * 2 ** 20 // DEFAULT_PAGE_SIZE)
+    if options.block_cache_size:
+        block_cache = BlockCache(max_blocks=options.block_cache_size * 2 ** 20 // DEFAULT_BLOCK_SIZE,
+                                 max_read_ahead=options.max_read_ahead)
+    if options.capacity:
+        used = get_tree_usage(root=source)
+        LOGGER.info("%s bytes of %s MiB capacity used in %s", used, options.capacity, source)
+        capacity = CapacityLimit(capacity=options.capacity * 2 ** 20, used=used)
+    return CharybdisOperations(source=source,
+                               mount_id=mount_id,
+                               page_cache=page_cache,
+                               block_cache=block_cache,
+                               lazy_forget=options.lazy_forget,
+                               direct_io_buffers=AlignedBufferPool(size=options.direct_io_buffers),
+                               io_workers=options.io_workers,
+                               xattr_cache=XattrCache(ttl=options.xattr_cache_ttl) if options.xattr_cache_ttl else None,
+                               capacity=capacity,
+                               io_scheduler=IOScheduler(queue_depth=options.queue_depth, policy=options.io_scheduler)
+                               if options.queue_depth else None,
+                               request_timeout=options.request_timeout or None,
+                               max_backing_fds=get_default_max_backing_fds()
+                               if options.max_backing_fds is None else options.max_backing_fds,
+                               slow_request_threshold=options.slow_request_threshold or None,
+                               loop_stall_threshold=options.loop_stall_threshold,
+                               fsync_coalescing=options.fsync_coalescing)
+
+
+def get_default_max_backing_fds() -> int:
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return 0
+    return max(soft_limit - FD_LIMIT_HEADROOM, soft_limit // 2)
+
+
+def get_fuse_options(debug: bool = False) -> set:
+    fuse_options = set(pyfuse3.default_options)
+    fuse_options.add("fsname=charybdisfs")
+    if debug:
+        fuse_options.add("debug")
+    return fuse_options
+
+
+def get_shards(source: str, target: str, subdirs: Iterable[str]) -> List[Tuple[str, str]]:
+    """Return source and target directories of mounts which serve subdirectories of a mount in child processes.
+
+    Requests for files in a shard go to its own FUSE session and process, so they are handled by another core.
+    """
+
+    source = os.path.abspath(source)
+    shards = []
+    for subdir in subdirs:
+        shard_source = os.path.normpath(os.path.join(source, subdir))
+        if shard_source == source or os.path.commonpath((source, shard_source)) != source:
+            raise ValueError(f"Shard {subdir} is not a subdirectory of the source directory")
+        if not os.path.isdir(shard_source):
+            raise ValueError(f"Shard {subdir} is not a directory")
+        shards.append((shard_source, os.path.join(os.path.abspath(target), os.path.relpath(shard_source, source))))
+    return shards
+
+
+async def charybdisfs_main(operations: CharybdisOperations,
+                           conn: Optional[Connection] = None,
+                           shards: Sequence[Tuple[str, str]] = ()) -> None:
+    operations.trio_token = trio.lowlevel.current_trio_token()
+    async with trio.open_nursery() as nursery:
+        if operations.lazy_forget:
+            nursery.start_soon(operations.reclaim_forgotten_inodes)
+        if operations.watchdog is not None:
+            nursery.start_soon(operations.watchdog.run)
+        nursery.start_soon(_become_ready, shards)
+        if conn is not None:
+            nursery.start_soon(_serve_commands, operations, conn, nursery.cancel_scope)
+            nursery.start_soon(_stop_on_signals, nursery.cancel_scope)
+        await pyfuse3.main()
+        nursery.cancel_scope.cancel()
+
+
+async def _become_ready(shards: Sequence[Tuple[str, str]]) -> None:
+    # Targets of shards are inside the mount, so they are mounted when the mount is served already.
+    for shard_source, shard_target in shards:
+        LOGGER.info("Mount shard %s to %s in a child process", shard_source, shard_target)
+        await trio.to_thread.run_sync(MountRegistry.add_mount, shard_source, shard_target)
+    await Readiness.become_ready()
+
+
+async def _serve_commands(operations: CharybdisOperations, conn: Connection, cancel_scope: trio.CancelScope) -> None:
+    events_subscriber: Optional[EventSubscriber] = None  # events are collected while the parent polls them
+    while True:
+        await trio.lowlevel.wait_readable(conn.fileno())
+        # A message can be split into several chunks, so it's received in a worker thread to don't block the loop.
+        command, args = await trio.to_thread.run_sync(conn.recv)
+        if command in ("set_faults", "set_scenarios", ):  # one-way notifications, no reply expected.
+            _set_configuration(command=command, args=args)
+        elif command in ("get_events", "unsubscribe_events", ):
+            events_subscriber = _serve_events(command=command, conn=conn, subscriber=events_subscriber)
+        elif command == "stop":
+            cancel_scope.cancel()
+            conn.send((True, None))
+            return
+        elif command in MOUNT_COMMANDS:
+            try:
+                conn.send((True, getattr(operations, command)(*args)))
+            except Exception as exc:
+                conn.send((False, str(exc)))
+        else:
+            conn.send((False, f"Unknown command: {command}"))
+
+
+def _set_configuration(command: str, args: tuple) -> None:
+    if command == "set_faults":
+        faults, mount_faults = args
+        Configuration.replace_all_faults(
+            faults={fault_id: create_fault_from_dict(data=fault) for fault_id, fault in faults.items()},
+            mount_faults=mount_faults,
+        )
+        return
+    scenarios, mount_scenarios = args
+    try:
+        Scenarios.replace_all_scenarios(scenarios=scenarios, mount_scenarios=mount_scenarios)
+    except ValueError as exc:
+        LOGGER.error("Unable to set scenarios: %s", exc)
+
+
+def _serve_events(command: str, conn: Connection, subscriber: Optional[EventSubscriber]) -> Optional[EventSubscriber]:
+    """Reply to an events command of the parent: return the subscriber to keep."""
+
+    if command == "unsubscribe_events":
+        if subscriber is not None:
+            EventStream.unsubscribe(subscriber)
+        conn.send((True, None))
+        return None
+    if subscriber is None:
+        subscriber = EventStream.subscribe()
+    conn.send((True, subscriber.get_batch(max_size=DEFAULT_QUEUE_SIZE, timeout=0)))
+    return subscriber
+
+
+async def _stop_on_signals(cancel_scope: trio.CancelScope) -> None:
+    with trio.open_signal_receiver(signal.SIGTERM, signal.SIGINT) as signals:
+        async for signum in signals:
+            LOGGER.info("Got signal %s, going to unmount", signum)
+            cancel_scope.cancel()
+            return
+
+
+def serve_mount(mount_id: MountID, source: str, target: str, options: MountOptions, conn: Connection) -> None:
+    """Entry point of a child process which serves one mount."""
+
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG if options.debug else logging.INFO)
+    # NOTIFY_SOCKET is inherited, but systemd should get READY=1 from the main process only.
+    Readiness.notify_supervisor = False
+    try:
+        operations = create_operations(source=source, options=options, mount_id=mount_id)
+        pyfuse3.init(operations, target, get_fuse_options(debug=options.debug))
+    except Exception as exc:
+        conn.send((False, str(exc)))
+        return
+    conn.send((True, None))
+    try:
+        trio.run(charybdisfs_main, operations, conn)
+    finally:
+        if operations.page_cache is not None:
+            operations.page_cache.flush_all()
+        pyfuse3.close(unmount=True)
+
+
+class MountProcess:
+    """A mount served by a child process: pyfuse3 supports one FUSE session per process only."""
+
+    def __init__(self, mount_id: MountID, source: str, target: str, options: MountOptions):
+        self.mount_id = mount_id
+        self.source = source
+        self.target = target
+        self.conn, self.child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.get_context("spawn").Process(
+            target=serve_mount,
+            kwargs={"mount_id": mount_id, "source": source, "target": target, "options": options, "conn": self.child_conn},
+            name=f"CharybdisFS-{mount_id}",
+            daemon=True,
+        )
+        self.lock = threading.Lock()
+        self.lost_replies = 0  # replies to calls which timed out
+        self.events_subscribed = False
+
+        # The latest state to push by command: a hung child blocks own pusher thread only, and states which aren't
+        # sent yet are replaced by newer ones.
+        self.pushes: Dict[str, Tuple[Any, ...]] = {}
+        self.pushes_changed = threading.Condition(threading.Lock())
+        self.pusher = threading.Thread(target=self._push_forever, name=f"{self.process.name}-pusher", daemon=True)
+        self.stopped = False
+
+    def start(self) -> None:
+        self.process.start()
+        self.child_conn.close()
+        try:
+            if not self.conn.poll(MOUNT_START_TIMEOUT):
+                self.process.kill()
+                raise RuntimeError(f"Mount {self.mount_id} is not ready after {MOUNT_START_TIMEOUT}s")
+            ok, error = self.conn.recv()
+        except EOFError:
+            ok, error = False, f"process exited with code {self.process.exitcode}"
+        if not ok:
+            self.process.join()
+            raise RuntimeError(f"Unable to mount {self.source} to {self.target}: {error}")
+        self.pusher.start()
+
+    def stop(self) -> None:
+        with self.pushes_changed:
+            self.stopped = True
+            self.pushes_changed.notify()
+        try:
+            self.call("stop")
+        except (OSError, EOFError, RuntimeError) as exc:
+            LOGGER.warning("Unable to stop mount %s gracefully: %s", self.mount_id, exc)
+            self.process.terminate()
+        self.process.join(MOUNT_STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+    def call(self, command: str, *args: Any) -> Any:
+        with self.lock:
+            while self.lost_replies and self.conn.poll(0):  # a late reply would be taken as a reply to this call.
+                self.conn.recv()
+                self.lost_replies -= 1
+            if self.lost_replies:
+                raise RuntimeError(f"Mount {self.mount_id} doesn't reply")
+            self.conn.send((command, args))
+            if not self.conn.poll(MOUNT_CALL_TIMEOUT):
+                self.lost_replies += 1
+                raise RuntimeError(f"Mount {self.mount_id} didn't reply to `{command}' in {MOUNT_CALL_TIMEOUT}s")
+            ok, result = self.conn.recv()
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+    def notify(self, command: str, *args: Any) -> None:
+        with self.lock:
+            self.conn.send((command, args))
+
+    def push(self, command: str, *args: Any) -> None:
+        """Send a one-way notification with the latest state from the pusher thread: it never blocks the caller."""
+
+        with self.pushes_changed:
+            self.pushes[command] = args
+            self.pushes_changed.notify()
+
+    def _push_forever(self) -> None:
+        while True:
+            with self.pushes_changed:
+                while not self.pushes and not self.stopped:
+                    self.pushes_changed.wait()
+                if self.stopped:
+                    return
+                pushes, self.pushes = self.pushes, {}
+            for command, args in pushes.items():
+                try:
+                    self.notify(command, *args)
+                except OSError as exc:
+                    LOGGER.error("Unable to send %s to mount %s: %s", command, self.mount_id, exc)
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        return self.call("get_stats")
+
+    def get_faults_stats(self) -> Dict[FaultID, Dict[str, Any]]:
+        return self.call("get_faults_stats")
+
+    def crash(self) -> int:
+        return self.call("crash")
+
+    def cancel_requests(self, min_age: float = 0) -> int:
+        return self.call("cancel_requests", min_age)
+
+    def start_profiler(self, mode: str, interval: float) -> None:
+        self.call("start_profiler", mode, interval)
+
+    def stop_profiler(self) -> bytes:
+        return self.call("stop_profiler")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"mount_id": self.mount_id, "source": self.source, "target": self.target, "pid": self.process.pid}
+
+
+class MountRegistry:
+    """Mounts served by child processes of this daemon."""
+
+    mounts: Dict[MountID, MountProcess] = {}
+    mounts_lock = threading.RLock()
+    starting_targets: Set[str] = set()  # mounts which are started now, they aren't registered yet
+    default_options = MountOptions()
+    events_forwarder: Optional[threading.Thread] = None
+
+    @classmethod
+    def add_mount(cls, source: str, target: str, options: Optional[MountOptions] = None) -> MountID:
+        sys.audit("charybdisfs.mounts", "add_mount", source, target)
+
+        mount_id = MountID(generate_fault_id())
+        mount = MountProcess(mount_id=mount_id, source=source, target=target, options=options or cls.default_options)
+        with cls.mounts_lock:
+            if target in cls.starting_targets or any(m.target == target for m in cls.mounts.values()):
+                raise ValueError(f"{target} is mounted already")
+            cls.starting_targets.add(target)
+        try:
+            mount.start()  # the handshake can take a while, so it's done without the lock.
+        except BaseException:
+            with cls.mounts_lock:
+                cls.starting_targets.discard(target)
+            raise
+        with cls.mounts_lock:
+            cls.starting_targets.discard(target)
+            cls.mounts[mount_id] = mount
+            if cls.push_faults not in Configuration.listeners:
+                Configuration.listeners.append(cls.push_faults)
+            if cls.push_scenarios not in Scenarios.listeners:
+                Scenarios.listeners.append(cls.push_scenarios)
+            if cls.events_forwarder is None:
+                cls.events_forwarder = threading.Thread(target=cls._forward_events_forever,
+                                                        name="EventsForwarder",
+                                                        daemon=True)
+                cls.events_forwarder.start()
+        # Push methods lock the configuration first and then the mounts, so they're called without the mounts lock.
+        cls.push_faults(mounts=(mount, ))
+        cls.push_scenarios(mounts=(mount, ))
+        return mount_id
+
+    @classmethod
+    def remove_mount(cls, mount_id: MountID) -> bool:
+        sys.audit("charybdisfs.mounts", "remove_mount", mount_id)
+
+        with cls.mounts_lock:
+            if (mount := cls.mounts.pop(mount_id, None)) is None:
+                return False
+        mount.stop()
+        with Configuration.syscalls_conf_lock:
+            for fault_id in [fault_id for fault_id, m_id in Configuration.mount_faults.items() if m_id == mount_id]:
+                Configuration.remove_fault(fault_id=fault_id)
+        with Scenarios.scenarios_lock:
+            for scenario_id in [s_id for s_id, m_id in Scenarios.mount_scenarios.items() if m_id == mount_id]:
+                Scenarios.remove_scenario(scenario_id=scenario_id)
+        return True
+
+    @classmethod
+    def remove_all_mounts(cls) -> None:
+        for mount_id in list(cls.mounts):
+            cls.remove_mount(mount_id=mount_id)
+
+    @classmethod
+    def get_mount(cls, mount_id: MountID) -> Optional[MountProcess]:
+        with cls.mounts_lock:
+            return cls.mounts.get(mount_id)
+
+    @classmethod
+    def get_all_mounts(cls) -> List[Dict[str, Any]]:
+        with cls.mounts_lock:
+            return [mount.to_dict() for mount in cls.mounts.values()]
+
+    @classmethod
+    def get_all_faults_stats(cls) -> Dict[FaultID, Dict[str, Any]]:
+        """Return stats of faults summed over this process and child processes: each of them runs own copies."""
+
+        stats = {fault_id: FaultStats(**fault_stats)
+                 for fault_id, fault_stats in Configuration.get_all_faults_stats().items()}
+        with cls.mounts_lock:
+            mounts = list(cls.mounts.values())
+        for mount in mounts:
+            try:
+                mount_stats = mount.get_faults_stats()
+            except (OSError, EOFError, RuntimeError) as exc:
+                LOGGER.warning("Unable to get faults stats of mount %s: %s", mount.mount_id, exc)
+                continue
+            for fault_id, fault_stats in mount_stats.items():
+                if fault_id in stats:  # skip faults which are removed already.
+                    stats[fault_id].add(FaultStats(**fault_stats))
+        return {fault_id: fault_stats.to_dict() for fault_id, fault_stats in stats.items()}
+
+    @classmethod
+    def forward_events(cls) -> None:
+        """Republish events of child processes while this process has subscribers."""
+
+        subscribed = bool(EventStream.subscribers)
+        with cls.mounts_lock:
+            mounts = list(cls.mounts.values())
+        for mount in mounts:
+            try:
+                if subscribed:  # a child starts to collect events on the first call.
+                    batch = mount.call("get_events")
+                    mount.events_subscribed = True
+                    EventStream.forward(events=batch["events"], dropped=batch["dropped"])
+                elif mount.events_subscribed:
+                    mount.call("unsubscribe_events")
+                    mount.events_subscribed = False
+            except (OSError, EOFError, RuntimeError) as exc:
+                LOGGER.warning("Unable to forward events of mount %s: %s", mount.mount_id, exc)
+
+    @classmethod
+    def _forward_events_forever(cls) -> None:
+        while True:
+            cls.forward_events()
+            time.sleep(EVENTS_FORWARD_INTERVAL)
+
+    @classmethod
+    def push_faults(cls, mounts: Optional[Iterable[MountProcess]] = None) -> None:
+        """Send the current fault configuration to child processes: it's queued, so children aren't called here."""
+
+        with Configuration.syscalls_conf_lock, cls.mounts_lock:
+            state: Tuple[Dict[FaultID, Dict[str, Any]], Dict[FaultID, MountID]] = (
+                {fault_id: fault.to_dict() for fault_id, fault in Configuration.syscalls_conf.items()},
+                dict(Configuration.mount_faults),
+            )
+            for mount in (cls.mounts.values() if mounts is None else mounts):
+                faults, mount_faults = state
+                mount_faults = {fault_id: m_id for fault_id, m_id in mount_faults.items() if m_id == mount.mount_id}
+                faults = {fault_id: fault for fault_id, fault in faults.items()
+                          if fault_id not in state[1] or fault_id in mount_faults}
+                mount.push("set_faults", faults, mount_faults)
+
+    @classmethod
+    def push_scenarios(cls, mounts: Optional[Iterable[MountProcess]] = None) -> None:
+        """Send descriptions of scenarios to child processes: they run own copies of new scenarios."""
+
+        with Scenarios.scenarios_lock, cls.mounts_lock:
+            scenarios, mount_scenarios = Scenarios.scenarios, Scenarios.mount_scenarios
+            for mount in (cls.mounts.values() if mounts is None else mounts):
+                scenarios_state: Tuple[Dict[ScenarioID, Dict[str, Any]], Dict[ScenarioID, MountID]] = (
+                    {scenario_id: scenario.to_dict() for scenario_id, scenario in scenarios.items()
+                     if mount_scenarios.get(scenario_id) in (None, mount.mount_id)},
+                    {scenario_id: m_id for scenario_id, m_id in mount_scenarios.items() if m_id == mount.mount_id},
+                )
+                mount.push("set_scenarios", *scenarios_state)
+
+
+__all__ = ("MountOptions", "MountRegistry", "create_operations", "get_fuse_options", "get_shards", "charybdisfs_main", )
@@ -17,26 +17,53 @@ from __future__ import annotations
 import os
 import sys
 import stat
+import time
 import errno
 import random
+import inspect
 import logging
-from typing import NewType, List, Tuple, Literal, Sequence, Dict, Optional, Union, Set, NoReturn, Callable, Type, cast
+import threading
+from typing import TYPE_CHECKING, \
+    NewType, List, Tuple, Literal, Sequence, Dict, Optional, Union, NoReturn, Callable, Type, Iterable, Iterator, TypeVar, \
+    Any, cast
 from functools import wraps
-from collections import Counter
+from contextlib import suppress, contextmanager
+from collections import deque, OrderedDict
 
+import trio
 import pyfuse3
 from pyfuse3 import \
     Operations, RequestContext, EntryAttributes, SetattrFields, FileInfo, StatvfsData, ReaddirToken, FUSEError, \
     RENAME_EXCHANGE, RENAME_NOREPLACE, ROOT_INODE
 
-from core.faults import SysCall
-from core.configuration import Configuration
+from core.faults import BaseFault, SysCall, Caller, Call
+from core.events import EventStream, FAULT_EVENT, SYSCALL_ERROR_EVENT
+from core.page_cache import PageCache
+from core.direct_io import AlignedBufferPool
+from core.block_cache import BlockCache
+from core.xattr_cache import XattrCache, NO_ATTRIBUTE
+from core.capacity import CapacityLimit
+from core.io_scheduler import IOScheduler, SCHEDULED_CALLS
+from core.inflight import InFlightRequests
+from core.fsync_coalescer import FsyncCoalescer
+from core.watchdog import Watchdog, DEFAULT_LOOP_STALL_THRESHOLD
+from core.profiler import Profiler, SAMPLING, DEFAULT_INTERVAL as DEFAULT_PROFILER_INTERVAL
+from core.configuration import Configuration, FaultID, MountID
+from core.scenarios import Scenarios
+
+if TYPE_CHECKING:
+    from core.trace import TraceRecorder
 
 
 # Everything from manpage statvfs(2) except f_flag and f_sid.
 STATVFS_DATA_FIELDS = \
     ("f_bsize", "f_frsize", "f_blocks", "f_bfree", "f_bavail", "f_files", "f_ffree", "f_favail", "f_namemax", )
 
+# Forget requests are processed by chunks to don't block the event loop by huge batches.
+FORGET_BATCH_SIZE = 1024
+MAX_PENDING_FORGETS = 1024 * FORGET_BATCH_SIZE
+FORGET_RECLAIM_INTERVAL = 0.1  # seconds
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -47,122 +74,340 @@ FileHandle = NewType("FileHandle", int)
 FileMode = NewType("FileMode", int)
 RenameFlags = Literal[RENAME_EXCHANGE, RENAME_NOREPLACE]
 
+T = TypeVar("T")
+
+
+class INodeRecord:
+    __slots__ = ("path", "aliases", "nlookup", )
+
+    def __init__(self, path: Optional[str], nlookup: int = 0):
+        self.path = path  # the primary path: stays the same while it exists.
+        self.aliases: Optional[Dict[str, None]] = None  # other hard links in order of adding.
+        self.nlookup = nlookup
+
+    def __repr__(self):
+        return f"{type(self).__name__}(path={self.path!r}, aliases={self.aliases!r}, nlookup={self.nlookup})"
+
+    def get_paths(self) -> List[str]:
+        if self.path is None:
+            return []
+        return [self.path, *self.aliases] if self.aliases else [self.path]
+
+    def add_path(self, path: str) -> None:
+        if self.path is None:
+            self.path = path
+        elif path != self.path:
+            if self.aliases is None:
+                self.aliases = {}
+            self.aliases[path] = None
+
+    def remove_path(self, path: str) -> bool:
+        """Return False if there is no such path."""
+
+        if path == self.path:
+            if self.aliases:
+                self.path = next(iter(self.aliases))
+                self.remove_alias(self.path)
+            else:
+                self.path = None
+            return True
+        if self.aliases and path in self.aliases:
+            self.remove_alias(path)
+            return True
+        return False
+
+    def remove_alias(self, path: str) -> None:
+        del self.aliases[path]
+        if not self.aliases:
+            self.aliases = None
+
+
+class PathMapping(Dict[INode, INodeRecord]):
+    """Paths of inodes known to the kernel.
+
+    An inode with several hard links has a primary path and aliases.  The mapping follows changes made through
+    CharybdisFS only, so if a path to forget or to replace is unknown (e.g., the backing FS was changed directly),
+    all paths of the inode are checked against the backing FS instead.
+    """
 
-class PathMapping(Dict[INode, Union[str, Set[str]]]):
     def __init__(self, root: str):
-        super().__init__({ROOT_INODE: root, })
-        self.inode_lookups: Counter = Counter()
+        super().__init__({ROOT_INODE: INodeRecord(path=root), })
         self.path_prefix_len = len(root) + 1
 
     def __getitem__(self, inode: INode) -> str:
-        path = super().__getitem__(inode)
-        if isinstance(path, set):
-            for path in path:
-                break
+        if (path := super().__getitem__(inode).path) is None:
+            raise KeyError(inode)
         return path
 
     def __setitem__(self, inode: INode, path: str) -> None:
-        self.inode_lookups[inode] += 1
-        if (old_path := super().get(inode)) is not None:
-            if isinstance(old_path, set):
-                old_path.add(path)
-            elif old_path != path:
-                super().__setitem__(inode, {old_path, path})
-        else:
-            super().__setitem__(inode, path)
+        if (record := super().get(inode)) is None:
+            super().__setitem__(inode, INodeRecord(path=path, nlookup=1))
+            return
+        record.nlookup += 1
+        record.add_path(path)
 
     def join(self, inode: INode, path: Union[str, bytes], /) -> str:
         return os.path.join(self[inode], os.fsdecode(path))
 
+    def get_nlookup(self, inode: INode) -> int:
+        return 0 if (record := super().get(inode)) is None else record.nlookup
+
+    def has_path(self, inode: INode) -> bool:
+        return (record := super().get(inode)) is not None and record.path is not None
+
+    def get_paths(self, inode: INode) -> List[str]:
+        """Return the primary path first and then aliases."""
+
+        return [] if (record := super().get(inode)) is None else record.get_paths()
+
     def forget_path(self, inode: INode, path: str) -> None:
-        if (inode_path := super().get(inode)) is None:
+        if (record := super().get(inode)) is None:
             return
-        if isinstance(inode_path, set):
-            inode_path.remove(path)  # can raise KeyError if there is no such path
-            if len(inode_path) == 1:
-                for path in inode_path:
-                    super().__setitem__(inode, path)
-        elif inode_path == path:
-            del self[inode]
-        else:
-            raise KeyError(path)
+        if not record.remove_path(path):
+            LOGGER.debug("Unknown %s for inode=%s: revalidate paths", path, inode)
+            self.revalidate(inode=inode)
+        elif record.path is None and not record.nlookup:
+            del self[inode]  # keep lookups counter until the kernel forgets the inode.
 
     def replace_path(self, inode: INode, old_path: str, new_path: str) -> None:
-        if (path := super().get(inode)) is None:
+        if (record := super().get(inode)) is None:
             return
-        if isinstance(path, set):
-            path.remove(old_path)  # can raise KeyError if there is no such path
-            path.add(new_path)
+        if old_path == record.path and not record.aliases:  # the most common case: no hard links.
+            record.path = new_path
+        elif new_path in record.get_paths() or not record.remove_path(old_path):
+            # Either both paths are links to the same inode and rename(2) did nothing, or the old path is unknown.
+            LOGGER.debug("Unexpected rename of %s to %s for inode=%s: revalidate paths", old_path, new_path, inode)
+            record.add_path(new_path)
+            self.revalidate(inode=inode)
         else:
-            if path != old_path:
-                raise KeyError(old_path)
-            super().__setitem__(inode, new_path)
+            record.add_path(new_path)
+
+    def revalidate(self, inode: INode) -> Optional[str]:
+        """Drop paths which aren't links to the inode anymore and return the primary path."""
+
+        if inode == ROOT_INODE or (record := super().get(inode)) is None:
+            return None
+        paths = record.get_paths()
+        record.path, record.aliases = None, None
+        for path in paths:
+            try:
+                if os.lstat(path).st_ino == inode:
+                    record.add_path(path)
+            except OSError:
+                pass
+        if record.path is None and not record.nlookup:
+            del self[inode]
+        return record.path
 
     def forget_inode_lookups(self, inode: INode, nlookup: int) -> bool:
         """Return True if inode removed from the mapping."""
 
-        if nlookup >= self.inode_lookups[inode]:
-            del self.inode_lookups[inode]
-            self.pop(inode, None)
-            return True
-        self.inode_lookups[inode] -= nlookup
-        return False
+        return bool(self.forget_lookups(inode_list=((inode, nlookup), )))
+
+    def forget_lookups(self, inode_list: Iterable[Tuple[INode, int]]) -> List[INode]:
+        """Batched version of `forget_inode_lookups()': return inodes removed from the mapping."""
+
+        removed = []
+        get, pop = super().get, super().pop
+        for inode, nlookup in inode_list:
+            if (record := get(inode)) is None or nlookup >= record.nlookup:
+                pop(inode, None)
+                removed.append(inode)
+            else:
+                record.nlookup -= nlookup
+        return removed
+
+
+class OpenFile:
+    __slots__ = ("inode", "fd", "flags", "users", "workers", "closing", "written", "caller", )
+
+    def __init__(self, inode: INode, fd: FileDescriptor, flags: int, caller: Optional[Caller] = None):
+        self.inode = inode
+        self.fd: Optional[FileDescriptor] = fd  # None if closed by the backing fds limit
+        self.flags = flags
+        self.users = 0  # requests which use the fd now
+        self.workers = 0  # I/O workers which use the fd now: they can outlive cancelled requests
+        self.closing = False  # the file is released: the last worker closes the fd
+        self.written = False  # there was a write through the handle
+        self.caller = caller  # the process which opened the file: calls by the file handle are attributed to it
 
+    def __repr__(self):
+        return f"{type(self).__name__}(inode={self.inode}, fd={self.fd}, flags={self.flags:#o})"
 
-class FileDescriptorMapping(Dict[INode, FileDescriptor]):
-    def __init__(self):
+
+class FileDescriptorMapping(Dict[FileHandle, OpenFile]):
+    """Backing file descriptor per file handle, so every open() has own access mode.
+
+    Number of open backing fds can be limited by `max_fds': least recently used fds which aren't in use are closed
+    and reopened by path with the original flags on next use.
+    """
+
+    def __init__(self, paths: Optional[PathMapping] = None, max_fds: int = 0):
         super().__init__()
-        self.inodes: Dict[FileDescriptor, INode] = {}
-        self.open_counters = Counter()
-
-    def __setitem__(self, inode: INode, fd: FileDescriptor):
-        if inode in self:
-            raise ValueError("Can't assign same inode twice")
-        super().__setitem__(inode, fd)
-        self.inodes[fd] = inode
-        self.open_counters[fd] = 1
-
-    def __delitem__(self, inode: INode):
-        del self.inodes[(fd := super().pop(inode))]
-        del self.open_counters[fd]
-
-    def acquire_by_inode(self, inode: INode) -> Optional[FileDescriptor]:
-        if (fd := self.get(inode)) is not None:
-            self.open_counters[fd] += 1
-        return fd
+        self.inodes: Dict[INode, Dict[FileHandle, None]] = {}  # open file handles by inode in order of opening.
+        self.last_fh = 0
+        self.paths = paths
+        self.max_fds = max_fds
+        self.open_fds: OrderedDict[FileHandle, None] = OrderedDict()  # in LRU order, if the limit is set
+        self.lock = threading.Lock()  # guards fds of files which are pinned by I/O workers
+
+        self.hits = 0
+        self.reopens = 0
+        self.reopen_errors = 0
+        self.evictions = 0
+
+    def add(self, inode: INode, fd: FileDescriptor, flags: int, caller: Optional[Caller] = None) -> FileHandle:
+        self.last_fh += 1
+        fh = cast(FileHandle, self.last_fh)
+        super().__setitem__(fh, OpenFile(inode=inode, fd=fd, flags=flags, caller=caller))
+        self.inodes.setdefault(inode, {})[fh] = None
+        if self.max_fds:
+            self.open_fds[fh] = None
+            self._shrink()
+        return fh
+
+    def release(self, fh: FileHandle) -> OpenFile:
+        open_file = super().pop(fh)
+        handles = self.inodes[open_file.inode]
+        del handles[fh]
+        if not handles:
+            del self.inodes[open_file.inode]
+        self.open_fds.pop(fh, None)
+        return open_file
+
+    def get_fd(self, fh: FileHandle) -> FileDescriptor:
+        """Return the backing fd: reopen it if it was closed.
+
+        The fd can be closed on next add() or reopen, so use `use()' if there are awaits before the fd is used.
+        """
+
+        open_file = self[fh]
+        if self.max_fds:
+            if open_file.fd is None:
+                open_file.fd = self._reopen(open_file=open_file)
+                self.open_fds[fh] = None
+                self._shrink()
+            else:
+                self.hits += 1
+                self.open_fds.move_to_end(fh)
+        return open_file.fd
 
-    def acquire(self, fd: FileDescriptor) -> None:
-        self.open_counters[fd] += 1
+    @contextmanager
+    def use(self, fh: FileHandle) -> Iterator[OpenFile]:
+        """Keep the backing fd open while in use."""
 
-    def release(self, fd: FileDescriptor) -> bool:
-        """Return True if associated inode removed from the mapping."""
+        self.get_fd(fh)
+        open_file = self[fh]
+        open_file.users += 1
+        try:
+            yield open_file
+        finally:
+            open_file.users -= 1
 
-        if self.open_counters[fd] == 1:
-            del self[self.inodes[fd]]
-            return True
-        self.open_counters[fd] -= 1
-        return False
+    @contextmanager
+    def pin(self, open_file: OpenFile) -> Iterator[FileDescriptor]:
+        """Keep the backing fd open while an I/O worker uses it: the fd can't be closed and reused meanwhile.
 
+        A cancelled request doesn't wait for its worker, so the file can be released while the worker runs.
+        """
 
-class CharybdisRuntimeErrors:
-    @staticmethod
-    def try_to_replace_fd_for_inode(inode: INode,
-                                    old_fd: FileDescriptor,
-                                    new_fd: FileDescriptor,
-                                    exc: Optional[Exception] = None) -> NoReturn:
-        raise RuntimeError(f"Try to replace {old_fd=} with {new_fd=} for {inode=}") from None
+        with self.lock:
+            if open_file.fd is None or open_file.closing:
+                raise OSError(errno.EBADF, os.strerror(errno.EBADF))
+            open_file.workers += 1
+        try:
+            yield open_file.fd
+        finally:
+            with self.lock:
+                open_file.workers -= 1
+                fd = None
+                if open_file.closing and not open_file.workers:
+                    fd, open_file.fd = open_file.fd, None
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError as exc:
+                    LOGGER.warning("Unable to close backing fd of %s: %s", open_file, exc)
+
+    def close(self, open_file: OpenFile) -> None:
+        """Close the backing fd of a released file, or leave it to the last I/O worker which uses it."""
+
+        with self.lock:
+            open_file.closing = True
+            if open_file.workers:
+                return
+            fd, open_file.fd = open_file.fd, None
+        if fd is not None:  # None if closed by the backing fds limit already.
+            os.close(fd)
+
+    def get_fd_by_inode(self, inode: INode) -> Optional[FileDescriptor]:
+        """Return an open backing fd of the inode if there is any."""
+
+        if (handles := self.inodes.get(inode)) is None:
+            return None
+        for fh in handles:
+            if (fd := self[fh].fd) is not None:
+                return fd
+        return None
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "open_fds": len(self.open_fds),
+            "max_fds": self.max_fds,
+            "hits": self.hits,
+            "reopens": self.reopens,
+            "reopen_errors": self.reopen_errors,
+            "evictions": self.evictions,
+        }
+
+    def _reopen(self, open_file: OpenFile) -> FileDescriptor:
+        try:
+            fd = cast(FileDescriptor,
+                      os.open(self.paths[open_file.inode], open_file.flags & ~(os.O_CREAT | os.O_EXCL | os.O_TRUNC)))
+        except (KeyError, OSError) as exc:
+            LOGGER.debug("Unable to reopen %s: %s", open_file, exc)
+            self.reopen_errors += 1
+            raise OSError(errno.ESTALE, os.strerror(errno.ESTALE)) from None
+        if os.fstat(fd).st_ino != open_file.inode:  # the path was replaced behind CharybdisFS.
+            os.close(fd)
+            self.reopen_errors += 1
+            raise OSError(errno.ESTALE, os.strerror(errno.ESTALE))
+        self.reopens += 1
+        return fd
 
+    def _shrink(self) -> None:
+        if (excess := len(self.open_fds) - self.max_fds) <= 0:
+            return
+        evicted = []
+        for fh in self.open_fds:  # from the least recently used one.
+            open_file = self[fh]
+            # Unlinked files can't be reopened by path.
+            if open_file.users or not self.paths.has_path(open_file.inode):
+                continue
+            with self.lock:
+                if open_file.workers:
+                    continue
+                fd, open_file.fd = open_file.fd, None
+            try:
+                os.close(fd)
+            except OSError as exc:
+                LOGGER.warning("Unable to close backing fd of %s: %s", open_file, exc)
+            evicted.append(fh)
+            if len(evicted) == excess:
+                break
+        for fh in evicted:  # the order can't be changed while it's iterated.
+            del self.open_fds[fh]
+        self.evictions += len(evicted)
+
+
+class CharybdisRuntimeErrors:
     @staticmethod
     def forgot_inode_with_open_fd(inode: INode, fd: FileDescriptor, exc: Optional[Exception] = None) -> NoReturn:
         raise RuntimeError(f"Forgot about {inode=} with open {fd=}") from None
 
     @staticmethod
-    def unknown_path(inode: INode, path: str, exc: Optional[Exception] = None) -> NoReturn:
-        raise RuntimeError(f"Unknown {path=} for {inode=}") from None
-
-    @staticmethod
-    def unknown_fd(fd: FileDescriptor, exc: Optional[Exception] = None) -> NoReturn:
-        raise RuntimeError(f"Unknown {fd=}") from None
+    def unknown_fh(fh: FileHandle, exc: Optional[Exception] = None) -> NoReturn:
+        raise RuntimeError(f"Unknown {fh=}") from None
 
 
 class faulty:
@@ -175,10 +420,18 @@ class faulty:
 
     def __init__(self, func: Callable):
         self.__func__ = func
+        self.arg_names = tuple(inspect.signature(func).parameters)[1:]  # without self
+        self.ctx_index = self.arg_names.index("ctx") if "ctx" in self.arg_names else None
+        # Directory handles are inodes, so only calls by file handles can be attributed to a process.
+        self.fh_index = self.arg_names.index("fh") \
+            if "fh" in self.arg_names and func.__name__ not in ("fsyncdir", "releasedir", ) else None
+        # Name of the file for conditions of faults: names of xattr calls are names of attributes.
+        self.name_arg = next((arg for arg in ("name", "new_name", "name_old", ) if arg in self.arg_names), None) \
+            if not func.__name__.endswith("xattr") else None
 
     def __get__(self, instance: CharybdisOperations, owner: Optional[Type[CharybdisOperations]] = None) -> Callable:
         @wraps(self.__func__)
-        def wrapper(*args, **kwargs):
+        async def wrapper(*args, **kwargs):
             sys.audit("charybdisfs.syscall", self.__name__, args, kwargs)
 
             # At this point we should have following things:
@@ -187,17 +440,179 @@ class faulty:
             #   * instance      : instance of CharybdisOperations class
             #   * args, kwargs  : arguments for FS call
 
-            rand = random.randint(0, 99)  # 100 possible values.
+            recorder = instance.recorder
+            start = time.monotonic_ns()
+
+            sys_call = SysCall(self.__name__)
+            fired = self._select_fault(instance=instance, sys_call=sys_call, args=args, kwargs=kwargs)
+
+            result = None
+            error_no = 0
+            if (io_scheduler := instance.io_scheduler) is not None and sys_call not in SCHEDULED_CALLS:
+                io_scheduler = None
+            dispatched = False
+            request = instance.requests.start(sys_call=sys_call,
+                                              arg_names=self.arg_names,
+                                              args=args,
+                                              kwargs=kwargs,
+                                              fault=fired)
+            try:
+                with request.cancel_scope:
+                    if io_scheduler is not None:
+                        # Faults are applied in the device queue slot too: a latency fault makes the device slower.
+                        await io_scheduler.acquire(sys_call=sys_call)
+                        dispatched = True
+
+                    if fired is not None:
+                        try:
+                            await self._apply_fault(instance=instance, fault=fired, args=args, kwargs=kwargs)
+                        except FUSEError as exc:
+                            error_no = exc.errno
+                            raise
+
+                    # Do the passthru call if no any fault raised an exception.
+                    try:
+                        result = await self.__func__(instance, *args, **kwargs)
+                    except FUSEError as exc:
+                        error_no = exc.errno
+                        EventStream.publish(SYSCALL_ERROR_EVENT,
+                                            sys_call=self.__name__,
+                                            mount_id=instance.mount_id,
+                                            errno=exc.errno)
+                        raise
+                    return result
+                error_no = errno.EINTR  # cancelled by the request timeout or explicitly.
+                raise FUSEError(errno.EINTR)
+            finally:
+                instance.requests.finish(request)
+                if dispatched:
+                    io_scheduler.release()
+                if recorder is not None:
+                    self._record(instance=instance,
+                                 recorder=recorder,
+                                 start=start,
+                                 args=args,
+                                 kwargs=kwargs,
+                                 result=result,
+                                 fault=fired,
+                                 error_no=error_no)
+        return wrapper
 
-            for fault in instance.faults.get_faults_by_sys_call(sys_call=SysCall(self.__name__)):
+    def _select_fault(self,
+                      instance: CharybdisOperations,
+                      sys_call: SysCall,
+                      args: tuple,
+                      kwargs: dict) -> Optional[BaseFault]:
+        """Evaluate faults and scenarios of the call: return the fault to apply, if any."""
+
+        rand = random.randint(0, 99)  # 100 possible values.
+        fired = None
+
+        faults = instance.faults.get_faults_by_sys_call(sys_call=sys_call, mount_id=instance.mount_id)
+        if instance.scenarios.scenarios:
+            faults += instance.scenarios.get_faults_by_sys_call(sys_call=sys_call, mount_id=instance.mount_id)
+        caller = self._get_caller(instance, args, kwargs) if any(fault.targeted for fault in faults) else None
+        call = self._get_call(instance, args, kwargs) if any(fault.conditional for fault in faults) else None
+        for fault in faults:
+            if not fault.matches(caller) or call is not None and not fault.check(call):
+                continue
+            fault.stats.evaluations += 1
+            if fired is None:
                 rand -= fault.probability
                 if rand < 0:
-                    fault.apply()
-                    break
+                    fired = fault
+        return fired
+
+    async def _apply_fault(self, instance: CharybdisOperations, fault: BaseFault, args: tuple, kwargs: dict) -> None:
+        if EventStream.subscribers:  # don't build the event if nobody listens.
+            EventStream.publish(FAULT_EVENT,
+                                sys_call=self.__name__,
+                                mount_id=instance.mount_id,
+                                fault_id=instance.faults.get_fault_id(fault=fault),
+                                fault=fault.to_dict())
+        await fault.apply_async(nbytes=self._get_data_size(args, kwargs))
+
+    def _record(self,
+                instance: CharybdisOperations,
+                recorder: TraceRecorder,
+                start: int,
+                args: tuple,
+                kwargs: dict,
+                result: object,
+                fault: Optional[BaseFault],
+                error_no: int) -> None:
+        duration = time.monotonic_ns() - start
+        call_args = dict(zip(self.arg_names, args), **kwargs)
+        inode = call_args.get("inode", call_args.get("parent_inode", call_args.get("parent_inode_old"))) or 0
+        entry = 0
+        if isinstance(result, tuple):  # create() returns (FileInfo, EntryAttributes)
+            result, entry = result[0], result[1].st_ino
+        elif isinstance(result, EntryAttributes) and self.__name__ not in ("getattr", "setattr", ):
+            entry = result.st_ino
+        if (new_parent_inode := call_args.get("parent_inode_new", call_args.get("new_parent_inode"))) is not None:
+            fh = new_parent_inode  # rename() and link() have no file handles.
+        elif (fh := call_args.get("fh")) is None:
+            fh = result.fh if isinstance(result, FileInfo) else result if self.__name__ == "opendir" else 0
+        if not inode:
+            if self.__name__ in ("fsyncdir", "releasedir", ):  # directory handles are inodes.
+                inode = fh
+            elif (open_file := instance.descriptors.get(fh)) is not None:
+                inode = open_file.inode
+        for known_inode in (inode, entry, new_parent_inode, ):
+            if known_inode and known_inode not in recorder.inode_paths:
+                with suppress(KeyError):
+                    recorder.inode_paths[known_inode] = instance.paths[known_inode][instance.paths.path_prefix_len:]
+        recorder.record(sys_call=SysCall(self.__name__),
+                        start=start,
+                        duration=duration,
+                        inode=inode,
+                        fh=fh or 0,
+                        off=call_args.get("off", 0),
+                        size=self._get_data_size(args, kwargs),
+                        entry=entry,
+                        flags=int(call_args.get("flags", call_args.get("mode", call_args.get("datasync", 0))) or 0),
+                        name=call_args.get("name", call_args.get("name_old")),
+                        new_name=call_args.get("name_new", call_args.get("new_name")),
+                        fault=fault,
+                        error_no=error_no)
+
+    def _get_caller(self, instance: CharybdisOperations, args: tuple, kwargs: dict) -> Optional[Caller]:
+        if self.ctx_index is not None:
+            if (ctx := kwargs["ctx"] if "ctx" in kwargs else args[self.ctx_index]) is None:
+                return None
+            return Caller(pid=ctx.pid, uid=ctx.uid, gid=ctx.gid)
+        if self.fh_index is not None and \
+                (open_file := instance.descriptors.get(kwargs["fh"] if "fh" in kwargs else args[self.fh_index])) is not None:
+            return open_file.caller
+        return None
+
+    def _get_call(self, instance: CharybdisOperations, args: tuple, kwargs: dict) -> Call:
+        call_args = dict(zip(self.arg_names, args), **kwargs)
+        open_file = instance.descriptors.get(call_args["fh"]) if self.fh_index is not None else None
+        if self.__name__ in ("open", "create", ):
+            flags = call_args["flags"]
+        else:
+            flags = None if open_file is None else open_file.flags
+        if self.name_arg is not None:
+            name = os.fsdecode(call_args[self.name_arg])
+        elif (inode := call_args.get("inode", None if open_file is None else open_file.inode)) is not None:
+            try:
+                name = os.path.basename(instance.paths[inode])
+            except KeyError:
+                name = None
+        else:
+            name = None
+        size = self._get_data_size(args, kwargs) if self.__name__ in ("read", "write", ) else None
+        return Call(offset=call_args.get("off"), size=size, flags=flags, name=name)
 
-            # Do the passthru call if no any fault raised an exception.
-            return self.__func__(instance, *args, **kwargs)
-        return wrapper
+    def _get_data_size(self, args: tuple, kwargs: dict) -> int:
+        """Size of data passed by read(fh, off, size) and write(fh, off, buf) calls, 0 for others."""
+
+        if self.__name__ == "read":
+            return kwargs["size"] if "size" in kwargs else args[2]
+        if self.__name__ == "write":
+            return len(kwargs["buf"] if "buf" in kwargs else args[2])
+        return 0
 
     def __set_name__(self, owner: Type[CharybdisOperations], name: str) -> None:
         self.__name__ = name
@@ -210,11 +625,124 @@ class CharybdisOperations(Operations):
     enable_writeback_cache = True
     runtime_errors = CharybdisRuntimeErrors()
     faults = Configuration
-
-    def __init__(self, source: str):
+    scenarios = Scenarios
+
+    def __init__(self,
+                 source: str,
+                 mount_id: Optional[MountID] = None,
+                 page_cache: Optional[PageCache] = None,
+                 block_cache: Optional[BlockCache] = None,
+                 lazy_forget: bool = False,
+                 direct_io_buffers: Optional[AlignedBufferPool] = None,
+                 io_workers: int = 0,
+                 xattr_cache: Optional[XattrCache] = None,
+                 capacity: Optional[CapacityLimit] = None,
+                 io_scheduler: Optional[IOScheduler] = None,
+                 request_timeout: Optional[float] = None,
+                 max_backing_fds: int = 0,
+                 slow_request_threshold: Optional[float] = None,
+                 loop_stall_threshold: float = DEFAULT_LOOP_STALL_THRESHOLD,
+                 fsync_coalescing: bool = False):
         super().__init__()
+        self.mount_id = mount_id
         self.paths = PathMapping(root=source.rstrip("/"))
-        self.descriptors = FileDescriptorMapping()
+        self.descriptors = FileDescriptorMapping(paths=self.paths, max_fds=max_backing_fds)
+        self.lazy_forget = lazy_forget
+        self.pending_forgets: deque[Tuple[INode, int]] = deque()
+        self.page_cache = page_cache
+        self.block_cache = block_cache
+        self.direct_io_buffers = AlignedBufferPool() if direct_io_buffers is None else direct_io_buffers
+        if page_cache is not None and block_cache is not None:
+            page_cache.on_flush = block_cache.invalidate
+        self.xattr_cache = xattr_cache
+        self.capacity = capacity
+        self.io_scheduler = io_scheduler
+        self.fsync_coalescer = FsyncCoalescer() if fsync_coalescing else None
+        self.requests = InFlightRequests(timeout=request_timeout)
+        self.watchdog = Watchdog(requests=self.requests,
+                                 slow_request_threshold=slow_request_threshold,
+                                 loop_stall_threshold=loop_stall_threshold) if slow_request_threshold else None
+        self.trio_token: Optional[trio.lowlevel.TrioToken] = None  # set when the event loop is started
+
+        # Data path syscalls can be offloaded to worker threads: they release the GIL while wait for the backing
+        # store, so slow I/O on one file doesn't stall the event loop and other requests.  Other syscalls and
+        # dispatching of all requests stay in the event loop thread.
+        self.io_limiter = trio.CapacityLimiter(io_workers) if io_workers else None
+        self.recorder: Optional[TraceRecorder] = None
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        stats = {}
+        if self.page_cache is not None:
+            stats["page_cache"] = self.page_cache.get_stats()
+        if self.block_cache is not None:
+            stats["block_cache"] = self.block_cache.get_stats()
+        if self.xattr_cache is not None:
+            stats["xattr_cache"] = self.xattr_cache.get_stats()
+        if self.capacity is not None:
+            stats["capacity"] = self.capacity.get_stats()
+        if self.io_scheduler is not None:
+            stats["io_scheduler"] = self.io_scheduler.get_stats()
+        if self.fsync_coalescer is not None:
+            stats["fsync_coalescer"] = self.fsync_coalescer.get_stats()
+        stats["direct_io_buffers"] = self.direct_io_buffers.get_stats()
+        stats["requests"] = self.requests.get_stats()
+        if self.watchdog is not None:
+            stats["watchdog"] = self.watchdog.get_stats()
+        if self.scenarios.scenarios:
+            stats["scenarios"] = self.scenarios.get_state(mount_id=self.mount_id)
+        stats["backing_fds"] = self.descriptors.get_stats()
+        if self.io_limiter is not None:
+            stats["io_workers"] = {
+                "total": int(self.io_limiter.total_tokens),
+                "busy": self.io_limiter.borrowed_tokens,
+                "waiting": self.io_limiter.statistics().tasks_waiting,
+            }
+        return stats
+
+    async def _run_io(self, func: Callable[..., T], *args, cancellable: bool = False) -> T:
+        """Run a blocking call in an I/O worker thread if workers are enabled.
+
+        Waiting for a free worker can be cancelled always.  If `cancellable', the request can be cancelled while
+        the call is in progress too: the worker finishes it in the background and the result is dropped.
+        """
+
+        if self.io_limiter is None:
+            return func(*args)
+        return await trio.to_thread.run_sync(func, *args, limiter=self.io_limiter, cancellable=cancellable)
+
+    def _run_in_loop(self, func: Callable[..., T], *args) -> T:
+        """Run a call in the event loop thread."""
+
+        try:
+            trio.lowlevel.current_trio_token()
+        except RuntimeError:  # called from another thread, e.g., by the REST API server.
+            if self.trio_token is None:
+                raise RuntimeError("CharybdisFS event loop is not running") from None
+            return trio.from_thread.run_sync(func, *args, trio_token=self.trio_token)
+        return func(*args)
+
+    def get_faults_stats(self) -> Dict[FaultID, Dict[str, Any]]:
+        return self.faults.get_all_faults_stats()
+
+    def cancel_requests(self, min_age: float = 0) -> int:
+        """Cancel requests which are in flight for `min_age' seconds at least: return number of them."""
+
+        return self._run_in_loop(self.requests.cancel, min_age)
+
+    def start_profiler(self, mode: str = SAMPLING, interval: float = DEFAULT_PROFILER_INTERVAL) -> None:
+        # A deterministic profiler traces the thread which enabled it, so it's done in the event loop thread.
+        # All faulty methods share the code of the wrapper, which is used to attribute samples to syscalls.
+        self._run_in_loop(Profiler.start, mode, interval, type(self).access.__code__)
+
+    def stop_profiler(self) -> bytes:
+        return self._run_in_loop(Profiler.stop)
+
+    def crash(self) -> int:
+        """Simulate a power loss: discard all data which wasn't flushed yet and return number of lost pages."""
+
+        if self.page_cache is None:
+            raise ValueError("Page cache is not enabled")
+        return self.page_cache.crash()
 
     @faulty
     async def access(self, inode: INode, mode: FileMode, ctx: RequestContext) -> bool:
@@ -229,6 +757,12 @@ class CharybdisOperations(Operations):
                      ctx: RequestContext) -> Tuple[FileInfo, EntryAttributes]:
         path = self.paths.join(parent_inode, name)
         try:
+            if self.capacity is not None:
+                self.capacity.check_free()
+                try:  # remember the size of an existent file before it's truncated.
+                    self.capacity.get_size(inode=os.stat(path).st_ino, target=path)
+                except FileNotFoundError:
+                    pass
             fd = cast(FileDescriptor,
                       os.open(path=path, flags=flags | os.O_CREAT | os.O_TRUNC, mode=(mode & ~ctx.umask)))
             os.fchown(fd=fd, uid=ctx.uid, gid=ctx.gid)
@@ -236,41 +770,101 @@ class CharybdisOperations(Operations):
             raise FUSEError(exc.errno)
         entry_attrs = self._get_entry_attrs(target=fd)
         inode = entry_attrs.st_ino
+        self._truncated(inode=inode, target=fd)  # an existent file is truncated.
         self.paths[inode] = path
-        self.descriptors[inode] = fd
-        return FileInfo(fh=fd), entry_attrs
+        fh = self.descriptors.add(inode=inode, fd=fd, flags=flags, caller=Caller(pid=ctx.pid, uid=ctx.uid, gid=ctx.gid))
+        return self._file_info(fh=fh, flags=flags), entry_attrs
 
     async def forget(self, inode_list: INodeList) -> None:
-        for inode, nlookup in inode_list:
-            if self.paths.forget_inode_lookups(inode=inode, nlookup=nlookup) and inode in self.descriptors:
-                self.runtime_errors.forgot_inode_with_open_fd(inode=inode, fd=self.descriptors[inode])
+        if self.lazy_forget:
+            self.pending_forgets.extend(inode_list)
+            if len(self.pending_forgets) < MAX_PENDING_FORGETS:
+                return
+            inode_list = list(self.pending_forgets)
+            self.pending_forgets.clear()
+        for batch_start in range(0, len(inode_list), FORGET_BATCH_SIZE):
+            if batch_start:
+                await trio.sleep(0)  # let other requests go between batches.
+            self._forget_batch(inode_list=inode_list[batch_start:batch_start + FORGET_BATCH_SIZE])
+
+    def _forget_batch(self, inode_list: INodeList) -> None:
+        for inode in self.paths.forget_lookups(inode_list=inode_list):
+            if self.xattr_cache is not None:
+                self.xattr_cache.invalidate(inode=inode)  # the inode number can be reused by a new file.
+            if self.capacity is not None:
+                self.capacity.forget(inode=inode)
+            if (fd := self.descriptors.get_fd_by_inode(inode)) is not None:
+                self.runtime_errors.forgot_inode_with_open_fd(inode=inode, fd=fd)
+
+    async def reclaim_forgotten_inodes(self) -> None:
+        """Process forget requests deferred by `lazy_forget' in background.
+
+        One batch is processed per tick while there are requests in flight, and all pending ones when it's idle.
+        """
+
+        while True:
+            await trio.sleep(FORGET_RECLAIM_INTERVAL)
+            while self.pending_forgets:
+                self._forget_batch(inode_list=[self.pending_forgets.popleft()
+                                               for _ in range(min(FORGET_BATCH_SIZE, len(self.pending_forgets)))])
+                if self.requests.requests:  # busy: leave the rest to next ticks.
+                    break
+                await trio.sleep(0)
 
     @faulty
     async def flush(self, fh: FileHandle) -> None:
-        fd = cast(FileDescriptor, fh)
-        if fd not in self.descriptors.inodes:
-            self.runtime_errors.unknown_fd(fd=fd)
+        if fh not in self.descriptors:
+            self.runtime_errors.unknown_fh(fh=fh)
         try:
-            open(file=fd, mode="r+b", closefd=False).flush()  # not sure about which mode we should use here.
+            with self.descriptors.use(fh) as open_file:
+                # not sure about which mode we should use here.
+                await self._run_io(open(file=open_file.fd, mode="r+b", closefd=False).flush)
         except OSError as exc:
             raise FUSEError(exc.errno) from None
 
     @faulty
     async def fsync(self, fh: FileHandle, datasync: bool) -> None:
         try:
-            if datasync:
-                os.fdatasync(fh)
-            else:
-                os.fsync(fh)
+            with self.descriptors.use(fh) as open_file:
+                async def sync(datasync: bool) -> None:
+                    if self.page_cache is not None:
+                        await self._run_io(self.page_cache.flush, open_file.inode)
+                    await self._run_io(self._fsync, open_file.fd, datasync)
+
+                if self.fsync_coalescer is None:
+                    await sync(datasync)
+                else:
+                    await self.fsync_coalescer.fsync(inode=open_file.inode, datasync=datasync, sync=sync)
         except OSError as exc:
             raise FUSEError(exc.errno) from None
 
     @faulty
     async def fsyncdir(self, fh: FileHandle, datasync: bool) -> None:
-        return await self.fsync(fh=fh, datasync=datasync)
+        inode = cast(INode, fh)
+
+        async def sync(datasync: bool) -> None:
+            fd = os.open(self.paths[inode], os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                await self._run_io(self._fsync, cast(FileDescriptor, fd), datasync)
+            finally:
+                os.close(fd)
+
+        try:
+            if self.fsync_coalescer is None:
+                await sync(datasync)
+            else:
+                await self.fsync_coalescer.fsync(inode=inode, datasync=datasync, sync=sync)
+        except OSError as exc:
+            raise FUSEError(exc.errno) from None
 
     @staticmethod
-    def _get_entry_attrs(target: Union[str, FileDescriptor]) -> EntryAttributes:
+    def _fsync(fd: FileDescriptor, datasync: bool) -> None:
+        if datasync:
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+
+    def _get_entry_attrs(self, target: Union[str, FileDescriptor]) -> EntryAttributes:
         try:
             stat_result = os.lstat(target) if isinstance(target, str) else os.fstat(target)
         except OSError as exc:
@@ -281,20 +875,40 @@ class CharybdisOperations(Operations):
                 setattr(entry_attrs, attr, getattr(stat_result, attr))
         entry_attrs.attr_timeout = 0
         entry_attrs.entry_timeout = 0
+        if self.page_cache is not None and (size := self.page_cache.get_size(inode=entry_attrs.st_ino)) is not None:
+            entry_attrs.st_size = max(entry_attrs.st_size, size)
         return entry_attrs
 
     @faulty
     async def getattr(self, inode: INode, ctx: RequestContext) -> EntryAttributes:
-        if (target := self.descriptors.get(inode)) is None:
+        if (target := self.descriptors.get_fd_by_inode(inode)) is None:
             target = self.paths[inode]
         return self._get_entry_attrs(target=target)
 
     @faulty
     async def getxattr(self, inode: INode, name: bytes, ctx: RequestContext) -> bytes:
+        attribute = _bytes2str(name)
+        if self.xattr_cache is not None and (value := self.xattr_cache.get(inode=inode, name=attribute)) is not None:
+            if value is NO_ATTRIBUTE:
+                raise FUSEError(errno.ENODATA)
+            return value
+        target, follow_symlinks = self._get_xattr_target(inode=inode)
         try:
-            return pyfuse3.getxattr(path=self.paths[inode], name=_bytes2str(name))
+            value = os.getxattr(target, attribute, **follow_symlinks)
         except OSError as exc:
+            if exc.errno == errno.ENODATA and self.xattr_cache is not None:
+                self.xattr_cache.put(inode=inode, name=attribute, value=NO_ATTRIBUTE)
             raise FUSEError(exc.errno) from None
+        if self.xattr_cache is not None:
+            self.xattr_cache.put(inode=inode, name=attribute, value=value)
+        return value
+
+    def _get_xattr_target(self, inode: INode) -> Tuple[Union[FileDescriptor, str], Dict[str, bool]]:
+        """Prefer an open file descriptor to save a path walk in the backing FS."""
+
+        if (fd := self.descriptors.get_fd_by_inode(inode)) is not None:
+            return fd, {}
+        return self.paths[inode], {"follow_symlinks": False, }
 
     @faulty
     async def link(self,
@@ -312,10 +926,16 @@ class CharybdisOperations(Operations):
 
     @faulty
     async def listxattr(self, inode: INode, ctx: RequestContext) -> Sequence[bytes]:
+        if self.xattr_cache is not None and (names := self.xattr_cache.get_names(inode=inode)) is not None:
+            return names
+        target, follow_symlinks = self._get_xattr_target(inode=inode)
         try:
-            return [_str2bytes(attr) for attr in os.listxattr(path=self.paths[inode], follow_symlinks=False)]
+            names = [_str2bytes(attr) for attr in os.listxattr(target, **follow_symlinks)]
         except OSError as exc:
             raise FUSEError(exc.errno) from None
+        if self.xattr_cache is not None:
+            self.xattr_cache.put_names(inode=inode, names=names)
+        return names
 
     @faulty
     async def lookup(self, parent_inode: INode, name: bytes, ctx: RequestContext) -> EntryAttributes:
@@ -360,18 +980,36 @@ class CharybdisOperations(Operations):
 
     @faulty
     async def open(self, inode: INode, flags: int, ctx: RequestContext) -> FileInfo:
-        if (fd := self.descriptors.acquire_by_inode(inode)) is None:
-            if flags & os.O_CREAT:
-                raise FUSEError(errno.EINVAL)
-            try:
-                fd = cast(FileDescriptor, os.open(self.paths[inode], flags))
-            except OSError as exc:
-                raise FUSEError(exc.errno) from None
-            try:
-                self.descriptors[inode] = fd
-            except ValueError:
-                self.runtime_errors.try_to_replace_fd_for_inode(inode=inode, old_fd=self.descriptors[inode], new_fd=fd)
-        return FileInfo(fh=fd)
+        if flags & os.O_CREAT:
+            raise FUSEError(errno.EINVAL)
+        path = self.paths[inode]
+        try:
+            if flags & os.O_TRUNC and self.capacity is not None:
+                self.capacity.get_size(inode=inode, target=path)  # remember the size before it's truncated.
+            fd = cast(FileDescriptor, os.open(path, flags))
+        except OSError as exc:
+            raise FUSEError(exc.errno) from None
+        if flags & os.O_TRUNC:  # the kernel passes O_TRUNC to open() with atomic_o_trunc instead of setattr().
+            self._truncated(inode=inode, target=fd)
+        fh = self.descriptors.add(inode=inode, fd=fd, flags=flags, caller=Caller(pid=ctx.pid, uid=ctx.uid, gid=ctx.gid))
+        return self._file_info(fh=fh, flags=flags)
+
+    def _truncated(self, inode: INode, target: FileDescriptor) -> None:
+        """Drop cached data of a file truncated by open(O_TRUNC)."""
+
+        if self.capacity is not None:
+            self.capacity.resize(inode=inode, target=target, size=0)
+        if self.page_cache is not None:
+            self.page_cache.truncate(inode=inode, length=0)
+        if self.block_cache is not None:
+            self.block_cache.invalidate(inode=inode)
+        if self.xattr_cache is not None:  # a truncate drops security.capability.
+            self.xattr_cache.invalidate(inode=inode)
+
+    @staticmethod
+    def _file_info(fh: FileHandle, flags: int) -> FileInfo:
+        # Keep page cache bypassing in the kernel for O_DIRECT opens.
+        return FileInfo(fh=fh, direct_io=bool(flags & os.O_DIRECT))
 
     @faulty
     async def opendir(self, inode: INode, ctx: RequestContext) -> FileHandle:
@@ -380,11 +1018,27 @@ class CharybdisOperations(Operations):
     @faulty
     async def read(self, fh: FileHandle, off: int, size: int) -> bytes:
         try:
-            os.lseek(fh, off, os.SEEK_SET)
-            return os.read(fh, size)
+            with self.descriptors.use(fh) as open_file:
+                return await self._run_io(self._read, fh, open_file, off, size, cancellable=True)
         except OSError as exc:
             raise FUSEError(exc.errno) from None
 
+    def _read(self, fh: FileHandle, open_file: OpenFile, off: int, size: int) -> bytes:
+        with self.descriptors.pin(open_file) as fd:
+            if open_file.flags & os.O_DIRECT:
+                if self.page_cache is not None:
+                    self.page_cache.flush(inode=open_file.inode)
+                return self.direct_io_buffers.read(fd=fd, off=off, size=size)
+            if self.block_cache is not None:
+                data = self.block_cache.read(inode=open_file.inode, fh=fh, fd=fd, off=off, size=size)
+            else:
+                data = os.pread(fd, size, off)
+        if self.block_cache is not None and open_file.closing:  # the request is cancelled and the file released.
+            self.block_cache.release(fh=fh)
+        if self.page_cache is not None:
+            data = self.page_cache.read(inode=open_file.inode, off=off, size=size, data=data)
+        return data
+
     @faulty
     async def readdir(self, inode: INode, start_id: int, token: ReaddirToken) -> None:
         dir_path = self.paths[inode]
@@ -407,11 +1061,17 @@ class CharybdisOperations(Operations):
 
     @faulty
     async def release(self, fh: FileHandle) -> None:
-        if self.descriptors.release(cast(FileDescriptor, fh)):
-            try:
-                os.close(fh)
-            except OSError as exc:
-                raise FUSEError(exc.errno)
+        open_file = self.descriptors.release(fh)
+        if self.capacity is not None and open_file.inode not in self.descriptors.inodes:
+            self.capacity.close(inode=open_file.inode)
+        try:
+            self.descriptors.close(open_file)
+        except OSError as exc:
+            raise FUSEError(exc.errno)
+        finally:  # after the fd is closed: a worker which still reads the file drops own read-ahead state.
+            if self.block_cache is not None:
+                self.block_cache.invalidate(inode=open_file.inode)
+                self.block_cache.release(fh=fh)
 
     @faulty
     async def releasedir(self, fh: FileHandle) -> None:
@@ -419,8 +1079,11 @@ class CharybdisOperations(Operations):
 
     @faulty
     async def removexattr(self, inode: INode, name: bytes, ctx: RequestContext) -> None:
+        if self.xattr_cache is not None:
+            self.xattr_cache.invalidate(inode=inode)
+        target, follow_symlinks = self._get_xattr_target(inode=inode)
         try:
-            os.removexattr(path=self.paths[inode], attribute=name, follow_symlinks=False)
+            os.removexattr(target, name, **follow_symlinks)
         except OSError as exc:
             raise FUSEError(exc.errno) from None
 
@@ -437,16 +1100,19 @@ class CharybdisOperations(Operations):
 
         old_path = self.paths.join(parent_inode_old, name_old)
         new_path = self.paths.join(parent_inode_new, name_new)
+        replaced = None
         try:
+            if self.capacity is not None:
+                with suppress(FileNotFoundError):
+                    replaced = os.lstat(new_path)
             os.rename(src=old_path, dst=new_path)
             inode = cast(INode, os.lstat(new_path).st_ino)
         except OSError as exc:
             raise FUSEError(exc.errno)
 
-        try:
-            self.paths.replace_path(inode=inode, old_path=old_path, new_path=new_path)
-        except KeyError:
-            self.runtime_errors.unknown_path(inode=inode, path=old_path)
+        if replaced is not None and replaced.st_ino != inode:
+            self._account_unlink(inode=cast(INode, replaced.st_ino), stat_result=replaced)
+        self.paths.replace_path(inode=inode, old_path=old_path, new_path=new_path)
 
     @faulty
     async def rmdir(self, parent_inode, name: bytes, ctx: RequestContext) -> None:
@@ -456,10 +1122,7 @@ class CharybdisOperations(Operations):
             os.rmdir(path)
         except OSError as exc:
             raise FUSEError(exc.errno) from None
-        try:
-            self.paths.forget_path(inode=inode, path=path)
-        except KeyError:
-            self.runtime_errors.unknown_path(inode=inode, path=path)
+        self.paths.forget_path(inode=inode, path=path)
 
     @faulty
     async def setattr(self,  # noqa: C901  # ignore "is too complex" message
@@ -472,11 +1135,18 @@ class CharybdisOperations(Operations):
             target = self.paths[inode]
             follow_symlinks = {"follow_symlinks": False, }
         else:
-            target = fh
+            try:
+                target = self.descriptors.get_fd(fh)
+            except OSError as exc:
+                raise FUSEError(exc.errno) from None
             follow_symlinks = {}
+        # Changes of the mode, owner and size drop security.capability, and the mode changes the POSIX ACL.
+        if self.xattr_cache is not None and (fields.update_mode or fields.update_uid or fields.update_gid
+                                             or fields.update_size):
+            self.xattr_cache.invalidate(inode=inode)
         try:
             if fields.update_size:
-                os.truncate(path=target, length=attr.st_size)
+                self._truncate(inode=inode, target=target, length=attr.st_size)
 
             if fields.update_mode:
                 if stat.S_ISLNK(attr.st_mode):
@@ -507,10 +1177,30 @@ class CharybdisOperations(Operations):
             raise FUSEError(exc.errno) from None
         return await self.getattr(inode=inode, ctx=ctx)
 
+    def _truncate(self, inode: INode, target: Union[FileDescriptor, str], length: int) -> None:
+        if self.capacity is None:
+            size = None
+        else:  # space is reserved before the truncate, so a growth can't overcommit.
+            size = self.capacity.get_size(inode=inode, target=target)
+            self.capacity.resize(inode=inode, target=target, size=length)
+        try:
+            if self.page_cache is not None:
+                self.page_cache.truncate(inode=inode, length=length)
+            if self.block_cache is not None:
+                self.block_cache.invalidate(inode=inode)
+            os.truncate(path=target, length=length)
+        except OSError:
+            if size is not None:
+                self.capacity.rollback(inode=inode, end=length, size=size)
+            raise
+
     @faulty
     async def setxattr(self, inode: INode, name: bytes, value: bytes, ctx: RequestContext) -> None:
+        if self.xattr_cache is not None:
+            self.xattr_cache.invalidate(inode=inode)
+        target, follow_symlinks = self._get_xattr_target(inode=inode)
         try:
-            pyfuse3.setxattr(path=self.paths[inode], name=_bytes2str(name), value=value)
+            os.setxattr(target, _bytes2str(name), value, **follow_symlinks)
         except OSError as exc:
             raise FUSEError(exc.errno) from None
 
@@ -524,6 +1214,10 @@ class CharybdisOperations(Operations):
         for field in STATVFS_DATA_FIELDS:
             setattr(statvfs_data, field, getattr(statvfs_result, field))
         statvfs_data.f_namemax -= self.paths.path_prefix_len
+        if self.capacity is not None:
+            statvfs_data.f_blocks = self.capacity.capacity // statvfs_data.f_frsize
+            statvfs_data.f_bfree = min(statvfs_data.f_bfree, self.capacity.free // statvfs_data.f_frsize)
+            statvfs_data.f_bavail = min(statvfs_data.f_bavail, statvfs_data.f_bfree)
         return statvfs_data
 
     @faulty
@@ -541,23 +1235,55 @@ class CharybdisOperations(Operations):
     @faulty
     async def write(self, fh: FileHandle, off: int, buf: bytes) -> int:
         try:
-            os.lseek(fh, off, os.SEEK_SET)
-            return os.write(fh, buf)
+            with self.descriptors.use(fh) as open_file:
+                if not open_file.written:
+                    open_file.written = True
+                    if self.xattr_cache is not None:  # the first write drops security.capability.
+                        self.xattr_cache.invalidate(inode=open_file.inode)
+                if self.capacity is None:
+                    return await self._run_io(self._write, open_file, off, buf)
+                # Reserve space before the write, so concurrent writes in I/O workers can't overcommit.
+                start = off
+                if open_file.flags & os.O_APPEND:
+                    start = self.capacity.get_size(inode=open_file.inode, target=open_file.fd)
+                size = self.capacity.extend(inode=open_file.inode, target=open_file.fd, end=start + len(buf))
+                written = 0
+                try:
+                    written = await self._run_io(self._write, open_file, off, buf)
+                    return written
+                finally:  # release space reserved for data which isn't written.
+                    self.capacity.rollback(inode=open_file.inode, end=start + len(buf), size=max(size, start + written))
         except OSError as exc:
             raise FUSEError(exc.errno) from None
 
+    def _write(self, open_file: OpenFile, off: int, buf: bytes) -> int:
+        try:
+            if open_file.flags & os.O_DIRECT:
+                if self.page_cache is not None:
+                    self.page_cache.flush(inode=open_file.inode)
+                return self.direct_io_buffers.write(fd=open_file.fd, off=off, data=buf)
+            if self.page_cache is not None:
+                return self.page_cache.write(inode=open_file.inode, fd=open_file.fd, off=off, buf=buf)
+            return os.pwrite(open_file.fd, buf, off)
+        finally:  # a read in another I/O worker could cache old data while the write is in progress.
+            if self.block_cache is not None:
+                self.block_cache.invalidate(inode=open_file.inode)
+
     @faulty
     async def unlink(self, parent_inode: INode, name: bytes, ctx: RequestContext) -> None:
         path = self.paths.join(parent_inode, name)
         try:
-            inode = cast(INode, os.lstat(path).st_ino)
+            stat_result = os.lstat(path)
             os.unlink(path)
         except OSError as exc:
             raise FUSEError(exc.errno) from None
-        try:
-            self.paths.forget_path(inode=inode, path=path)
-        except KeyError:
-            self.runtime_errors.unknown_path(inode=inode, path=path)
+        inode = cast(INode, stat_result.st_ino)
+        self.paths.forget_path(inode=inode, path=path)
+        self._account_unlink(inode=inode, stat_result=stat_result)
+
+    def _account_unlink(self, inode: INode, stat_result: os.stat_result) -> None:
+        if self.capacity is not None:
+            self.capacity.unlink(inode=inode, stat_result=stat_result, is_open=inode in self.descriptors.inodes)
 
 
 def _str2bytes(val: str, /) -> bytes:
@@ -0,0 +1,281 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import os
+import sys
+import fcntl
+import logging
+import threading
+from typing import TYPE_CHECKING, Dict, Tuple, Set, List, Optional, Callable, Union
+from collections import OrderedDict
+
+if TYPE_CHECKING:
+    from core.operations import INode, FileDescriptor
+
+
+DEFAULT_PAGE_SIZE = 4096
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Page:
+    """A page of written data with a single contiguous dirty range [start, end)."""
+
+    __slots__ = ("data", "start", "end", )
+
+    def __init__(self, size: int):
+        self.data = bytearray(size)
+        self.start = self.end = 0
+
+    def update(self, start: int, buf: Union[bytes, memoryview]) -> bool:
+        """Return False if the new range can't be merged with the dirty one."""
+
+        end = start + len(buf)
+        if self.end and (start > self.end or end < self.start):
+            return False
+        self.data[start:end] = buf
+        if self.end:
+            self.start, self.end = min(self.start, start), max(self.end, end)
+        else:
+            self.start, self.end = start, end
+        return True
+
+
+class PageCache:
+    """Write-back cache which keeps written data in memory until it flushed to the backing store.
+
+    Dirty pages are lost on `crash()' the same way as data which wasn't fsync'ed is lost on a power failure.
+
+    Pages stay dirty if `flush()' fails to write them, so it can be retried.  Pages written back on eviction are
+    dropped on a failure like the kernel does, and the error is reported by the next `flush()' of the inode.
+    """
+
+    def __init__(self, max_pages: int, page_size: int = DEFAULT_PAGE_SIZE):
+        assert max_pages > 0, "Page cache should have room for one page at least"
+
+        self.max_pages = max_pages
+        self.page_size = page_size
+        self.pages: OrderedDict[Tuple[INode, int], Page] = OrderedDict()  # in LRU order
+        self.inode_pages: Dict[INode, Set[int]] = {}
+        self.sizes: Dict[INode, int] = {}
+        self.fds: Dict[INode, FileDescriptor] = {}  # own backing fds to flush after release
+        self.errors: Dict[INode, OSError] = {}  # write-back errors of evicted pages
+        self.lock = threading.RLock()
+        self.on_flush: Optional[Callable[[INode], None]] = None
+
+        self.flushed_pages = 0
+        self.backing_writes = 0
+        self.evicted_pages = 0
+        self.discarded_pages = 0
+
+    def write(self, inode: INode, fd: FileDescriptor, off: int, buf: bytes) -> int:
+        with self.lock:
+            view = memoryview(buf)
+            pos, end = off, off + len(buf)
+            while pos < end:
+                index, page_off = divmod(pos, self.page_size)
+                chunk = min(self.page_size - page_off, end - pos)
+                data = view[pos - off:pos - off + chunk]
+                if (page := self.pages.get((inode, index))) is not None:
+                    if page.update(start=page_off, buf=data):
+                        self.pages.move_to_end((inode, index))
+                    else:  # non-adjacent write to a dirty page: flush it first.
+                        self._evict(inode=inode, indexes=[index])
+                        page = None
+                if page is None:
+                    if inode not in self.inode_pages:
+                        self.fds[inode] = self._open_writer(fd=fd)
+                        self.sizes[inode] = os.fstat(fd).st_size
+                        self.inode_pages[inode] = set()
+                    page = self.pages[(inode, index)] = Page(size=self.page_size)
+                    page.update(start=page_off, buf=data)
+                    self.inode_pages[inode].add(index)
+                pos += chunk
+            self.sizes[inode] = max(self.sizes[inode], end)
+            self._shrink()
+        return len(buf)
+
+    def read(self, inode: INode, off: int, size: int, data: bytes) -> bytes:
+        """Overlay dirty pages on data read from the backing store."""
+
+        with self.lock:
+            if not (indexes := self.inode_pages.get(inode)):
+                return data
+            end = min(off + size, self.sizes[inode])
+            if end <= off:
+                return data
+            buf = bytearray(data)
+            if len(buf) < end - off:
+                buf.extend(bytes(end - off - len(buf)))
+            for index in range(off // self.page_size, (end - 1) // self.page_size + 1):
+                if index not in indexes:
+                    continue
+                page = self.pages[(inode, index)]
+                page_off = index * self.page_size
+                start, stop = max(page_off + page.start, off), min(page_off + page.end, end)
+                if start < stop:
+                    buf[start - off:stop - off] = page.data[start - page_off:stop - page_off]
+            return bytes(buf)
+
+    def get_size(self, inode: INode) -> Optional[int]:
+        with self.lock:
+            return self.sizes.get(inode)
+
+    def truncate(self, inode: INode, length: int) -> None:
+        with self.lock:
+            if (indexes := self.inode_pages.get(inode)) is None:
+                return
+            for index in [index for index in indexes if (index + 1) * self.page_size > length]:
+                page = self.pages[(inode, index)]
+                page.end = min(page.end, length - index * self.page_size)
+                if page.end <= page.start:
+                    del self.pages[(inode, index)]
+                    indexes.discard(index)
+            self.sizes[inode] = length
+            if not indexes:
+                self._forget_inode(inode=inode)
+
+    def flush(self, inode: INode) -> None:
+        with self.lock:
+            if (indexes := self.inode_pages.get(inode)) is not None:
+                self._write_back(inode=inode, indexes=sorted(indexes))
+            if (error := self.errors.pop(inode, None)) is not None:
+                raise OSError(error.errno, error.strerror)
+
+    def flush_all(self) -> None:
+        with self.lock:
+            for inode in list(self.inode_pages):
+                try:
+                    self.flush(inode=inode)
+                except OSError as exc:
+                    LOGGER.error("Unable to flush dirty pages of inode=%s: %s", inode, exc)
+
+    def crash(self) -> int:
+        """Discard all dirty pages and return number of lost pages."""
+
+        with self.lock:
+            discarded_pages = len(self.pages)
+            sys.audit("charybdisfs.crash", discarded_pages)
+            self.pages.clear()
+            self.errors.clear()
+            for inode in list(self.inode_pages):
+                self._forget_inode(inode=inode)
+            self.discarded_pages += discarded_pages
+        return discarded_pages
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "dirty_pages": len(self.pages),
+                "dirty_inodes": len(self.inode_pages),
+                "flushed_pages": self.flushed_pages,
+                "backing_writes": self.backing_writes,
+                "evicted_pages": self.evicted_pages,
+                "discarded_pages": self.discarded_pages,
+            }
+
+    def _shrink(self) -> None:
+        while len(self.pages) > self.max_pages:
+            inode, index = next(iter(self.pages))
+            self.evicted_pages += 1
+            self._evict(inode=inode, indexes=[index])
+
+    def _evict(self, inode: INode, indexes: List[int]) -> None:
+        try:
+            self._write_back(inode=inode, indexes=indexes)
+        except OSError as exc:
+            LOGGER.warning("Unable to write back evicted pages of inode=%s: %s", inode, exc)
+            self.errors[inode] = exc
+            inode_pages = self.inode_pages[inode]
+            for index in indexes:
+                if index in inode_pages:
+                    del self.pages[(inode, index)]
+                    inode_pages.discard(index)
+                    self.discarded_pages += 1
+            if not inode_pages:
+                self._forget_inode(inode=inode)
+
+    def _write_back(self, inode: INode, indexes: List[int]) -> None:
+        """Write pages to the backing store coalescing adjacent pages into one call.
+
+        Pages are removed from the cache only when they are written.
+        """
+
+        batch: List[memoryview] = []
+        batch_indexes: List[int] = []
+        batch_off = batch_end = 0
+        try:
+            for index in indexes:
+                page = self.pages[(inode, index)]
+                page_off = index * self.page_size
+                if batch and (batch_end != page_off + page.start):
+                    self._write_batch(inode=inode, indexes=batch_indexes, buffers=batch, off=batch_off)
+                    batch, batch_indexes = [], []
+                if not batch:
+                    batch_off = page_off + page.start
+                batch.append(memoryview(page.data)[page.start:page.end])
+                batch_indexes.append(index)
+                batch_end = page_off + page.end
+            if batch:
+                self._write_batch(inode=inode, indexes=batch_indexes, buffers=batch, off=batch_off)
+        finally:
+            if not self.inode_pages[inode]:
+                self._forget_inode(inode=inode)
+            if self.on_flush is not None:  # a failed write could change the backing store partially.
+                self.on_flush(inode)
+
+    def _write_batch(self, inode: INode, indexes: List[int], buffers: List[memoryview], off: int) -> None:
+        self._pwritev(fd=self.fds[inode], buffers=buffers, off=off)
+        inode_pages = self.inode_pages[inode]
+        for index in indexes:
+            del self.pages[(inode, index)]
+            inode_pages.discard(index)
+        self.flushed_pages += len(indexes)
+
+    def _pwritev(self, fd: FileDescriptor, buffers: List[memoryview], off: int) -> None:
+        self.backing_writes += 1
+        size = sum(len(buf) for buf in buffers)
+        while size:
+            written = os.pwritev(fd, buffers, off)
+            size -= written
+            off += written
+            while buffers and written >= len(buffers[0]):
+                written -= len(buffers.pop(0))
+            if written:
+                buffers[0] = buffers[0][written:]
+
+    @staticmethod
+    def _open_writer(fd: FileDescriptor) -> FileDescriptor:
+        """Return an own fd to write pages back by offsets.
+
+        A duplicate shares the file status flags with the original fd, so O_APPEND of a writer's fd would make
+        all pwritev() calls append.  Such files are reopened by the procfs link, which works for unlinked files too.
+        """
+
+        if not fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_APPEND:
+            return os.dup(fd)
+        return os.open(f"/proc/self/fd/{fd}", os.O_WRONLY | os.O_CLOEXEC)
+
+    def _forget_inode(self, inode: INode) -> None:
+        del self.inode_pages[inode]
+        del self.sizes[inode]
+        try:
+            os.close(self.fds.pop(inode))
+        except OSError as exc:
+            LOGGER.warning("Unable to close page cache fd for inode=%s: %s", inode, exc)
+
+
+__all__ = ("PageCache", "DEFAULT_PAGE_SIZE", )
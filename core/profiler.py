@@ -0,0 +1,162 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""On-demand profiling of a running CharybdisFS process.
+
+Two modes are supported:
+
+    sampling       stacks of all threads are sampled every `interval' seconds by a background thread.  Samples of
+                   the event loop thread taken while a FUSE request is served are attributed to its syscall.
+                   The result is in the collapsed stack format of flame graph tools: `root;frame;...;frame count'
+    deterministic  cProfile of the thread which started it (i.e., the event loop thread.)  The result is a marshaled
+                   pstats dump which can be loaded by `pstats.Stats' or snakeviz.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import time
+import marshal
+import logging
+import cProfile
+import threading
+from types import CodeType, FrameType
+from typing import Counter, Dict, List, Optional, Tuple, Union
+from collections import Counter as CounterType
+
+from core.faults import SysCall
+
+
+SAMPLING = "sampling"
+DETERMINISTIC = "deterministic"
+MODES = (SAMPLING, DETERMINISTIC, )
+
+DEFAULT_INTERVAL = 0.005  # seconds
+MAX_DURATION = 300  # seconds
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SamplingProfile:
+    def __init__(self, interval: float = DEFAULT_INTERVAL, dispatch_code: Optional[CodeType] = None):
+        if interval <= 0:
+            raise ValueError(f"Sampling interval should be positive: {interval}")
+        self.interval = interval
+        self.dispatch_code = dispatch_code  # frames of this code serve FUSE requests and have `sys_call' local.
+        self.samples: Counter[Tuple[str, ...]] = CounterType()
+        self.started = 0.0
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self._frame_names: Dict[CodeType, str] = {}
+
+    def start(self) -> None:
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name="charybdisfs-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> bytes:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        LOGGER.info("Sampling profile collected: %s samples in %.1fs",
+                    sum(self.samples.values()), time.monotonic() - self.started)
+        return self.get_collapsed().encode()
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self) -> None:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own_ident = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident != own_ident:
+                self.samples[self._get_stack(frame=frame, root=thread_names.get(ident, str(ident)))] += 1
+
+    def _get_stack(self, frame: Optional[FrameType], root: str) -> Tuple[str, ...]:
+        stack: List[str] = []
+        while frame is not None:
+            code = frame.f_code
+            if code is self.dispatch_code and isinstance(sys_call := frame.f_locals.get("sys_call"), SysCall):
+                root = sys_call.value  # the innermost request wins, but there is only one per stack in fact.
+            if (name := self._frame_names.get(code)) is None:
+                name = self._frame_names[code] = \
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            stack.append(name)
+            frame = frame.f_back
+        stack.append(root)
+        stack.reverse()
+        return tuple(stack)
+
+    def get_collapsed(self) -> str:
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.samples.most_common())
+
+
+class DeterministicProfile:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self) -> None:
+        self.profile.enable()
+
+    def stop(self) -> bytes:
+        """Should be called from the same thread as start()."""
+
+        self.profile.disable()
+        self.profile.create_stats()
+        return marshal.dumps(self.profile.stats)  # the format of pstats.Stats.dump_stats()
+
+
+class Profiler:
+    """Profiler of this process: only one profile can be collected at a time."""
+
+    lock = threading.Lock()
+    profile: Union[SamplingProfile, DeterministicProfile, None] = None
+    mode: Optional[str] = None
+
+    @classmethod
+    def start(cls,
+              mode: str = SAMPLING,
+              interval: float = DEFAULT_INTERVAL,
+              dispatch_code: Optional[CodeType] = None) -> None:
+        sys.audit("charybdisfs.profiler", "start", mode)
+
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiler mode {mode!r}, should be one of {MODES}")
+        with cls.lock:
+            if cls.profile is not None:
+                raise RuntimeError(f"Profiler is running already in {cls.mode} mode")
+            if mode == SAMPLING:
+                profile = SamplingProfile(interval=interval, dispatch_code=dispatch_code)
+            else:
+                profile = DeterministicProfile()
+            profile.start()
+            cls.profile, cls.mode = profile, mode
+
+    @classmethod
+    def stop(cls) -> bytes:
+        """Stop the profiler and return the result: collapsed stacks or a pstats dump depends on the mode."""
+
+        sys.audit("charybdisfs.profiler", "stop", cls.mode)
+
+        with cls.lock:
+            if (profile := cls.profile) is None:
+                raise RuntimeError("Profiler is not running")
+            cls.profile = cls.mode = None
+        return profile.stop()
+
+
+__all__ = ("Profiler", "SamplingProfile", "DeterministicProfile",
+           "MODES", "SAMPLING", "DETERMINISTIC", "DEFAULT_INTERVAL", "MAX_DURATION", )
@@ -0,0 +1,183 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import os
+import sys
+import stat
+import socket
+import logging
+import threading
+from typing import TYPE_CHECKING, Optional, Sequence, List, Tuple, Dict, Any
+
+import trio
+from pyfuse3 import ROOT_INODE
+
+if TYPE_CHECKING:
+    from core.operations import CharybdisOperations
+
+
+DEFAULT_WARM_UP_CONCURRENCY = 8  # directories scanned simultaneously
+
+LOGGER = logging.getLogger(__name__)
+
+
+class WarmUp:
+    """Walk subtrees of the source directory before the first request.
+
+    It warms the dentry and inode caches of the backing FS and asks the kernel to read data of regular files into
+    the page cache (if `prefetch_data'.)  Inodes are left to the kernel's lookups: a record without a lookup saves
+    nothing, since `lookup' stats the entry anyway.
+    """
+
+    def __init__(self,
+                 operations: CharybdisOperations,
+                 subtrees: Sequence[str],
+                 concurrency: int = DEFAULT_WARM_UP_CONCURRENCY,
+                 prefetch_data: bool = True):
+        self.operations = operations
+        root = operations.paths[ROOT_INODE]
+        self.subtrees = []
+        for subtree in subtrees:
+            path = os.path.normpath(os.path.join(root, subtree))
+            if os.path.commonpath((root, path)) != root:
+                raise ValueError(f"Warm-up subtree {subtree} is out of the source directory")
+            self.subtrees.append(path)
+        self.limiter = trio.CapacityLimiter(concurrency)
+        self.prefetch_data = prefetch_data
+
+        self.done = False
+        self.directories = 0
+        self.entries = 0
+        self.prefetched_bytes = 0
+        self.errors = 0
+
+    async def run(self) -> None:
+        LOGGER.info("Warm-up of %s started", self.subtrees)
+        async with trio.open_nursery() as nursery:
+            for path in self.subtrees:
+                nursery.start_soon(self._walk, path, nursery)
+        self.done = True
+        LOGGER.info("Warm-up finished: %s", self.get_stats())
+
+    async def _walk(self, path: str, nursery: trio.Nursery) -> None:
+        entries, prefetched_bytes, errors = await trio.to_thread.run_sync(self._scan, path, limiter=self.limiter)
+        self.directories += 1
+        self.entries += len(entries)
+        self.prefetched_bytes += prefetched_bytes
+        self.errors += errors
+        for entry_path, is_dir in entries:
+            if is_dir:
+                nursery.start_soon(self._walk, entry_path, nursery)
+
+    def _scan(self, path: str) -> Tuple[List[Tuple[str, bool]], int, int]:
+        """Stat all entries of a directory in a worker thread: return entries, prefetched bytes and errors."""
+
+        entries = []
+        prefetched_bytes = errors = 0
+        try:
+            with os.scandir(path) as dir_entries:
+                for entry in dir_entries:
+                    try:
+                        stat_result = entry.stat(follow_symlinks=False)
+                        if self.prefetch_data and stat.S_ISREG(stat_result.st_mode) and stat_result.st_size:
+                            _prefetch(path=entry.path)
+                            prefetched_bytes += stat_result.st_size
+                    except OSError as exc:
+                        LOGGER.debug("Unable to warm up %s: %s", entry.path, exc)
+                        errors += 1
+                        continue
+                    entries.append((entry.path, stat.S_ISDIR(stat_result.st_mode)))
+        except OSError as exc:
+            LOGGER.warning("Unable to warm up %s: %s", path, exc)
+            errors += 1
+        return entries, prefetched_bytes, errors
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "done": self.done,
+            "directories": self.directories,
+            "entries": self.entries,
+            "prefetched_bytes": self.prefetched_bytes,
+            "errors": self.errors,
+        }
+
+
+def _prefetch(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+class Readiness:
+    """Global readiness state of the mount: set once when the mount is able to serve requests."""
+
+    ready = threading.Event()
+    ready_fd: Optional[int] = None  # a pipe to write "READY\n" to and close
+    warm_up: Optional[WarmUp] = None
+    notify_supervisor = True  # False in child processes: only the main process reports readiness of the daemon
+
+    @classmethod
+    async def become_ready(cls) -> None:
+        """Wait for the warm-up if it's configured and notify about readiness."""
+
+        if cls.warm_up is not None:
+            await cls.warm_up.run()
+        cls.set_ready()
+
+    @classmethod
+    def set_ready(cls) -> None:
+        sys.audit("charybdisfs.ready")
+
+        cls.ready.set()
+        if not cls.notify_supervisor:
+            LOGGER.info("CharybdisFS mount is ready")
+            return
+        if cls.ready_fd is not None:
+            try:
+                os.write(cls.ready_fd, b"READY\n")
+                os.close(cls.ready_fd)
+            except OSError as exc:
+                LOGGER.error("Unable to notify about readiness using fd=%s: %s", cls.ready_fd, exc)
+            cls.ready_fd = None
+        sd_notify(state=b"READY=1")
+        LOGGER.info("CharybdisFS is ready")
+
+    @classmethod
+    def get_status(cls) -> Dict[str, Any]:
+        status: Dict[str, Any] = {"ready": cls.ready.is_set()}
+        if cls.warm_up is not None:
+            status["warm_up"] = cls.warm_up.get_stats()
+        return status
+
+
+def sd_notify(state: bytes) -> None:
+    """Send a notification to systemd if the process is started by it with Type=notify."""
+
+    if not (address := os.environ.get("NOTIFY_SOCKET")):
+        return
+    if address.startswith("@"):  # abstract namespace socket
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state)
+    except OSError as exc:
+        LOGGER.error("Unable to send %r to systemd: %s", state, exc)
+
+
+__all__ = ("Readiness", "WarmUp", "DEFAULT_WARM_UP_CONCURRENCY", )
@@ -12,22 +12,42 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import annotations
+
 import sys
+import json
+import time
 import logging
-from typing import Optional
+from typing import TYPE_CHECKING, Optional, Union
 
 import cherrypy
 
 from core.faults import create_fault_from_dict
-from core.configuration import Configuration, FaultID, generate_fault_id
+from core.constants import DEFAULT_PORT
+from core.events import EventStream, DEFAULT_QUEUE_SIZE, DEFAULT_BATCH_SIZE
+from core.mounts import MountRegistry, MountProcess
+from core.readiness import Readiness
+from core.scenarios import Scenarios, Scenario, ScenarioID, generate_scenario_id
+from core.profiler import SAMPLING, DETERMINISTIC, DEFAULT_INTERVAL as DEFAULT_PROFILER_INTERVAL, MAX_DURATION
+from core.configuration import Configuration, FaultID, MountID, generate_fault_id
+
+if TYPE_CHECKING:
+    from core.operations import CharybdisOperations
+
 
+EVENTS_HEARTBEAT = 1  # seconds, an empty batch sent if there were no events
+THREAD_POOL_SIZE = 10
 
-DEFAULT_PORT = 8080
+# Each events stream holds a server thread, so most of the threads are left for other requests.
+MAX_EVENTS_SUBSCRIBERS = 4
 
 LOGGER = logging.getLogger(__name__)
 
 
 class CharybdisFsApiServer:
+    def __init__(self, operations: Optional[CharybdisOperations] = None):
+        self.operations = operations
+
     @cherrypy.expose
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
@@ -40,7 +60,7 @@ class CharybdisFsApiServer:
             if fault_id is None:
                 return {"faults_ids": Configuration.get_all_faults_ids()}
             if fault := Configuration.get_fault_by_uuid(fault_id=fault_id):
-                return {"fault_id": fault_id, "fault": fault.to_dict()}
+                return {"fault_id": fault_id, "fault": fault.to_dict(), "mount_id": Configuration.get_mount_id(fault_id)}
             raise cherrypy.NotFound()
 
         elif method in ("POST", "CREATE", "PUT",):
@@ -48,9 +68,11 @@ class CharybdisFsApiServer:
                 raise cherrypy.HTTPError(message="Replacing of a fault is not supported")
             if (fault := create_fault_from_dict(data=cherrypy.request.json)) is None:
                 raise cherrypy.HTTPError(message="Unable to create a fault from provided JSON data")
+            if (mount_id := cherrypy.request.json.get("mount_id")) and MountRegistry.get_mount(mount_id) is None:
+                raise cherrypy.HTTPError(message=f"Unknown {mount_id=}")
             try:
                 fault_id = generate_fault_id()
-                Configuration.add_fault(fault_id=fault_id, fault=fault)
+                Configuration.add_fault(fault_id=fault_id, fault=fault, mount_id=mount_id)
             except ValueError as exc:
                 raise cherrypy.HTTPError(message=f"Unable to add a fault {fault} with {fault_id=}: {exc}") from None
             return {"fault_id": fault_id}
@@ -60,17 +82,227 @@ class CharybdisFsApiServer:
                 return {"fault_id": fault_id}
             raise cherrypy.NotFound()
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def faults_stats(self):
+        method = cherrypy.request.method
+
+        sys.audit("charybdisfs.api", method, None, cherrypy.request)
+
+        if method != "GET":
+            raise cherrypy.HTTPError(status=405)
+        return {"faults_stats": MountRegistry.get_all_faults_stats()}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def scenarios(self, scenario_id: Optional[ScenarioID] = None):  # noqa: C901  # ignore "is too complex" message
+        method = cherrypy.request.method
+
+        sys.audit("charybdisfs.api", method, scenario_id, cherrypy.request)
+
+        if method == "GET":
+            if scenario_id is None:
+                return {"scenarios_ids": Scenarios.get_all_scenarios_ids()}
+            if scenario := Scenarios.get_scenario(scenario_id=scenario_id):
+                return {"scenario_id": scenario_id,
+                        "scenario": scenario.to_dict(),
+                        "state": scenario.get_state(),
+                        "mount_id": Scenarios.get_mount_id(scenario_id)}
+            raise cherrypy.NotFound()
+
+        elif method in ("POST", "CREATE", "PUT",):
+            if scenario_id:
+                raise cherrypy.HTTPError(message="Replacing of a scenario is not supported")
+            try:
+                scenario = Scenario.from_dict(data=cherrypy.request.json)
+            except ValueError as exc:
+                raise cherrypy.HTTPError(message=f"Unable to create a scenario from provided JSON data: {exc}") from None
+            if (mount_id := cherrypy.request.json.get("mount_id")) and MountRegistry.get_mount(mount_id) is None:
+                raise cherrypy.HTTPError(message=f"Unknown {mount_id=}")
+            scenario_id = generate_scenario_id()
+            Scenarios.add_scenario(scenario_id=scenario_id, scenario=scenario, mount_id=mount_id)
+            return {"scenario_id": scenario_id}
+
+        elif method == "DELETE":
+            if Scenarios.remove_scenario(scenario_id=scenario_id):
+                return {"scenario_id": scenario_id}
+            raise cherrypy.NotFound()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def mounts(self, mount_id: Optional[MountID] = None):  # noqa: C901  # ignore "is too complex" message
+        method = cherrypy.request.method
+
+        sys.audit("charybdisfs.api", method, mount_id, cherrypy.request)
+
+        if method == "GET":
+            if mount_id is None:
+                return {"mounts": MountRegistry.get_all_mounts()}
+            if mount := MountRegistry.get_mount(mount_id=mount_id):
+                return mount.to_dict()
+            raise cherrypy.NotFound()
+
+        elif method in ("POST", "CREATE", "PUT",):
+            if mount_id:
+                raise cherrypy.HTTPError(message="Replacing of a mount is not supported")
+            try:
+                mount_id = MountRegistry.add_mount(source=cherrypy.request.json["source"],
+                                                   target=cherrypy.request.json["target"])
+            except KeyError:
+                raise cherrypy.HTTPError(message="Both source and target are required for a mount") from None
+            except (ValueError, RuntimeError) as exc:
+                raise cherrypy.HTTPError(message=f"Unable to add a mount: {exc}") from None
+            return {"mount_id": mount_id}
+
+        elif method == "DELETE":
+            if MountRegistry.remove_mount(mount_id=mount_id):
+                return {"mount_id": mount_id}
+            raise cherrypy.NotFound()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def crash(self, mount_id: Optional[MountID] = None):
+        method = cherrypy.request.method
+
+        sys.audit("charybdisfs.api", method, mount_id, cherrypy.request)
+
+        if method != "POST":
+            raise cherrypy.HTTPError(status=405)
+        if (operations := self._get_operations(mount_id=mount_id)) is None:
+            raise cherrypy.HTTPError(message="No CharybdisFS mount in this process")
+        try:
+            return {"discarded_pages": operations.crash()}
+        except (ValueError, RuntimeError) as exc:
+            raise cherrypy.HTTPError(message=str(exc)) from None
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def cancel(self, mount_id: Optional[MountID] = None, min_age: float = 0):
+        """Cancel in-flight requests (e.g., stuck in latency faults) which are older than `min_age' seconds."""
+
+        method = cherrypy.request.method
+
+        sys.audit("charybdisfs.api", method, mount_id, cherrypy.request)
+
+        if method != "POST":
+            raise cherrypy.HTTPError(status=405)
+        if (operations := self._get_operations(mount_id=mount_id)) is None:
+            raise cherrypy.HTTPError(message="No CharybdisFS mount in this process")
+        try:
+            return {"cancelled": operations.cancel_requests(float(min_age))}
+        except (ValueError, RuntimeError) as exc:
+            raise cherrypy.HTTPError(message=str(exc)) from None
+
+    @cherrypy.expose
+    def profile(self,
+                mount_id: Optional[MountID] = None,
+                seconds: float = 10,
+                mode: str = SAMPLING,
+                interval: float = DEFAULT_PROFILER_INTERVAL):
+        """Profile a mount for `seconds' and return collapsed stacks (sampling mode) or a pstats dump (deterministic.)"""
+
+        method = cherrypy.request.method
+
+        sys.audit("charybdisfs.api", method, mount_id, cherrypy.request)
+
+        if method != "GET":
+            raise cherrypy.HTTPError(status=405)
+        try:
+            seconds, interval = float(seconds), float(interval)
+            if not 0 < seconds <= MAX_DURATION:
+                raise ValueError(f"Profiling duration should be in (0, {MAX_DURATION}] seconds")
+            if (operations := self._get_operations(mount_id=mount_id)) is None:
+                raise cherrypy.HTTPError(message="No CharybdisFS mount in this process")
+            operations.start_profiler(mode, interval)
+            try:
+                time.sleep(seconds)
+            finally:
+                result = operations.stop_profiler()
+        except ValueError as exc:
+            raise cherrypy.HTTPError(status=400, message=str(exc)) from None
+        except RuntimeError as exc:
+            raise cherrypy.HTTPError(message=str(exc)) from None
+        if mode == DETERMINISTIC:
+            cherrypy.response.headers["Content-Type"] = "application/octet-stream"
+            cherrypy.response.headers["Content-Disposition"] = 'attachment; filename="charybdisfs.pstats"'
+        else:
+            cherrypy.response.headers["Content-Type"] = "text/plain"
+        return result
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def stats(self, mount_id: Optional[MountID] = None):
+        method = cherrypy.request.method
+
+        sys.audit("charybdisfs.api", method, mount_id, cherrypy.request)
+
+        if method != "GET":
+            raise cherrypy.HTTPError(status=405)
+        if (operations := self._get_operations(mount_id=mount_id)) is None:
+            return {}
+        return operations.get_stats()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def ready(self):
+        """Readiness of the mount: 503 status until the mount is able to serve requests and the warm-up is done."""
+
+        method = cherrypy.request.method
+
+        sys.audit("charybdisfs.api", method, None, cherrypy.request)
+
+        if method != "GET":
+            raise cherrypy.HTTPError(status=405)
+        if not (status := Readiness.get_status())["ready"]:
+            cherrypy.response.status = 503
+        return status
+
+    @cherrypy.expose
+    def events(self, batch_size: int = DEFAULT_BATCH_SIZE, queue_size: int = DEFAULT_QUEUE_SIZE):
+        """Stream of event batches as JSON lines: {"events": [...], "dropped": N}."""
+
+        method = cherrypy.request.method
+
+        sys.audit("charybdisfs.api", method, None, cherrypy.request)
+
+        if method != "GET":
+            raise cherrypy.HTTPError(status=405)
+
+        if (subscriber := EventStream.subscribe(queue_size=int(queue_size),
+                                                max_subscribers=MAX_EVENTS_SUBSCRIBERS)) is None:
+            raise cherrypy.HTTPError(status=503, message=f"Too many events streams, {MAX_EVENTS_SUBSCRIBERS} at most")
+        cherrypy.response.headers["Content-Type"] = "application/x-ndjson"
+
+        def stream():
+            try:
+                while True:
+                    batch = subscriber.get_batch(max_size=int(batch_size), timeout=EVENTS_HEARTBEAT)
+                    yield (json.dumps(batch) + "\n").encode()
+            finally:
+                EventStream.unsubscribe(subscriber)
+        return stream()
+    events._cp_config = {"response.stream": True}
+
+    def _get_operations(self, mount_id: Optional[MountID]) -> Union[CharybdisOperations, MountProcess, None]:
+        if mount_id is None:
+            return self.operations
+        if (mount := MountRegistry.get_mount(mount_id=mount_id)) is None:
+            raise cherrypy.NotFound()
+        return mount
+
 
-def start_charybdisfs_api_server(port: int = DEFAULT_PORT) -> None:
+def start_charybdisfs_api_server(port: int = DEFAULT_PORT, operations: Optional[CharybdisOperations] = None) -> None:
     conf = {
         "global": {
             "server.socket_host": "0.0.0.0",
             "server.socket_port": port,
-            "server.thread_pool": 1,
+            "server.thread_pool": THREAD_POOL_SIZE,
             "engine.autoreload.on": False,
         },
     }
-    cherrypy.quickstart(root=CharybdisFsApiServer(), config=conf)
+    cherrypy.quickstart(root=CharybdisFsApiServer(operations=operations), config=conf)
 
 
 def stop_charybdisfs_api_server() -> None:
@@ -0,0 +1,271 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fault scenarios: sequences of stages with own faults, e.g., progressive failure of a disk.
+
+A scenario is described by JSON like this:
+
+    {"name": "dying disk",
+     "stages": [{"name": "healthy", "faults": [], "until": {"calls": 1000, "sys_call": "write"}},
+                {"faults": [{"fault_type": "ErrorFault", "sys_call": "write", "probability": 5, "error_no": 5}],
+                 "until": {"seconds": 30}},
+                {"faults": [{"fault_type": "LatencyFault", "sys_call": "write", "probability": 100, "delay": 50000}],
+                 "until": {"seconds": 60}},
+                {"name": "recovered", "faults": []}]}
+
+A stage lasts until any of its `until' conditions is met: `calls' FS calls (of `sys_call' only if it's set) are
+served, or `seconds' passed since the stage is entered.  A stage without conditions lasts forever, and the scenario
+is finished (no faults) after the last stage with conditions.
+"""
+
+from __future__ import annotations
+
+import sys
+import time
+import logging
+import threading
+from typing import NewType, Dict, Optional, List, Tuple, Callable, Any
+
+from core.faults import BaseFault, SysCall, create_fault_from_dict
+from core.configuration import MountID, generate_fault_id
+
+
+ScenarioID = NewType("ScenarioID", str)
+
+NO_FAULTS: Tuple[BaseFault, ...] = ()
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Stage:
+    """Stage of a scenario with faults precompiled into a per-syscall table."""
+
+    __slots__ = ("name", "faults", "calls", "calls_sys_call", "seconds", "table", )
+
+    def __init__(self,
+                 faults: List[BaseFault],
+                 name: Optional[str] = None,
+                 calls: Optional[int] = None,
+                 calls_sys_call: SysCall = SysCall.ALL,
+                 seconds: Optional[float] = None):
+        if calls is not None and calls < 1:
+            raise ValueError(f"Number of calls of a stage should be positive: {calls}")
+        if seconds is not None and seconds <= 0:
+            raise ValueError(f"Duration of a stage should be positive: {seconds}")
+        self.name = name
+        self.faults = faults
+        self.calls = calls
+        self.calls_sys_call = calls_sys_call
+        self.seconds = seconds
+        self.table = self.compile(faults=faults)
+
+    @property
+    def final(self) -> bool:
+        return self.calls is None and self.seconds is None
+
+    @staticmethod
+    def compile(faults: List[BaseFault]) -> Dict[SysCall, Tuple[BaseFault, ...]]:
+        """Return faults by syscall: syscalls without faults are not in the table."""
+
+        table = {}
+        for sys_call in SysCall:
+            if sys_call in (SysCall.UNKNOWN, SysCall.ALL, ):
+                continue
+            if sys_call_faults := tuple(fault for fault in faults if fault.sys_call in (sys_call, SysCall.ALL, )):
+                for fault in sys_call_faults:
+                    if sum(f.probability for f in sys_call_faults if f.may_overlap(fault)) > 100:
+                        raise ValueError(f"Fault probability for FS call `{sys_call.value}' exceeds 100%")
+                table[sys_call] = sys_call_faults
+        return table
+
+    def to_dict(self) -> Dict[str, Any]:
+        until: Dict[str, Any] = {}
+        if self.calls is not None:
+            until.update(calls=self.calls, sys_call=self.calls_sys_call.value)
+        if self.seconds is not None:
+            until["seconds"] = self.seconds
+        return {"name": self.name, "faults": [fault.to_dict() for fault in self.faults], "until": until or None}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> Stage:
+        faults = []
+        for fault_data in data.get("faults", ()):
+            if (fault := create_fault_from_dict(data=fault_data)) is None:
+                raise ValueError(f"Unable to create a fault from {fault_data}")
+            faults.append(fault)
+        until = data.get("until") or {}
+        if (calls_sys_call := SysCall(until.get("sys_call", SysCall.ALL.value))) == SysCall.UNKNOWN:
+            raise ValueError(f"Unknown syscall in stage conditions: {until['sys_call']}")
+        return cls(faults=faults,
+                   name=data.get("name"),
+                   calls=until.get("calls"),
+                   calls_sys_call=calls_sys_call,
+                   seconds=until.get("seconds"))
+
+
+class Scenario:
+    """State machine over stages: advanced by FS calls, so it's driven by the event loop thread only."""
+
+    def __init__(self, stages: List[Stage], name: Optional[str] = None):
+        if not stages:
+            raise ValueError("A scenario should have one stage at least")
+        if any(stage.final for stage in stages[:-1]):
+            raise ValueError("Only the last stage of a scenario can last forever")
+        self.name = name
+        self.stages = stages
+        self.stage_index = 0
+        self.table = stages[0].table
+        self.stage_started = self.deadline = 0.0
+        self.calls_left = 0  # 0 if the stage isn't limited by calls
+        self.calls_sys_call = SysCall.ALL
+        self._enter(index=0)
+
+    @property
+    def finished(self) -> bool:
+        return self.stage_index >= len(self.stages)
+
+    def get_faults_by_sys_call(self, sys_call: SysCall) -> Tuple[BaseFault, ...]:
+        if self.deadline and time.monotonic() >= self.deadline:
+            self._enter(index=self.stage_index + 1)
+        table = self.table
+        if self.calls_left and self.calls_sys_call in (sys_call, SysCall.ALL, ):
+            self.calls_left -= 1
+            if not self.calls_left:  # the call is the last one served by the stage.
+                self._enter(index=self.stage_index + 1)
+        return table.get(sys_call, NO_FAULTS)
+
+    def _enter(self, index: int) -> None:
+        self.stage_index = index
+        self.stage_started = time.monotonic()
+        if self.finished:
+            self.table, self.calls_left, self.deadline = {}, 0, 0.0
+            LOGGER.info("Scenario %r is finished", self.name)
+            return
+        stage = self.stages[index]
+        self.table = stage.table
+        self.calls_left = stage.calls or 0
+        self.calls_sys_call = stage.calls_sys_call
+        self.deadline = self.stage_started + stage.seconds if stage.seconds else 0.0
+        LOGGER.info("Scenario %r entered stage #%s %r", self.name, index, stage.name)
+
+    def get_state(self) -> Dict[str, Any]:
+        state = {"stage": self.stage_index, "finished": self.finished}
+        if not self.finished:
+            stage = self.stages[self.stage_index]
+            state.update(stage_name=stage.name, stage_age=time.monotonic() - self.stage_started)
+            if stage.calls:
+                state["calls_left"] = self.calls_left
+        return state
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"name": self.name, "stages": [stage.to_dict() for stage in self.stages]}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> Scenario:
+        try:
+            return cls(stages=[Stage.from_dict(stage) for stage in data["stages"]], name=data.get("name"))
+        except (KeyError, TypeError, AssertionError) as exc:
+            raise ValueError(f"Invalid scenario description: {exc!r}") from None
+
+
+class Scenarios:
+    """Global registry of running scenarios.
+
+    Like a fault, a scenario can be scoped to one mount.  A mount served by a child process runs own copies of
+    scenarios, so they are advanced by calls to this mount only.
+    """
+
+    scenarios: Dict[ScenarioID, Scenario] = {}
+    scenarios_lock = threading.RLock()
+    mount_scenarios: Dict[ScenarioID, MountID] = {}
+    listeners: List[Callable[[], None]] = []  # called on every change
+
+    @classmethod
+    def add_scenario(cls, scenario_id: ScenarioID, scenario: Scenario, mount_id: Optional[MountID] = None) -> None:
+        sys.audit("charybdisfs.config", "add_scenario", scenario_id, scenario.name, mount_id)
+
+        with cls.scenarios_lock:
+            if scenario_id in cls.scenarios:
+                raise ValueError(f"The scenario with {scenario_id=} is set already.")
+            cls._set(scenarios={**cls.scenarios, scenario_id: scenario},
+                     mount_scenarios={**cls.mount_scenarios, scenario_id: mount_id} if mount_id else cls.mount_scenarios)
+
+    @classmethod
+    def remove_scenario(cls, scenario_id: ScenarioID) -> Optional[Scenario]:
+        sys.audit("charybdisfs.config", "remove_scenario", scenario_id)
+
+        with cls.scenarios_lock:
+            if (scenario := cls.scenarios.get(scenario_id)) is not None:
+                cls._set(scenarios={s_id: s for s_id, s in cls.scenarios.items() if s_id != scenario_id},
+                         mount_scenarios={s_id: m_id for s_id, m_id in cls.mount_scenarios.items() if s_id != scenario_id})
+            return scenario
+
+    @classmethod
+    def replace_all_scenarios(cls,
+                              scenarios: Dict[ScenarioID, Dict[str, Any]],
+                              mount_scenarios: Dict[ScenarioID, MountID]) -> None:
+        """Set scenarios from descriptions: running ones are kept in their current stages."""
+
+        sys.audit("charybdisfs.config", "replace_all_scenarios", list(scenarios))
+
+        with cls.scenarios_lock:
+            cls._set(scenarios={scenario_id: cls.scenarios.get(scenario_id) or Scenario.from_dict(data)
+                                for scenario_id, data in scenarios.items()},
+                     mount_scenarios=dict(mount_scenarios))
+
+    @classmethod
+    def _set(cls, scenarios: Dict[ScenarioID, Scenario], mount_scenarios: Dict[ScenarioID, MountID]) -> None:
+        # Dicts are replaced, not changed, so the event loop thread can iterate them without the lock.
+        cls.scenarios, cls.mount_scenarios = scenarios, mount_scenarios
+        for listener in cls.listeners:
+            try:
+                listener()
+            except Exception:  # a broken listener shouldn't break the configuration.
+                LOGGER.exception("Scenarios listener %s failed", listener)
+
+    @classmethod
+    def get_faults_by_sys_call(cls, sys_call: SysCall, mount_id: Optional[MountID] = None) -> Tuple[BaseFault, ...]:
+        """Advance scenarios of the mount by the call and return faults of their current stages."""
+
+        faults = NO_FAULTS
+        mount_scenarios = cls.mount_scenarios
+        for scenario_id, scenario in cls.scenarios.items():
+            if mount_scenarios.get(scenario_id) in (None, mount_id):
+                faults += scenario.get_faults_by_sys_call(sys_call=sys_call)
+        return faults
+
+    @classmethod
+    def get_scenario(cls, scenario_id: ScenarioID) -> Optional[Scenario]:
+        return cls.scenarios.get(scenario_id)
+
+    @classmethod
+    def get_mount_id(cls, scenario_id: ScenarioID) -> Optional[MountID]:
+        return cls.mount_scenarios.get(scenario_id)
+
+    @classmethod
+    def get_all_scenarios_ids(cls) -> List[ScenarioID]:
+        return list(cls.scenarios)
+
+    @classmethod
+    def get_state(cls, mount_id: Optional[MountID] = None) -> Dict[ScenarioID, Dict[str, Any]]:
+        mount_scenarios = cls.mount_scenarios
+        return {scenario_id: scenario.get_state() for scenario_id, scenario in cls.scenarios.items()
+                if mount_scenarios.get(scenario_id) in (None, mount_id)}
+
+
+def generate_scenario_id() -> ScenarioID:
+    return ScenarioID(generate_fault_id())
+
+
+__all__ = ("Scenarios", "Scenario", "Stage", "ScenarioID", "generate_scenario_id", )
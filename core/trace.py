@@ -0,0 +1,353 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Record FS calls into a memory-mapped ring file and replay them.
+
+Layout (little-endian):
+
+    header: magic "CHTR", format version (u16), record size (u16), capacity (u32), number of written records (u64)
+    record: start (u64, monotonic ns), duration (u64, ns), inode (u64), fh (u64), offset (i64), size (u64),
+            entry inode (u64), flags (u32), name (u32), new name (u32), syscall (u8),
+            fault type (u8, 0 if no fault fired), errno (u16)
+
+The ring keeps the last `capacity' records.  Calls with a directory entry record the parent directory as the inode,
+the inode of a found or created entry, and ids of names in a table of names.  rename() and link() keep the new parent
+directory in the fh field.  Paths of recorded inodes relative to the source directory and the table of names are saved
+to JSON files next to the trace on close, so a trace can be replayed on a copy of the data.  Modes of created files
+are not recorded.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+from typing import TYPE_CHECKING, Dict, List, Optional, Any, NamedTuple
+
+import pyfuse3
+
+from core.faults import BaseFault, SysCall
+from core.fault_snapshot import FAULT_TYPES, SYS_CALLS
+
+if TYPE_CHECKING:
+    from core.operations import CharybdisOperations, FileHandle, INode
+
+
+MAGIC = b"CHTR"
+FORMAT_VERSION = 2
+DEFAULT_CAPACITY = 1024 * 1024  # records
+
+HEADER = struct.Struct("<4sHHIQ")
+HEAD = struct.Struct("<Q")
+HEAD_OFFSET = 12
+RECORD = struct.Struct("<QQQQqQQIIIBBH")
+
+UNKNOWN_FAULT_TYPE = 255
+
+# Calls which use a file handle returned by a recorded open().
+FILE_HANDLE_CALLS = frozenset({SysCall.FLUSH, SysCall.FSYNC, SysCall.READ, SysCall.RELEASE, SysCall.WRITE, })
+
+# Calls which have names of directory entries.
+NAMESPACE_CALLS = frozenset({
+    SysCall.CREATE, SysCall.LINK, SysCall.LOOKUP, SysCall.MKDIR, SysCall.MKNOD, SysCall.RENAME, SysCall.RMDIR,
+    SysCall.SYMLINK, SysCall.UNLINK,
+})
+
+DEFAULT_FILE_MODE = 0o644
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TraceRecord(NamedTuple):
+    start: int
+    duration: int
+    inode: int
+    fh: int
+    off: int
+    size: int
+    entry: int
+    flags: int
+    name: int
+    new_name: int
+    sys_call: SysCall
+    fault_type: str
+    errno: int
+
+
+class TraceRecorder:
+    def __init__(self, path: str, capacity: int = DEFAULT_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        size = HEADER.size + RECORD.size * capacity
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.head = 0
+        self.mmap[:HEADER.size] = HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size, capacity, 0)
+        self.inode_paths: Dict[int, str] = {}  # relative to the source directory
+        self.names: Dict[str, int] = {"": 0}  # name -> id, 0 if there is no name
+
+    def record(self,
+               sys_call: SysCall,
+               start: int,
+               duration: int,
+               inode: int = 0,
+               fh: int = 0,
+               off: int = 0,
+               size: int = 0,
+               entry: int = 0,
+               flags: int = 0,
+               name: Optional[bytes] = None,
+               new_name: Optional[bytes] = None,
+               fault: Optional[BaseFault] = None,
+               error_no: int = 0) -> None:
+        if fault is None:
+            fault_type = 0
+        elif (fault_type_name := type(fault).__name__) in FAULT_TYPES:
+            fault_type = FAULT_TYPES.index(fault_type_name)
+        else:
+            fault_type = UNKNOWN_FAULT_TYPE
+        if sys_call in NAMESPACE_CALLS:
+            name_id, new_name_id = self._get_name_id(name=name), self._get_name_id(name=new_name)
+        else:  # e.g., names of extended attributes.
+            name_id = new_name_id = 0
+        RECORD.pack_into(self.mmap, HEADER.size + self.head % self.capacity * RECORD.size,
+                         start, duration, inode, fh, off, size, entry, flags, name_id, new_name_id,
+                         SYS_CALLS.index(sys_call), fault_type, error_no)
+        self.head += 1
+        HEAD.pack_into(self.mmap, HEAD_OFFSET, self.head)
+
+    def _get_name_id(self, name: Optional[bytes]) -> int:
+        if not name:
+            return 0
+        if (name_id := self.names.get(decoded := os.fsdecode(name))) is None:
+            name_id = self.names[decoded] = len(self.names)
+        return name_id
+
+    def close(self) -> None:
+        with open(get_inode_paths_file(path=self.path), "w") as inode_paths_file:
+            json.dump(self.inode_paths, inode_paths_file)
+        with open(get_names_file(path=self.path), "w") as names_file:
+            json.dump(list(self.names), names_file)
+        self.mmap.close()
+
+
+def get_inode_paths_file(path: str) -> str:
+    return f"{path}.inodes"
+
+
+def get_names_file(path: str) -> str:
+    return f"{path}.names"
+
+
+def read_inode_paths(path: str) -> Dict[int, str]:
+    try:
+        with open(get_inode_paths_file(path=path)) as inode_paths_file:
+            return {int(inode): inode_path for inode, inode_path in json.load(inode_paths_file).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def read_names(path: str) -> List[bytes]:
+    """Return the table of names: a record has an index in it."""
+
+    try:
+        with open(get_names_file(path=path)) as names_file:
+            return [os.fsencode(name) for name in json.load(names_file)]
+    except FileNotFoundError:
+        return []
+
+
+def read_trace(path: str) -> List[TraceRecord]:
+    """Return recorded calls in order of their start."""
+
+    with open(path, "rb") as trace_file, mmap.mmap(trace_file.fileno(), 0, prot=mmap.PROT_READ) as trace:
+        magic, version, record_size, capacity, head = HEADER.unpack_from(trace)
+        if magic != MAGIC or version != FORMAT_VERSION or record_size != RECORD.size:
+            raise ValueError(f"{path} is not a trace of version {FORMAT_VERSION}")
+        records = [_unpack_record(record) for record in RECORD.iter_unpack(trace[HEADER.size:])][:min(head, capacity)]
+    if head > capacity:  # the ring wrapped around: the oldest record is next to the newest one.
+        records = records[head % capacity:] + records[:head % capacity]
+    return records
+
+
+def _unpack_record(record: tuple) -> TraceRecord:
+    *fields, sys_call, fault_type, error_no = record
+    return TraceRecord(*fields,
+                       sys_call=SYS_CALLS[sys_call],
+                       fault_type=FAULT_TYPES[fault_type] if fault_type < len(FAULT_TYPES) else "unknown",
+                       errno=error_no)
+
+
+class ReplayContext(NamedTuple):
+    """Context of replayed calls: files are created by the user who replays a trace."""
+
+    pid: int
+    uid: int
+    gid: int
+    umask: int
+
+
+class CallStats:
+    __slots__ = ("count", "errors", "replay_time", "recorded_time", )
+
+    def __init__(self):
+        self.count = self.errors = self.replay_time = self.recorded_time = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "replay_time": self.replay_time / 1e9,
+            "recorded_time": self.recorded_time / 1e9,
+        }
+
+
+class TraceReplayer:
+    """Drive CharybdisOperations by recorded calls and compare timings with the recorded ones.
+
+    Replay changes the data in the source directory, so it should be done on a copy.
+    """
+
+    def __init__(self,
+                 operations: CharybdisOperations,
+                 inode_paths: Optional[Dict[int, str]] = None,
+                 names: Optional[List[bytes]] = None):
+        self.operations = operations
+        self.inode_paths = inode_paths
+        self.names = names or []
+        self.inodes: Dict[int, INode] = {}  # recorded inode -> inode in the replayed tree
+        self.ctx = ReplayContext(pid=os.getpid(), uid=os.getuid(), gid=os.getgid(), umask=0o022)  # owns new files
+        self.file_handles: Dict[int, FileHandle] = {}  # recorded fh -> replayed fh
+        self.stats: Dict[str, CallStats] = {}
+        self.skipped = 0
+        self.handlers = {
+            SysCall.ACCESS: lambda r: self.operations.access(self._inode(r), r.flags, self.ctx),
+            SysCall.CREATE: self._create,
+            SysCall.FLUSH: lambda r: self.operations.flush(self.file_handles[r.fh]),
+            SysCall.FSYNC: lambda r: self.operations.fsync(self.file_handles[r.fh], bool(r.flags)),
+            SysCall.FSYNCDIR: lambda r: self.operations.fsyncdir(self._inode(r), bool(r.flags)),
+            SysCall.GETATTR: lambda r: self.operations.getattr(self._inode(r), self.ctx),
+            SysCall.LOOKUP: self._lookup,
+            SysCall.MKDIR: self._mkdir,
+            SysCall.OPEN: self._open,
+            SysCall.OPENDIR: lambda r: self.operations.opendir(self._inode(r), self.ctx),
+            SysCall.READ: lambda r: self.operations.read(self.file_handles[r.fh], r.off, r.size),
+            SysCall.READLINK: lambda r: self.operations.readlink(self._inode(r), self.ctx),
+            SysCall.RELEASE: lambda r: self.operations.release(self.file_handles.pop(r.fh)),
+            SysCall.RELEASEDIR: lambda r: self.operations.releasedir(r.fh),
+            SysCall.RENAME: lambda r: self.operations.rename(self._inode(r), self._name(r.name),
+                                                             self.inodes.get(r.fh, r.fh), self._name(r.new_name),
+                                                             r.flags, self.ctx),
+            SysCall.RMDIR: lambda r: self.operations.rmdir(self._inode(r), self._name(r.name), self.ctx),
+            SysCall.STATFS: lambda r: self.operations.statfs(self.ctx),
+            SysCall.UNLINK: lambda r: self.operations.unlink(self._inode(r), self._name(r.name), self.ctx),
+            SysCall.WRITE: lambda r: self.operations.write(self.file_handles[r.fh], r.off, bytes(r.size)),
+        }
+
+    def prime_paths(self) -> None:
+        """Make inodes of recorded files known to the operations.
+
+        Without saved paths the trace is expected to be replayed on the same tree, so all files are added.
+        """
+
+        root = self.operations.paths[pyfuse3.ROOT_INODE]
+        if self.inode_paths:
+            for inode, inode_path in self.inode_paths.items():
+                if not inode_path:
+                    continue
+                path = os.path.join(root, inode_path)
+                try:
+                    self.inodes[inode] = replay_inode = os.lstat(path).st_ino
+                except OSError as exc:  # could be created by the trace.
+                    LOGGER.debug("Unable to find %s recorded for inode=%s: %s", path, inode, exc)
+                    continue
+                self.operations.paths[replay_inode] = path
+            return
+        for dir_path, dir_names, file_names in os.walk(root):
+            for name in dir_names + file_names:
+                path = os.path.join(dir_path, name)
+                self.operations.paths[os.lstat(path).st_ino] = path
+
+    def _inode(self, record: TraceRecord) -> INode:
+        return self.inodes.get(record.inode, record.inode)
+
+    def _name(self, name_id: int) -> bytes:
+        return self.names[name_id] if name_id < len(self.names) else b""
+
+    async def replay(self, records: List[TraceRecord]) -> Dict[str, Any]:
+        self.prime_paths()
+        started = time.monotonic_ns()
+        for record in records:
+            if (handler := self.handlers.get(record.sys_call)) is None or \
+                    record.sys_call in FILE_HANDLE_CALLS and record.fh not in self.file_handles or \
+                    record.sys_call in NAMESPACE_CALLS and not self._name(record.name):
+                self.skipped += 1  # unsupported call, a file opened before the first record or an unknown name.
+                continue
+            if (stats := self.stats.get(record.sys_call.value)) is None:
+                stats = self.stats[record.sys_call.value] = CallStats()
+            start = time.monotonic_ns()
+            try:
+                await handler(record)
+            except (pyfuse3.FUSEError, OSError, KeyError):
+                stats.errors += 1
+            stats.replay_time += time.monotonic_ns() - start
+            stats.recorded_time += record.duration
+            stats.count += 1
+        elapsed = (time.monotonic_ns() - started) / 1e9
+        replayed = sum(stats.count for stats in self.stats.values())
+        return {
+            "replayed": replayed,
+            "skipped": self.skipped,
+            "elapsed": elapsed,
+            "ops_per_second": replayed / elapsed if elapsed else 0,
+            "calls": {sys_call: stats.to_dict() for sys_call, stats in sorted(self.stats.items())},
+        }
+
+    async def _open(self, record: TraceRecord) -> None:
+        file_info = await self.operations.open(self._inode(record), record.flags & ~(os.O_CREAT | os.O_TRUNC), self.ctx)
+        if record.errno:  # failed in the recorded run: keep the cost of the call, but not the handle.
+            await self.operations.release(file_info.fh)
+        else:
+            self.file_handles[record.fh] = file_info.fh
+
+    async def _create(self, record: TraceRecord) -> None:
+        file_info, entry_attrs = \
+            await self.operations.create(self._inode(record), self._name(record.name), DEFAULT_FILE_MODE,
+                                         record.flags, self.ctx)
+        if record.entry:
+            self.inodes[record.entry] = entry_attrs.st_ino
+        if record.errno:
+            await self.operations.release(file_info.fh)
+        else:
+            self.file_handles[record.fh] = file_info.fh
+
+    async def _lookup(self, record: TraceRecord) -> None:
+        entry_attrs = await self.operations.lookup(self._inode(record), self._name(record.name), self.ctx)
+        if record.entry:
+            self.inodes[record.entry] = entry_attrs.st_ino
+
+    async def _mkdir(self, record: TraceRecord) -> None:
+        entry_attrs = await self.operations.mkdir(self._inode(record), self._name(record.name), record.flags, self.ctx)
+        if record.entry:
+            self.inodes[record.entry] = entry_attrs.st_ino
+
+
+__all__ = ("TraceRecorder", "TraceReplayer", "TraceRecord", "read_trace", "read_inode_paths", "read_names", )
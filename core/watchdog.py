@@ -0,0 +1,143 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import sys
+import time
+import logging
+import threading
+import traceback
+from typing import Dict, Any, List, Optional
+
+import trio
+
+from core.inflight import InFlightRequests
+
+
+DEFAULT_SLOW_REQUEST_THRESHOLD = 5.0  # seconds
+DEFAULT_LOOP_STALL_THRESHOLD = 1.0  # seconds
+DEFAULT_TICK_INTERVAL = 0.1  # seconds
+MAX_REPORTED_REQUESTS = 16  # slow requests in stats
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Watchdog:
+    """Monitor of the event loop lag and of slow requests.
+
+    A task in the event loop wakes up every `tick_interval' seconds: the lag is how late it's woken up.  The task
+    reports requests which are in flight longer than `slow_request_threshold' once per request.
+
+    A stalled loop can't report itself, so a thread checks the heartbeat of the task and reports the stack of the
+    event loop thread if there was no heartbeat for `loop_stall_threshold' seconds.
+    """
+
+    def __init__(self,
+                 requests: InFlightRequests,
+                 slow_request_threshold: float = DEFAULT_SLOW_REQUEST_THRESHOLD,
+                 loop_stall_threshold: float = DEFAULT_LOOP_STALL_THRESHOLD,
+                 tick_interval: float = DEFAULT_TICK_INTERVAL):
+        self.requests = requests
+        self.slow_request_threshold = slow_request_threshold
+        self.loop_stall_threshold = loop_stall_threshold
+        self.tick_interval = tick_interval
+
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self.stall_reported = False
+        self.stopped = threading.Event()
+
+        self.ticks = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.stalls = 0
+        self.slow_requests = 0
+
+    async def run(self) -> None:
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopped.clear()
+        thread = threading.Thread(target=self._watch_loop, name="charybdisfs-watchdog", daemon=True)
+        thread.start()
+        try:
+            while True:
+                expected = time.monotonic() + self.tick_interval
+                await trio.sleep(self.tick_interval)
+                self.tick(now=time.monotonic(), expected=expected)
+        finally:
+            self.stopped.set()
+
+    def tick(self, now: float, expected: float) -> None:
+        lag = max(0.0, now - expected)
+        self.ticks += 1
+        self.last_lag = lag
+        self.total_lag += lag
+        if lag > self.max_lag:
+            self.max_lag = lag
+        if lag >= self.loop_stall_threshold:
+            LOGGER.warning("Event loop was stalled for %.3fs", lag)
+        self.heartbeat = now
+        self.stall_reported = False
+        self.check_requests(now=now)
+
+    def check_requests(self, now: float) -> None:
+        started_before = now - self.slow_request_threshold
+        for request in self.requests.requests.values():  # in order of start
+            if request.started > started_before:
+                break
+            if not request.reported:
+                request.reported = True
+                self.slow_requests += 1
+                LOGGER.warning("Slow request: %s", request.to_dict(now=now))
+
+    def _watch_loop(self) -> None:
+        while not self.stopped.wait(self.tick_interval):
+            stalled = time.monotonic() - self.heartbeat
+            if stalled < self.loop_stall_threshold or self.stall_reported:
+                continue
+            self.stall_reported = True
+            self.stalls += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            oldest = self.requests.get_oldest()
+            LOGGER.warning("Event loop is stalled for %.3fs, the oldest in-flight request: %s, event loop stack:\n%s",
+                           stalled,
+                           None if oldest is None else oldest.to_dict(now=time.monotonic()),
+                           "".join(traceback.format_stack(frame)) if frame is not None else "unknown")
+
+    def get_slow_requests(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        started_before = now - self.slow_request_threshold
+        slow_requests = []
+        for request in list(self.requests.requests.values()):
+            if request.started > started_before or len(slow_requests) >= MAX_REPORTED_REQUESTS:
+                break
+            slow_requests.append(request.to_dict(now=now))
+        return slow_requests
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "loop_lag": {
+                "last": self.last_lag,
+                "max": self.max_lag,
+                "avg": self.total_lag / self.ticks if self.ticks else 0.0,
+            },
+            "stalls": self.stalls,
+            "slow_requests": self.slow_requests,
+            "slow_in_flight": self.get_slow_requests(),
+        }
+
+
+__all__ = ("Watchdog", "DEFAULT_SLOW_REQUEST_THRESHOLD", "DEFAULT_LOOP_STALL_THRESHOLD", )
@@ -0,0 +1,121 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import time
+import logging
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+from collections import OrderedDict
+
+if TYPE_CHECKING:
+    from core.operations import INode
+
+
+DEFAULT_TTL = 1.0  # seconds
+DEFAULT_MAX_INODES = 64 * 1024
+
+LOGGER = logging.getLogger(__name__)
+
+
+class NoAttribute:
+    """Cached "no such attribute" (ENODATA) result."""
+
+    def __repr__(self):
+        return "NO_ATTRIBUTE"
+
+
+NO_ATTRIBUTE = NoAttribute()
+
+CachedValue = Union[bytes, NoAttribute, None]  # None if not cached
+
+
+class INodeXattrs:
+    __slots__ = ("values", "names", )
+
+    def __init__(self):
+        self.values: Dict[str, Tuple[Union[bytes, NoAttribute], float]] = {}  # name -> (value, expiration time)
+        self.names: Optional[Tuple[List[bytes], float]] = None
+
+
+class XattrCache:
+    """Per-inode cache of extended attributes values and names lists.
+
+    Entries expire after `ttl' seconds, so changes made directly on the backing FS become visible eventually.
+    Changes made through CharybdisFS invalidate entries of the inode immediately.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TTL, max_inodes: int = DEFAULT_MAX_INODES):
+        self.ttl = ttl
+        self.max_inodes = max_inodes
+        self.inodes: OrderedDict[INode, INodeXattrs] = OrderedDict()  # in LRU order
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evicted_inodes = 0
+
+    def get(self, inode: INode, name: str) -> CachedValue:
+        if (xattrs := self._get_xattrs(inode=inode)) is not None and (entry := xattrs.values.get(name)) is not None:
+            value, expires = entry
+            if expires > time.monotonic():
+                if value is NO_ATTRIBUTE:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return value
+            del xattrs.values[name]
+        self.misses += 1
+        return None
+
+    def put(self, inode: INode, name: str, value: Union[bytes, NoAttribute]) -> None:
+        self._get_xattrs(inode=inode, create=True).values[name] = (value, time.monotonic() + self.ttl)
+
+    def get_names(self, inode: INode) -> Optional[List[bytes]]:
+        if (xattrs := self._get_xattrs(inode=inode)) is not None and (entry := xattrs.names) is not None:
+            names, expires = entry
+            if expires > time.monotonic():
+                self.hits += 1
+                return names
+            xattrs.names = None
+        self.misses += 1
+        return None
+
+    def put_names(self, inode: INode, names: List[bytes]) -> None:
+        self._get_xattrs(inode=inode, create=True).names = (names, time.monotonic() + self.ttl)
+
+    def invalidate(self, inode: INode) -> None:
+        self.inodes.pop(inode, None)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evicted_inodes": self.evicted_inodes,
+            "cached_inodes": len(self.inodes),
+        }
+
+    def _get_xattrs(self, inode: INode, create: bool = False) -> Optional[INodeXattrs]:
+        if (xattrs := self.inodes.get(inode)) is not None:
+            self.inodes.move_to_end(inode)
+        elif create:
+            xattrs = self.inodes[inode] = INodeXattrs()
+            if len(self.inodes) > self.max_inodes:
+                self.inodes.popitem(last=False)
+                self.evicted_inodes += 1
+        return xattrs
+
+
+__all__ = ("XattrCache", "NO_ATTRIBUTE", "DEFAULT_TTL", )
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import json
+import logging
+from typing import Optional
+
+import trio
+import click
+
+from core.faults import create_fault_from_dict
+from core.trace import TraceReplayer, read_trace, read_inode_paths, read_names
+from core.mounts import create_operations
+from core.configuration import Configuration, generate_fault_id
+
+
+LOGGER = logging.getLogger("charybdisfs.replay")
+
+
+@click.command()
+@click.option("--debug/--no-debug", default=False)
+@click.option("--faults", type=click.File(), default=None)  # JSON list of faults in the REST API format
+@click.argument("trace", type=click.Path(exists=True, dir_okay=False))
+@click.argument("source", type=click.Path(exists=True, dir_okay=True))
+def replay_trace(trace: str, source: str, debug: bool, faults: Optional[click.File]) -> None:
+    """Replay FS calls recorded by `charybdisfs.py --trace' on a copy of the source directory."""
+
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG if debug else logging.INFO)
+
+    for fault_data in json.load(faults) if faults else ():
+        if (fault := create_fault_from_dict(data=fault_data)) is None:
+            raise click.BadParameter(f"Unable to create a fault from {fault_data}", param_hint="--faults")
+        Configuration.add_fault(fault_id=generate_fault_id(), fault=fault)
+
+    records = read_trace(path=trace)
+    LOGGER.info("Going to replay %s FS calls on %s", len(records), source)
+    replayer = TraceReplayer(operations=create_operations(source=source),
+                             inode_paths=read_inode_paths(path=trace),
+                             names=read_names(path=trace))
+    json.dump(trio.run(replayer.replay, records), sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    replay_trace(prog_name="replay_trace")
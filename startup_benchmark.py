@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import time
+import signal
+import statistics
+import subprocess
+from typing import Dict, List, Tuple, Optional
+
+import click
+
+
+IMPORT_PROBE = """
+import sys, time
+modules = len(sys.modules)
+start = time.perf_counter()
+import {module}
+print(len(sys.modules) - modules, time.perf_counter() - start)
+"""
+
+MOUNT_POLL_INTERVAL = 0.001  # seconds
+MOUNT_TIMEOUT = 60  # seconds
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+CHARYBDISFS = os.path.join(ROOT_DIR, "charybdisfs.py")
+
+
+def measure_import(module: str) -> Tuple[int, float]:
+    """Return number of modules loaded by an import of the module and time of the import in a fresh interpreter."""
+
+    output = subprocess.run([sys.executable, "-c", IMPORT_PROBE.format(module=module)],
+                            cwd=ROOT_DIR, check=True, capture_output=True, text=True).stdout.split()
+    return int(output[0]), float(output[1])
+
+
+def measure_mount(source: str, target: str, args: List[str]) -> float:
+    """Return time from a start of CharybdisFS to the moment when the target is a mount point."""
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, CHARYBDISFS, *args, source, target],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while not os.path.ismount(target):
+            if process.poll() is not None:
+                raise click.ClickException(f"CharybdisFS exited with code {process.returncode}")
+            if time.perf_counter() - start > MOUNT_TIMEOUT:
+                raise click.ClickException(f"{target} is not mounted after {MOUNT_TIMEOUT}s")
+            time.sleep(MOUNT_POLL_INTERVAL)
+        return time.perf_counter() - start
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait()
+
+
+def summary(values: List[float]) -> Dict[str, float]:
+    return {"min": min(values), "median": statistics.median(values), "max": max(values)}
+
+
+@click.command()
+@click.option("--runs", type=int, default=5)
+@click.option("--module", "modules", multiple=True, default=("client", "charybdisfs", ))
+@click.option("--charybdisfs-args", default="--no-rest-api")  # used for the time-to-mounted measurement
+@click.argument("source", type=click.Path(exists=True, dir_okay=True), required=False)
+@click.argument("target", type=click.Path(exists=True, dir_okay=True), required=False)
+def startup_benchmark(runs: int,
+                      modules: Tuple[str, ...],
+                      charybdisfs_args: str,
+                      source: Optional[str],
+                      target: Optional[str]) -> None:
+    """Measure import cost of the entry points and, if SOURCE and TARGET given, time to a mounted CharybdisFS."""
+
+    results = {}
+    for module in modules:
+        measurements = [measure_import(module=module) for _ in range(runs)]
+        results[module] = {"modules": measurements[0][0], "import_time": summary([t for _, t in measurements])}
+    if source and target:
+        results["time_to_mounted"] = \
+            summary([measure_mount(source=source, target=target, args=charybdisfs_args.split()) for _ in range(runs)])
+    json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    startup_benchmark(prog_name="startup_benchmark")
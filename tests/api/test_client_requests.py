@@ -13,10 +13,14 @@
 # limitations under the License.
 
 import errno
+import threading
 
 import pytest
+import requests
 
 from core.faults import LatencyFault, ErrorFault, SysCall
+from core.events import EventStream, FAULT_EVENT
+from core.rest_api import MAX_EVENTS_SUBSCRIBERS
 
 
 pytestmark = pytest.mark.usefixtures("start_api_server")
@@ -54,3 +58,28 @@ def test_get_active_faults(api_client):
 
     assert response.ok and response.text == f'{{"faults_ids": ["{fault_id}"]}}', \
         f"Request failed. Status: {response.status_code}\n Text: {response.text}"
+
+
+def test_stream_events(api_client):
+    threading.Timer(0.5, EventStream.publish, args=(FAULT_EVENT, ), kwargs={"sys_call": "write"}).start()
+    for batch in api_client.stream_events():
+        if batch["events"]:
+            break
+    assert [event["sys_call"] for event in batch["events"]] == ["write", ]
+
+
+def test_too_many_event_streams(api_client):
+    subscribers = [EventStream.subscribe() for _ in range(MAX_EVENTS_SUBSCRIBERS)]
+    try:
+        with pytest.raises(requests.HTTPError) as exc_info:
+            next(api_client.stream_events())
+        assert exc_info.value.response.status_code == 503
+    finally:
+        for subscriber in subscribers:
+            EventStream.unsubscribe(subscriber)
+
+
+@pytest.mark.parametrize("params", [{"seconds": "abc"}, {"seconds": "1", "interval": "abc"}, {"seconds": "0"}])
+def test_profile_bad_parameters(api_client, params):
+    response = requests.get(url=f"{api_client.base_url}/profile", params=params, timeout=api_client.timeout)
+    assert response.status_code == 400
@@ -19,7 +19,9 @@ from core.configuration import Configuration
 
 @pytest.fixture
 def configuration():
-    syscalls_conf = Configuration.syscalls_conf
-    Configuration.syscalls_conf = {}
+    syscalls_conf, mount_faults = Configuration.syscalls_conf, Configuration.mount_faults
+    Configuration.syscalls_conf, Configuration.mount_faults = {}, {}
+    Configuration.compile()
     yield Configuration
-    Configuration.syscalls_conf = syscalls_conf
+    Configuration.syscalls_conf, Configuration.mount_faults = syscalls_conf, mount_faults
+    Configuration.compile()
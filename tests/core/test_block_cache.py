@@ -0,0 +1,124 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import trio
+import pytest
+import pyfuse3
+
+from core.block_cache import BlockCache
+from core.operations import CharybdisOperations
+
+
+DATA = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def backing_fd(tmp_path):
+    fd = os.open(tmp_path / "data", os.O_RDWR | os.O_CREAT)
+    os.write(fd, DATA)
+    yield fd
+    os.close(fd)
+
+
+@pytest.fixture
+def cache():
+    return BlockCache(max_blocks=8, block_size=64, max_read_ahead=4)
+
+
+def test_read(cache, backing_fd):
+    assert cache.read(inode=42, fh=1, fd=backing_fd, off=10, size=100) == DATA[10:110]
+    assert cache.misses == 1
+    assert cache.hits == 1  # both blocks fetched by one backing read
+    assert cache.read(inode=42, fh=1, fd=backing_fd, off=20, size=30) == DATA[20:50]
+    assert cache.misses == 1
+    assert cache.hits == 2
+
+
+def test_read_after_eof(cache, backing_fd):
+    assert cache.read(inode=42, fh=1, fd=backing_fd, off=1000, size=100) == DATA[1000:]
+    assert cache.read(inode=42, fh=1, fd=backing_fd, off=2000, size=100) == b""
+
+
+def test_read_ahead(cache, backing_fd):
+    for off in range(0, 256, 64):
+        assert cache.read(inode=42, fh=1, fd=backing_fd, off=off, size=64) == DATA[off:off + 64]
+    assert cache.read_ahead.get(1).window == 4
+    assert cache.misses == 3  # 0: no window, 64: window=1, 128: hit, 192: window=4
+    assert cache.read_ahead_blocks == 5
+
+
+def test_random_read_resets_read_ahead(cache, backing_fd):
+    cache.read(inode=42, fh=1, fd=backing_fd, off=0, size=64)
+    cache.read(inode=42, fh=1, fd=backing_fd, off=64, size=64)
+    cache.read(inode=42, fh=1, fd=backing_fd, off=512, size=64)
+    assert cache.read_ahead.get(1).window == 0
+    cache.release(fh=1)
+    assert 1 not in cache.read_ahead
+
+
+def test_invalidate(cache, backing_fd):
+    cache.read(inode=42, fh=1, fd=backing_fd, off=0, size=10)
+    os.pwrite(backing_fd, b"new", 0)
+    cache.invalidate(inode=42)
+    assert cache.read(inode=42, fh=1, fd=backing_fd, off=0, size=5) == b"new" + DATA[3:5]
+    assert cache.misses == 2
+
+
+def test_eviction(cache, backing_fd):
+    for off in range(0, 1024, 64):
+        cache.read(inode=42, fh=1, fd=backing_fd, off=off, size=1)  # same fh: no read-ahead for sparse reads
+    assert len(cache.blocks) == 8
+    assert cache.evicted_blocks == 8
+    assert cache.get_stats()["cached_blocks"] == 8
+
+
+def test_open_truncate(tmp_path):
+    (tmp_path / "file").write_bytes(bytes(1000))
+
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path), block_cache=BlockCache(max_blocks=32))
+        ctx = pyfuse3.RequestContext(uid=os.getuid(), gid=os.getgid(), umask=0o022)
+
+        entry_attrs = await operations.lookup(pyfuse3.ROOT_INODE, b"file", ctx)
+        reader = await operations.open(entry_attrs.st_ino, os.O_RDONLY, ctx)
+        assert await operations.read(reader.fh, 0, 100) == bytes(100)  # cached now.
+
+        await operations.open(entry_attrs.st_ino, os.O_WRONLY | os.O_TRUNC, ctx)
+        assert await operations.read(reader.fh, 0, 100) == b""
+
+    trio.run(run)
+
+
+def test_read_during_write(tmp_path, monkeypatch):
+    (tmp_path / "file").write_bytes(b"old")
+    original_pwrite = os.pwrite
+
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path), io_workers=2, block_cache=BlockCache(max_blocks=32))
+        ctx = pyfuse3.RequestContext(uid=os.getuid(), gid=os.getgid(), umask=0o022)
+        entry_attrs = await operations.lookup(pyfuse3.ROOT_INODE, b"file", ctx)
+        fh = (await operations.open(entry_attrs.st_ino, os.O_RDWR, ctx)).fh
+
+        def pwrite(fd, data, off):  # a read in another worker caches the old data before the write.
+            assert trio.from_thread.run(operations.read, fh, 0, 100) == b"old"
+            return original_pwrite(fd, data, off)
+
+        monkeypatch.setattr(os, "pwrite", pwrite)
+        assert await operations.write(fh, 0, b"new") == 3
+        monkeypatch.undo()
+        assert await operations.read(fh, 0, 100) == b"new"
+
+    trio.run(run)
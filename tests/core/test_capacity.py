@@ -0,0 +1,166 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import errno
+
+import trio
+import pytest
+import pyfuse3
+
+from core.capacity import CapacityLimit, get_tree_usage
+from core.operations import CharybdisOperations
+
+
+def test_get_tree_usage(tmp_path):
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "a").write_bytes(bytes(100))
+    (tmp_path / "b").write_bytes(bytes(10))
+    os.link(tmp_path / "b", tmp_path / "c")
+    os.symlink("b", tmp_path / "d")
+    assert get_tree_usage(str(tmp_path)) == 110
+
+
+def test_resize(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(bytes(10))
+    capacity = CapacityLimit(capacity=100, used=10)
+
+    capacity.extend(inode=42, target=str(path), end=5)
+    assert capacity.used == 10
+    capacity.extend(inode=42, target=str(path), end=100)
+    assert capacity.used == 100
+    with pytest.raises(OSError) as exc_info:
+        capacity.extend(inode=42, target=str(path), end=101)
+    assert exc_info.value.errno == errno.ENOSPC
+    capacity.resize(inode=42, target=str(path), size=50)
+    assert capacity.get_stats() == {"capacity": 100, "used": 50, "free": 50, "enospc_errors": 1}
+
+    assert capacity.extend(inode=42, target=str(path), end=80) == 50
+    capacity.rollback(inode=42, end=80, size=60)
+    assert capacity.used == 60
+    capacity.extend(inode=42, target=str(path), end=90)
+    capacity.rollback(inode=42, end=80, size=60)  # resized by another write since then.
+    assert capacity.used == 90
+
+
+def test_operations(tmp_path):
+    (tmp_path / "old").write_bytes(bytes(1000))
+
+    async def run():
+        capacity = CapacityLimit(capacity=4096, used=get_tree_usage(str(tmp_path)))
+        operations = CharybdisOperations(source=str(tmp_path), capacity=capacity)
+        ctx = pyfuse3.RequestContext(uid=os.getuid(), gid=os.getgid(), umask=0o022)
+
+        file_info, entry_attrs = await operations.create(pyfuse3.ROOT_INODE, b"new", 0o644, os.O_WRONLY, ctx)
+        assert await operations.write(file_info.fh, 0, bytes(3000)) == 3000
+        assert capacity.used == 4000
+        assert (await operations.getattr(entry_attrs.st_ino, ctx)).st_size == 3000
+
+        with pytest.raises(pyfuse3.FUSEError) as exc_info:
+            await operations.write(file_info.fh, 3000, bytes(100))
+        assert exc_info.value.errno == errno.ENOSPC
+        assert await operations.write(file_info.fh, 0, bytes(100)) == 100  # overwrite doesn't need space.
+
+        statvfs_data = await operations.statfs(ctx)
+        assert statvfs_data.f_blocks * statvfs_data.f_frsize <= 4096
+        assert statvfs_data.f_bfree == 96 // statvfs_data.f_frsize
+
+        await operations.lookup(pyfuse3.ROOT_INODE, b"old", ctx)
+        await operations.unlink(pyfuse3.ROOT_INODE, b"old", ctx)
+        assert capacity.used == 3000
+
+        await operations.unlink(pyfuse3.ROOT_INODE, b"new", ctx)
+        assert capacity.used == 3000  # still open.
+        await operations.release(file_info.fh)
+        assert capacity.used == 0
+        assert operations.get_stats()["capacity"] == {"capacity": 4096, "used": 0, "free": 4096, "enospc_errors": 1}
+
+    trio.run(run)
+
+
+def test_open_truncate(tmp_path):
+    (tmp_path / "file").write_bytes(bytes(1000))
+
+    async def run():
+        capacity = CapacityLimit(capacity=4096, used=get_tree_usage(str(tmp_path)))
+        operations = CharybdisOperations(source=str(tmp_path), capacity=capacity)
+        ctx = pyfuse3.RequestContext(uid=os.getuid(), gid=os.getgid(), umask=0o022)
+
+        entry_attrs = await operations.lookup(pyfuse3.ROOT_INODE, b"file", ctx)
+        writer = await operations.open(entry_attrs.st_ino, os.O_WRONLY | os.O_TRUNC, ctx)
+        assert capacity.used == 0
+        assert await operations.write(writer.fh, 0, bytes(4000)) == 4000
+        assert capacity.used == 4000
+
+    trio.run(run)
+
+
+def test_create_over_existent_file(tmp_path):
+    (tmp_path / "file").write_bytes(bytes(1000))
+
+    async def run():
+        capacity = CapacityLimit(capacity=4096, used=get_tree_usage(str(tmp_path)))
+        operations = CharybdisOperations(source=str(tmp_path), capacity=capacity)
+        ctx = pyfuse3.RequestContext(uid=os.getuid(), gid=os.getgid(), umask=0o022)
+        await operations.create(pyfuse3.ROOT_INODE, b"file", 0o644, os.O_WRONLY, ctx)
+        assert capacity.used == 0
+
+    trio.run(run)
+
+
+def test_failed_write_releases_space(tmp_path, monkeypatch):
+    def pwrite(fd, buf, off):
+        raise OSError(errno.EIO, os.strerror(errno.EIO))
+
+    async def run():
+        capacity = CapacityLimit(capacity=4096)
+        operations = CharybdisOperations(source=str(tmp_path), capacity=capacity)
+        ctx = pyfuse3.RequestContext(uid=os.getuid(), gid=os.getgid(), umask=0o022)
+        file_info, _ = await operations.create(pyfuse3.ROOT_INODE, b"file", 0o644, os.O_WRONLY, ctx)
+        await operations.write(file_info.fh, 0, bytes(100))
+        monkeypatch.setattr(os, "pwrite", pwrite)
+        with pytest.raises(pyfuse3.FUSEError):
+            await operations.write(file_info.fh, 100, bytes(1000))
+        assert capacity.used == 100
+
+    trio.run(run)
+
+
+@pytest.mark.parametrize("size", [0, 3000])
+def test_failed_truncate(tmp_path, monkeypatch, size):
+    (tmp_path / "file").write_bytes(bytes(1000))
+
+    def failing_truncate(path, length):
+        raise OSError(errno.EPERM, os.strerror(errno.EPERM))
+
+    async def run():
+        capacity = CapacityLimit(capacity=4096, used=get_tree_usage(str(tmp_path)))
+        operations = CharybdisOperations(source=str(tmp_path), capacity=capacity)
+        ctx = pyfuse3.RequestContext(uid=os.getuid(), gid=os.getgid(), umask=0o022)
+        entry_attrs = await operations.lookup(pyfuse3.ROOT_INODE, b"file", ctx)
+
+        monkeypatch.setattr(os, "truncate", failing_truncate)
+        with pytest.raises(pyfuse3.FUSEError) as exc_info:
+            await operations.setattr(entry_attrs.st_ino, pyfuse3.EntryAttributes(st_size=size),
+                                     pyfuse3.SetattrFields(update_size=True), None, ctx)
+        assert exc_info.value.errno == errno.EPERM
+        assert capacity.used == 1000
+        monkeypatch.undo()
+
+        await operations.setattr(entry_attrs.st_ino, pyfuse3.EntryAttributes(st_size=size),
+                                 pyfuse3.SetattrFields(update_size=True), None, ctx)
+        assert capacity.used == size
+
+    trio.run(run)
@@ -64,6 +64,20 @@ def test_add_fault(configuration):
     assert configuration.syscalls_conf == {fault1_uuid: fault1, fault2_uuid: fault2, fault3_uuid: fault4, }
 
 
+def test_add_targeted_faults(configuration):
+    configuration.add_fault(fault_id=new_uuid(),
+                            fault=ErrorFault(sys_call=SysCall.WRITE, probability=100, error_no=errno.EIO, pids=[1, 2]))
+    configuration.add_fault(fault_id=new_uuid(),
+                            fault=ErrorFault(sys_call=SysCall.WRITE, probability=100, error_no=errno.EIO, pids=[3]))
+
+    # Faults which can match the same process.
+    for target in ({"pids": [2, 3]}, {"comms": ["backup"]}, {}):
+        with pytest.raises(ValueError):
+            configuration.add_fault(fault_id=new_uuid(),
+                                    fault=ErrorFault(sys_call=SysCall.WRITE, probability=1, error_no=errno.EIO, **target))
+    assert len(configuration.syscalls_conf) == 2
+
+
 def test_remove_fault(configuration):
     fault_uuid = new_uuid()
     fault = ErrorFault(sys_call=SysCall.WRITE, probability=100, error_no=errno.ENOSPC)
@@ -93,8 +107,71 @@ def test_get_faults_by_sys_call(configuration):
     configuration.add_fault(fault_id=fault1_uuid, fault=fault1)
     configuration.add_fault(fault_id=fault2_uuid, fault=fault2)
     configuration.add_fault(fault_id=fault3_uuid, fault=fault3)
-    assert configuration.get_faults_by_sys_call(sys_call=SysCall.WRITE) == [fault1, fault3]
-    assert configuration.get_faults_by_sys_call(sys_call=SysCall.READ) == [fault2, fault3]
-    assert configuration.get_faults_by_sys_call(sys_call=SysCall.ALL) == [fault3]
+    assert configuration.get_faults_by_sys_call(sys_call=SysCall.WRITE) == (fault1, fault3)
+    assert configuration.get_faults_by_sys_call(sys_call=SysCall.READ) == (fault2, fault3)
+    assert configuration.get_faults_by_sys_call(sys_call=SysCall.ALL) == (fault3, )
     assert configuration.get_all_faults() == [fault1, fault2, fault3]
     assert configuration.get_all_faults_ids() == [fault1_uuid, fault2_uuid, fault3_uuid]
+    assert configuration.get_fault_id(fault=fault2) == fault2_uuid
+
+    configuration.remove_fault(fault_id=fault2_uuid)
+    assert configuration.get_faults_by_sys_call(sys_call=SysCall.READ) == (fault3, )
+    assert configuration.get_fault_id(fault=fault2) is None
+
+
+def test_mount_faults(configuration):
+    global_fault_uuid = new_uuid()
+    mount1_fault_uuid = new_uuid()
+    mount2_fault_uuid = new_uuid()
+    global_fault = ErrorFault(sys_call=SysCall.WRITE, probability=50, error_no=errno.ENOSPC)
+    mount1_fault = ErrorFault(sys_call=SysCall.WRITE, probability=50, error_no=errno.EIO)
+    mount2_fault = ErrorFault(sys_call=SysCall.ALL, probability=40, error_no=errno.EIO)
+    configuration.add_fault(fault_id=global_fault_uuid, fault=global_fault)
+    configuration.add_fault(fault_id=mount1_fault_uuid, fault=mount1_fault, mount_id="mount1")
+    configuration.add_fault(fault_id=mount2_fault_uuid, fault=mount2_fault, mount_id="mount2")
+    assert configuration.get_faults_by_sys_call(sys_call=SysCall.WRITE) == (global_fault, )
+    assert configuration.get_faults_by_sys_call(sys_call=SysCall.WRITE, mount_id="mount1") == \
+           (global_fault, mount1_fault)
+    assert configuration.get_faults_by_sys_call(sys_call=SysCall.WRITE, mount_id="mount2") == \
+           (global_fault, mount2_fault)
+    assert configuration.get_faults_by_sys_call(sys_call=SysCall.WRITE, mount_id="mount3") == (global_fault, )
+    assert configuration.get_mount_id(mount1_fault_uuid) == "mount1"
+    assert configuration.get_mount_id(global_fault_uuid) is None
+
+    # Global fault exceeds probability for mount1.
+    with pytest.raises(ValueError):
+        configuration.add_fault(fault_id=new_uuid(),
+                                fault=ErrorFault(sys_call=SysCall.WRITE, probability=1, error_no=errno.EIO))
+
+    # Other mounts are not affected by mount1 faults.
+    configuration.add_fault(fault_id=new_uuid(),
+                            fault=ErrorFault(sys_call=SysCall.WRITE, probability=10, error_no=errno.EIO),
+                            mount_id="mount2")
+
+    assert configuration.remove_fault(fault_id=mount1_fault_uuid) == mount1_fault
+    assert configuration.get_mount_id(mount1_fault_uuid) is None
+
+
+def test_listeners(configuration):
+    calls = []
+    configuration.listeners.append(lambda: calls.append(len(configuration.syscalls_conf)))
+    try:
+        fault_uuid = new_uuid()
+        configuration.add_fault(fault_id=fault_uuid,
+                                fault=ErrorFault(sys_call=SysCall.WRITE, probability=10, error_no=errno.EIO))
+        configuration.remove_fault(fault_id=fault_uuid)
+        configuration.remove_fault(fault_id=fault_uuid)
+    finally:
+        configuration.listeners.pop()
+    assert calls == [1, 0]
+
+
+def test_replace_all_faults_keeps_stats(configuration):
+    fault_uuid = new_uuid()
+    configuration.add_fault(fault_id=fault_uuid,
+                            fault=ErrorFault(sys_call=SysCall.WRITE, probability=10, error_no=errno.EIO))
+    configuration.get_fault_by_uuid(fault_uuid).stats.fired(nbytes=10)
+
+    fault = ErrorFault(sys_call=SysCall.WRITE, probability=10, error_no=errno.EIO)
+    configuration.replace_all_faults(faults={fault_uuid: fault}, mount_faults={})
+    assert configuration.get_all_faults_stats()[fault_uuid]["hits"] == 1
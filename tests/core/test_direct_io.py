@@ -0,0 +1,61 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import mmap
+import ctypes
+
+import pytest
+
+from core.direct_io import AlignedBufferPool
+
+
+@pytest.fixture
+def pool():
+    return AlignedBufferPool(size=2, buffer_size=mmap.PAGESIZE)
+
+
+@pytest.fixture
+def backing_fd(tmp_path):
+    fd = os.open(tmp_path / "data", os.O_RDWR | os.O_CREAT)
+    yield fd
+    os.close(fd)
+
+
+def test_buffers_are_aligned(pool):
+    with pool.buffer() as buf:
+        assert ctypes.addressof(ctypes.c_char.from_buffer(buf)) % mmap.PAGESIZE == 0
+
+
+def test_buffers_are_reused(pool):
+    with pool.buffer() as buf1:
+        pass
+    with pool.buffer() as buf2:
+        assert buf1 is buf2
+    assert pool.extra_allocations == 0
+
+
+def test_exhausted_pool(pool):
+    with pool.buffer(), pool.buffer(), pool.buffer():
+        assert not pool.free
+    assert pool.extra_allocations == 1
+    assert len(pool.free) == 2
+
+
+def test_write_and_read(pool, backing_fd):
+    data = os.urandom(mmap.PAGESIZE * 3)
+    assert pool.write(fd=backing_fd, off=mmap.PAGESIZE, data=data) == len(data)
+    assert pool.read(fd=backing_fd, off=mmap.PAGESIZE, size=len(data)) == data
+    assert pool.read(fd=backing_fd, off=0, size=mmap.PAGESIZE * 8) == bytes(mmap.PAGESIZE) + data
+    assert pool.get_stats() == {"requests": 3, "extra_allocations": 0, "free_buffers": 2}
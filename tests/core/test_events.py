@@ -0,0 +1,85 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+
+import trio
+import pytest
+import pyfuse3
+
+from core.faults import ErrorFault, SysCall
+from core.events import EventStream, FAULT_EVENT, SYSCALL_ERROR_EVENT
+from core.operations import CharybdisOperations
+from core.configuration import generate_fault_id
+
+
+@pytest.fixture
+def subscriber():
+    subscriber = EventStream.subscribe(queue_size=3)
+    yield subscriber
+    EventStream.unsubscribe(subscriber)
+
+
+def test_publish(subscriber):
+    EventStream.publish(FAULT_EVENT, sys_call="write", fault_id="id")
+    EventStream.publish(SYSCALL_ERROR_EVENT, sys_call="read", errno=5)
+
+    batch = subscriber.get_batch(timeout=0)
+    assert batch["dropped"] == 0
+    assert [(event["type"], event["sys_call"]) for event in batch["events"]] == \
+        [(FAULT_EVENT, "write"), (SYSCALL_ERROR_EVENT, "read"), ]
+    assert batch["events"][0]["timestamp"] <= batch["events"][1]["timestamp"]
+
+    assert subscriber.get_batch(timeout=0) == {"events": [], "dropped": 0}
+
+
+def test_slow_subscriber(subscriber):
+    for index in range(5):
+        EventStream.publish(FAULT_EVENT, index=index)
+    assert subscriber.get_batch(max_size=2, timeout=0)["dropped"] == 2
+    assert [event["index"] for event in subscriber.get_batch(timeout=0)["events"]] == [2, ]
+
+    EventStream.publish(FAULT_EVENT, index=5)
+    batch = subscriber.get_batch(timeout=0)
+    assert [event["index"] for event in batch["events"]] == [5, ]
+    assert batch["dropped"] == 0
+
+
+def test_unsubscribe(subscriber):
+    EventStream.unsubscribe(subscriber)
+    EventStream.publish(FAULT_EVENT)
+    assert subscriber.get_batch(timeout=0)["events"] == []
+
+
+def test_fault_event_built_for_subscribers_only(configuration, tmp_path, monkeypatch):
+    fault_id = generate_fault_id()
+    configuration.add_fault(fault_id=fault_id,
+                            fault=ErrorFault(sys_call=SysCall.GETATTR, probability=100, error_no=errno.EIO))
+    operations = CharybdisOperations(source=str(tmp_path))
+
+    async def getattr():
+        with pytest.raises(pyfuse3.FUSEError):
+            await operations.getattr(pyfuse3.ROOT_INODE, pyfuse3.RequestContext())
+
+    with monkeypatch.context() as patch:
+        patch.setattr(ErrorFault, "to_dict", lambda fault: pytest.fail("the event is built without subscribers"))
+        trio.run(getattr)
+
+    subscriber = EventStream.subscribe()
+    try:
+        trio.run(getattr)
+        events = subscriber.get_batch(timeout=0)["events"]
+    finally:
+        EventStream.unsubscribe(subscriber)
+    assert [(event["type"], event.get("fault_id")) for event in events] == [(FAULT_EVENT, fault_id), ]
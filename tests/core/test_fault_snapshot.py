@@ -0,0 +1,89 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import errno
+
+import pytest
+
+from core.faults import ErrorFault, LatencyFault, SysCall, Status
+from core.configuration import MountID, generate_fault_id as new_uuid
+from core.fault_snapshot import \
+    FaultSnapshotWriter, FaultSnapshotReader, FaultRecord, SEQUENCE, SEQUENCE_OFFSET, SCOPE_PIDS, SCOPE_NAMES
+
+
+@pytest.fixture
+def snapshot_writer(configuration, tmp_path):
+    writer = FaultSnapshotWriter(path=str(tmp_path / "snapshot"), capacity=4)
+    configuration.listeners.append(writer)
+    yield writer
+    configuration.listeners.remove(writer)
+    writer.close()
+
+
+def test_publish(configuration, snapshot_writer):
+    reader = FaultSnapshotReader(path=snapshot_writer.path)
+    assert reader.read() == (0, [])
+
+    fault1_uuid, fault2_uuid, mount_id = new_uuid(), new_uuid(), MountID(new_uuid())
+    configuration.add_fault(fault_id=fault1_uuid,
+                            fault=ErrorFault(sys_call=SysCall.WRITE, probability=10, error_no=errno.ENOSPC))
+    configuration.add_fault(fault_id=fault2_uuid,
+                            fault=LatencyFault(sys_call=SysCall.ALL, probability=20, delay=1.5),
+                            mount_id=mount_id)
+    assert reader.get_generation() == 2
+    assert reader.read() == (2, [
+        FaultRecord(fault_id=fault1_uuid, mount_id=None, fault_type="ErrorFault", sys_call=SysCall.WRITE,
+                    probability=10, status=Status.NEW, error_no=errno.ENOSPC),
+        FaultRecord(fault_id=fault2_uuid, mount_id=mount_id, fault_type="LatencyFault", sys_call=SysCall.ALL,
+                    probability=20, status=Status.NEW, delay=1.5),
+    ])
+
+    configuration.remove_fault(fault_id=fault1_uuid)
+    assert [fault.fault_id for fault in reader.read().faults] == [fault2_uuid, ]
+    assert reader.get_generation() == 3
+
+
+def test_targeted_and_conditional_faults(configuration, snapshot_writer):
+    fault_uuid = new_uuid()
+    configuration.add_fault(fault_id=fault_uuid,
+                            fault=ErrorFault(sys_call=SysCall.WRITE, probability=10, error_no=errno.EIO,
+                                             pids=[42], offset_min=4096, size_max=512, flags=os.O_DIRECT,
+                                             names=["*.db"]))
+    record, = FaultSnapshotReader(path=snapshot_writer.path).read().faults
+    assert record == FaultRecord(fault_id=fault_uuid, mount_id=None, fault_type="ErrorFault", sys_call=SysCall.WRITE,
+                                 probability=10, status=Status.NEW, error_no=errno.EIO, scope=SCOPE_PIDS | SCOPE_NAMES,
+                                 offset_min=4096, size_max=512, flags=os.O_DIRECT)
+    assert record.targeted
+
+
+def test_capacity(configuration, snapshot_writer):
+    for _ in range(6):
+        configuration.add_fault(fault_id=new_uuid(),
+                                fault=ErrorFault(sys_call=SysCall.READ, probability=1, error_no=errno.EIO))
+    assert len(FaultSnapshotReader(path=snapshot_writer.path).read().faults) == 4
+
+
+def test_update_in_progress(snapshot_writer):
+    reader = FaultSnapshotReader(path=snapshot_writer.path)
+    SEQUENCE.pack_into(snapshot_writer.mmap, SEQUENCE_OFFSET, 1)
+    with pytest.raises(RuntimeError):
+        reader.read()
+
+
+def test_not_a_snapshot(tmp_path):
+    path = tmp_path / "garbage"
+    path.write_bytes(bytes(4096))
+    with pytest.raises(ValueError):
+        FaultSnapshotReader(path=str(path))
@@ -12,19 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import errno
 from unittest.mock import patch
 
+import trio
 import pytest
 import pyfuse3
 
-from core.faults import LatencyFault, ErrorFault, SysCall, Status, create_fault_from_dict
+from core.faults import LatencyFault, ErrorFault, SysCall, Status, FaultStats, Caller, Call, create_fault_from_dict
 
 
 def test_latency_fault_to_dict():
     assert LatencyFault(sys_call=SysCall.ALL, probability=50).to_dict() == \
-           {"fault_type": "LatencyFault", "sys_call": "*", "probability": 50, "status": "new", "delay": 0}
+           {"fault_type": "LatencyFault", "sys_call": "*", "probability": 50, "status": "new", "delay": 0,
+            "pids": None, "uids": None, "comms": None,
+            "offset_min": None, "offset_max": None, "size_min": None, "size_max": None, "flags": None, "names": None,
+            "stats": {"evaluations": 0, "hits": 0, "affected_bytes": 0, "first_fired": None, "last_fired": None}}
     assert LatencyFault(sys_call=SysCall.WRITE, probability=75, delay=1000).to_dict() == \
-           {"fault_type": "LatencyFault", "sys_call": "write", "probability": 75, "status": "new", "delay": 1000}
+           {"fault_type": "LatencyFault", "sys_call": "write", "probability": 75, "status": "new", "delay": 1000,
+            "pids": None, "uids": None, "comms": None,
+            "offset_min": None, "offset_max": None, "size_min": None, "size_max": None, "flags": None, "names": None,
+            "stats": {"evaluations": 0, "hits": 0, "affected_bytes": 0, "first_fired": None, "last_fired": None}}
 
 
 def test_latency_fault_from_dict():
@@ -49,14 +58,104 @@ def test_latency_fault_apply():
     assert fault.status == Status.APPLIED
 
 
+def test_latency_fault_apply_async():
+    fault = LatencyFault(sys_call=SysCall.WRITE, probability=50, delay=60e6)
+
+    async def apply():
+        with trio.move_on_after(0.01) as cancel_scope:
+            await fault.apply_async(nbytes=100)
+        return cancel_scope.cancelled_caught
+
+    assert trio.run(apply)
+    assert fault.status == Status.APPLIED
+    assert fault.stats.hits == 1
+
+
 def test_latency_fault_to_dict_and_back():
     fault = LatencyFault(sys_call=SysCall.WRITE, probability=50, delay=666)
     assert fault == create_fault_from_dict(fault.to_dict())
 
 
+def test_targeted_fault():
+    fault = ErrorFault(sys_call=SysCall.WRITE, probability=100, error_no=666, pids=[3, 1], comms=["backup"])
+    assert fault.targeted
+    assert fault.to_dict()["pids"] == [1, 3]
+    assert fault.to_dict()["uids"] is None
+    assert fault.to_dict()["comms"] == ["backup"]
+    assert fault == create_fault_from_dict(fault.to_dict())
+
+    assert fault.matches(Caller(pid=1, uid=0, gid=0))
+    assert not fault.matches(Caller(pid=2, uid=0, gid=0))
+    assert not fault.matches(None)
+    with patch("core.faults.get_comm", return_value="backup"):
+        assert fault.matches(Caller(pid=2, uid=0, gid=0))
+
+    untargeted = ErrorFault(sys_call=SysCall.WRITE, probability=100, error_no=666)
+    assert not untargeted.targeted
+    assert untargeted.matches(None)
+
+
+def test_conditional_fault():
+    fault = ErrorFault(sys_call=SysCall.WRITE, probability=100, error_no=errno.EIO,
+                       offset_min=4096, size_min=1024 * 1024, flags="O_DIRECT|O_SYNC", names=["*.db", "manifest"])
+    assert fault.conditional
+    assert fault.flags == os.O_DIRECT | os.O_SYNC
+    assert fault.check(Call(offset=4096, size=1024 * 1024, flags=fault.flags | os.O_WRONLY, name="data.db"))
+    assert fault.check(Call(offset=8192, size=2 * 1024 * 1024, flags=fault.flags, name="manifest"))
+    assert not fault.check(Call(offset=0, size=1024 * 1024, flags=fault.flags, name="data.db"))
+    assert not fault.check(Call(offset=4096, size=4096, flags=fault.flags, name="data.db"))
+    assert not fault.check(Call(offset=4096, size=1024 * 1024, flags=os.O_DIRECT, name="data.db"))
+    assert not fault.check(Call(offset=4096, size=1024 * 1024, flags=fault.flags, name="commit.log"))
+    assert not fault.check(Call(offset=4096, size=1024 * 1024, flags=fault.flags))  # not applicable to the call
+
+    offsets = ErrorFault(sys_call=SysCall.READ, probability=100, error_no=errno.EIO, offset_min=10, offset_max=20)
+    assert [offsets.check(Call(offset=offset)) for offset in (9, 10, 19, 20)] == [False, True, True, False]
+
+    unconditional = ErrorFault(sys_call=SysCall.WRITE, probability=100, error_no=errno.EIO)
+    assert not unconditional.conditional
+    assert unconditional.check(Call())
+
+    data = fault.to_dict()
+    assert data["names"] == ["*.db", "manifest"]
+    assert "_predicate" not in data
+    restored = create_fault_from_dict(data)
+    assert restored == fault
+    assert restored.check(Call(offset=4096, size=1024 * 1024, flags=fault.flags, name="data.db"))
+
+    assert create_fault_from_dict({**data, "flags": ["O_UNKNOWN"]}) is None
+    assert create_fault_from_dict({**data, "offset_max": 0}) is None
+
+
+def test_conditional_fault_in_operations(tmp_path):
+    from core.operations import CharybdisOperations
+    from core.configuration import Configuration, generate_fault_id
+
+    fault_id = generate_fault_id()
+    Configuration.add_fault(fault_id=fault_id, fault=ErrorFault(sys_call=SysCall.WRITE, probability=100,
+                                                                error_no=errno.EIO, size_min=4096, names=["*.db"]))
+
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path))
+        ctx = pyfuse3.RequestContext()
+        db_file, _ = await operations.create(pyfuse3.ROOT_INODE, b"data.db", 0o644, os.O_WRONLY, ctx)
+        log_file, _ = await operations.create(pyfuse3.ROOT_INODE, b"commit.log", 0o644, os.O_WRONLY, ctx)
+        assert await operations.write(log_file.fh, 0, bytes(8192)) == 8192
+        assert await operations.write(db_file.fh, 0, bytes(100)) == 100
+        with pytest.raises(pyfuse3.FUSEError):
+            await operations.write(db_file.fh, 100, bytes(8192))
+
+    try:
+        trio.run(run)
+    finally:
+        Configuration.remove_fault(fault_id=fault_id)
+
+
 def test_error_fault_to_dict():
     assert ErrorFault(sys_call=SysCall.ALL, probability=50, error_no=666).to_dict() == \
-           {"fault_type": "ErrorFault", "sys_call": "*", "probability": 50, "status": "new", "error_no": 666}
+           {"fault_type": "ErrorFault", "sys_call": "*", "probability": 50, "status": "new", "error_no": 666,
+            "pids": None, "uids": None, "comms": None,
+            "offset_min": None, "offset_max": None, "size_min": None, "size_max": None, "flags": None, "names": None,
+            "stats": {"evaluations": 0, "hits": 0, "affected_bytes": 0, "first_fired": None, "last_fired": None}}
 
 
 def test_error_fault_from_dict():
@@ -90,3 +189,19 @@ def test_unknown_fault_from_dict():
 def test_error_fault_to_dict_and_back():
     fault = ErrorFault(sys_call=SysCall.ALL, probability=100, error_no=8)
     assert fault == create_fault_from_dict(fault.to_dict())
+
+
+def test_fault_stats():
+    fault = ErrorFault(sys_call=SysCall.WRITE, probability=100, error_no=8)
+    for nbytes in (10, 20):
+        with pytest.raises(pyfuse3.FUSEError):
+            fault.apply(nbytes=nbytes)
+    assert fault.stats.hits == 2
+    assert fault.stats.affected_bytes == 30
+    assert fault.stats.first_fired <= fault.stats.last_fired
+
+
+def test_fault_stats_to_dict_and_back():
+    fault = LatencyFault(sys_call=SysCall.WRITE, probability=50, delay=666)
+    fault.stats = FaultStats(evaluations=100, hits=50, affected_bytes=4096, first_fired=1.0, last_fired=2.0)
+    assert create_fault_from_dict(fault.to_dict()).stats == fault.stats
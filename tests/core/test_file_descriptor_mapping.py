@@ -12,9 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import errno
+import threading
+
+import trio
 import pytest
+import pyfuse3
 
-from core.operations import FileDescriptorMapping
+from core.operations import FileDescriptorMapping, CharybdisOperations
 
 
 @pytest.fixture
@@ -25,57 +31,140 @@ def mapping():
 def test_get_from_empty(mapping):
     with pytest.raises(KeyError):
         return mapping[42]
+    assert mapping.get_fd_by_inode(42) is None
+
+
+def test_add(mapping):
+    fh = mapping.add(inode=42, fd=100500, flags=os.O_RDONLY)
+    assert mapping[fh].inode == 42
+    assert mapping[fh].fd == 100500
+    assert mapping[fh].flags == os.O_RDONLY
+    assert list(mapping.inodes[42]) == [fh]
+    assert mapping.get_fd_by_inode(42) == 100500
+
+
+def test_add_same_inode_twice(mapping):
+    fh1 = mapping.add(inode=42, fd=100500, flags=os.O_RDONLY)
+    fh2 = mapping.add(inode=42, fd=100501, flags=os.O_WRONLY | os.O_APPEND)
+    assert fh1 != fh2
+    assert mapping[fh1].fd == 100500
+    assert mapping[fh2].fd == 100501
+    assert mapping[fh2].flags == os.O_WRONLY | os.O_APPEND
+    assert list(mapping.inodes[42]) == [fh1, fh2]
+    assert mapping.get_fd_by_inode(42) == 100500
+
+
+def test_release(mapping):
+    fh1 = mapping.add(inode=42, fd=100500, flags=os.O_RDONLY)
+    fh2 = mapping.add(inode=42, fd=100501, flags=os.O_RDWR)
+
+    open_file = mapping.release(fh1)
+    assert open_file.inode == 42
+    assert open_file.fd == 100500
+    assert fh1 not in mapping
+    assert list(mapping.inodes[42]) == [fh2]
+    assert mapping.get_fd_by_inode(42) == 100501
+
+    mapping.release(fh2)
+    assert fh2 not in mapping
+    assert 42 not in mapping.inodes
+    assert mapping.get_fd_by_inode(42) is None
 
+    with pytest.raises(KeyError):
+        mapping.release(fh2)
 
-def test_set_once(mapping):
-    mapping[42] = 100500
-    assert mapping[42] == 100500
-    assert mapping.inodes[100500] == 42
-    assert mapping.open_counters[100500] == 1
-
-
-def test_set_twice(mapping):
-    mapping[42] = 100500
-    with pytest.raises(ValueError):
-        mapping[42] = 100500
-    assert mapping[42] == 100500
-    assert mapping.inodes[100500] == 42
-    assert mapping.open_counters[100500] == 1
-
-
-def test_del(mapping):
-    mapping[42] = 100500
-
-    del mapping[42]
-    assert 42 not in mapping
-    assert 100500 not in mapping.inodes
-    assert 100500 not in mapping.open_counters
-
-
-def test_acquire_release(mapping):
-    mapping[42] = 100500
-
-    mapping.acquire(100500)
-    assert mapping[42] == 100500
-    assert mapping.inodes[100500] == 42
-    assert mapping.open_counters[100500] == 2
-
-    assert not mapping.release(100500)
-    assert mapping[42] == 100500
-    assert mapping.inodes[100500] == 42
-    assert mapping.open_counters[100500] == 1
-
-    assert mapping.release(100500)
-    assert 42 not in mapping
-    assert 100500 not in mapping.inodes
-    assert 100500 not in mapping.open_counters
-
-
-def test_acquire_by_inode(mapping):
-    assert mapping.acquire_by_inode(42) is None
-    assert 42 not in mapping
-    assert 42 not in mapping.inodes
 
-    mapping[42] = 100500
-    assert mapping.acquire_by_inode(42) == 100500
-    assert mapping.open_counters[100500] == 2
+@pytest.fixture
+def files(tmp_path):
+    inodes = []
+    for index in range(4):
+        path = tmp_path / f"file{index}"
+        path.write_bytes(b"%d" % index)
+        inodes.append(os.lstat(path).st_ino)
+    return inodes
+
+
+def test_lazy_reopen(tmp_path, files):
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path), max_backing_fds=2)
+        ctx = pyfuse3.RequestContext()
+        handles = []
+        for index, inode in enumerate(files):
+            await operations.lookup(pyfuse3.ROOT_INODE, b"file%d" % index, ctx)
+            handles.append((await operations.open(inode, os.O_RDWR | os.O_APPEND, ctx)).fh)
+        assert [operations.descriptors[fh].fd is None for fh in handles] == [True, True, False, False]
+
+        assert await operations.read(handles[0], 0, 10) == b"0"
+        assert await operations.write(handles[1], 0, b"!") == 1  # O_APPEND is kept.
+        assert (tmp_path / "file1").read_bytes() == b"1!"
+        assert [operations.descriptors[fh].fd is None for fh in handles] == [False, False, True, True]
+
+        await operations.rename(pyfuse3.ROOT_INODE, b"file2", pyfuse3.ROOT_INODE, b"renamed", 0, ctx)
+        assert await operations.read(handles[2], 0, 10) == b"2"
+
+        await operations.unlink(pyfuse3.ROOT_INODE, b"file3", ctx)
+        with pytest.raises(pyfuse3.FUSEError) as exc_info:
+            await operations.read(handles[3], 0, 10)
+        assert exc_info.value.errno == errno.ESTALE
+
+        for fh in handles:
+            await operations.release(fh)
+        assert operations.get_stats()["backing_fds"] == \
+            {"open_fds": 0, "max_fds": 2, "hits": 0, "reopens": 3, "reopen_errors": 1, "evictions": 5}
+
+    trio.run(run)
+
+
+def test_unlinked_file_kept_open(tmp_path, files):
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path), max_backing_fds=1)
+        ctx = pyfuse3.RequestContext()
+        await operations.lookup(pyfuse3.ROOT_INODE, b"file0", ctx)
+        await operations.lookup(pyfuse3.ROOT_INODE, b"file1", ctx)
+        fh = (await operations.open(files[0], os.O_RDONLY, ctx)).fh
+        await operations.unlink(pyfuse3.ROOT_INODE, b"file0", ctx)
+        other_fh = (await operations.open(files[1], os.O_RDONLY, ctx)).fh
+        assert await operations.read(fh, 0, 10) == b"0"  # can't be reopened, so it's not closed.
+        await operations.release(fh)
+        await operations.release(other_fh)
+
+    trio.run(run)
+
+
+def test_cancelled_read_keeps_fd_open(tmp_path, files, monkeypatch):
+    started, resume = trio.Event(), threading.Event()
+    read_fds = []
+    pread = os.pread
+
+    def blocked_pread(fd, size, off):
+        read_fds.append(fd)
+        trio.from_thread.run_sync(started.set)
+        resume.wait()
+        return pread(fd, size, off)
+
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path), io_workers=1)
+        ctx = pyfuse3.RequestContext()
+        await operations.lookup(pyfuse3.ROOT_INODE, b"file0", ctx)
+        fh = (await operations.open(files[0], os.O_RDONLY, ctx)).fh
+        open_file = operations.descriptors[fh]
+        monkeypatch.setattr(os, "pread", blocked_pread)
+        with trio.move_on_after(5) as cancel_scope:
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(operations.read, fh, 0, 10)
+                await started.wait()
+                nursery.cancel_scope.cancel()
+        assert not cancel_scope.cancelled_caught
+
+        await operations.release(fh)
+        assert open_file.fd is not None  # the worker still reads it.
+        os.fstat(read_fds[0])
+        resume.set()
+        while open_file.fd is not None:
+            await trio.sleep(0.01)
+        with pytest.raises(OSError) as exc_info:
+            with operations.descriptors.pin(open_file):
+                pass
+        assert exc_info.value.errno == errno.EBADF
+
+    trio.run(run)
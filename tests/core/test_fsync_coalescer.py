@@ -0,0 +1,122 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import errno
+
+import trio
+import trio.testing
+import pytest
+import pyfuse3
+
+from core.operations import CharybdisOperations
+from core.fsync_coalescer import FsyncCoalescer
+
+
+def test_late_arrivals_wait_for_next_batch():
+    coalescer = FsyncCoalescer()
+    backing_fsyncs = []
+    results = []
+
+    async def sync(datasync):
+        backing_fsyncs.append(datasync)
+        await trio.sleep(0.05)
+
+    async def fsync(inode, datasync):
+        await coalescer.fsync(inode=inode, datasync=datasync, sync=sync)
+        results.append(inode)
+
+    async def run():
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(fsync, 1, True)
+            await trio.sleep(0.01)  # the first backing fsync is in flight now.
+            for datasync in (True, False, True, True, True):
+                nursery.start_soon(fsync, 1, datasync)
+            nursery.start_soon(fsync, 2, True)  # other inodes aren't affected.
+
+    trio.run(run)
+    assert results.count(1) == 6
+    assert backing_fsyncs == [True, True, False]  # the second batch has a caller which asked for a full fsync.
+    assert coalescer.inodes == {}
+    assert coalescer.get_stats() == {
+        "calls": 7,
+        "backing_fsyncs": 3,
+        "max_batch_size": 5,
+        "batch_sizes": {"<=1": 2, "<=8": 1},
+    }
+
+
+def test_error_reported_to_batch():
+    coalescer = FsyncCoalescer()
+    errors = []
+
+    async def sync(datasync):
+        await trio.sleep(0.01)
+        raise OSError(errno.EIO, os.strerror(errno.EIO))
+
+    async def fsync():
+        try:
+            await coalescer.fsync(inode=1, datasync=False, sync=sync)
+        except OSError as exc:
+            errors.append(exc.errno)
+
+    async def run():
+        async with trio.open_nursery() as nursery:
+            for _ in range(3):
+                nursery.start_soon(fsync)
+
+    trio.run(run)
+    assert errors == [errno.EIO] * 3
+    assert coalescer.backing_fsyncs == 2
+
+
+def test_fsync_coalescing_in_operations(tmp_path):
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path), io_workers=2, fsync_coalescing=True)
+        ctx = pyfuse3.RequestContext()
+        file_info, _ = await operations.create(pyfuse3.ROOT_INODE, b"commitlog", 0o644, os.O_WRONLY, ctx)
+        await operations.write(file_info.fh, 0, b"data")
+        async with trio.open_nursery() as nursery:
+            for _ in range(4):
+                nursery.start_soon(operations.fsync, file_info.fh, True)
+            nursery.start_soon(operations.fsyncdir, pyfuse3.ROOT_INODE, False)
+        return operations.get_stats()["fsync_coalescer"]
+
+    stats = trio.run(run)
+    assert stats["calls"] == 5
+    assert stats["backing_fsyncs"] == 3
+    assert stats["max_batch_size"] == 3
+    assert (tmp_path / "commitlog").read_bytes() == b"data"
+
+
+@pytest.mark.parametrize("size, bucket", [(1, "<=1"), (2, "<=2"), (3, "<=4"), (4, "<=4"), (5, "<=8")])
+def test_batch_sizes_histogram(size, bucket):
+    coalescer = FsyncCoalescer()
+    first_fsync_done = trio.Event()
+
+    async def sync(datasync):
+        if not first_fsync_done.is_set():
+            await first_fsync_done.wait()
+
+    async def run():
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(coalescer.fsync, 1, True, sync)
+            await trio.testing.wait_all_tasks_blocked()  # the first backing fsync is in flight now.
+            for _ in range(size):
+                nursery.start_soon(coalescer.fsync, 1, True, sync)
+            await trio.testing.wait_all_tasks_blocked()
+            first_fsync_done.set()
+
+    trio.run(run)
+    assert coalescer.get_stats()["batch_sizes"] == ({"<=1": 1, bucket: 1} if size > 1 else {"<=1": 2})
@@ -0,0 +1,79 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import errno
+
+import trio
+import pytest
+import pyfuse3
+
+from core.faults import LatencyFault, SysCall
+from core.operations import CharybdisOperations
+from core.configuration import Configuration, generate_fault_id
+
+
+@pytest.fixture
+def latency_fault():
+    fault_id = generate_fault_id()
+    Configuration.add_fault(fault_id=fault_id, fault=LatencyFault(sys_call=SysCall.GETATTR, probability=100, delay=60e6))
+    yield
+    Configuration.remove_fault(fault_id=fault_id)
+
+
+def test_request_timeout(tmp_path, latency_fault):
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path), request_timeout=0.05)
+        started = time.monotonic()
+        with pytest.raises(pyfuse3.FUSEError) as exc_info:
+            await operations.getattr(pyfuse3.ROOT_INODE, pyfuse3.RequestContext())
+        assert exc_info.value.errno == errno.EINTR
+        assert time.monotonic() - started < 10
+        stats = operations.get_stats()["requests"]
+        assert stats == {"in_flight": 0, "oldest": None, "cancelled": {}, "timed_out": {"getattr": 1}}
+
+    trio.run(run)
+
+
+def test_cancel_requests(tmp_path, latency_fault):
+    results = []
+
+    async def getattr_request(operations):
+        try:
+            await operations.getattr(pyfuse3.ROOT_INODE, pyfuse3.RequestContext())
+        except pyfuse3.FUSEError as exc:
+            results.append(exc.errno)
+
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path))
+        operations.trio_token = trio.lowlevel.current_trio_token()
+        async with trio.open_nursery() as nursery:
+            for _ in range(3):
+                nursery.start_soon(getattr_request, operations)
+            await trio.sleep(0.05)
+            stats = operations.get_stats()["requests"]
+            assert stats["in_flight"] == 3
+            assert stats["oldest"]["sys_call"] == "getattr"
+            assert operations.cancel_requests(min_age=60) == 0
+            # The REST API server calls it from another thread.
+            assert await trio.to_thread.run_sync(operations.cancel_requests) == 3
+        assert operations.get_stats()["requests"]["cancelled"] == {"getattr": 3}
+
+        # Requests not affected by faults aren't affected by cancellation of others.
+        assert (await operations.statfs(pyfuse3.RequestContext())).f_namemax
+        assert os.path.isdir(tmp_path)
+
+    trio.run(run)
+    assert results == [errno.EINTR] * 3
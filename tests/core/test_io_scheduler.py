@@ -0,0 +1,122 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import trio
+import pytest
+import pyfuse3
+
+from core.faults import SysCall
+from core.operations import CharybdisOperations
+from core.io_scheduler import IOScheduler, FIFO, DEADLINE, READ_PRIORITY
+
+
+def run_requests(scheduler, sys_calls):
+    """Fill the queue while all slots are busy and return the dispatch order."""
+
+    order = []
+
+    async def request(index, sys_call):
+        await scheduler.acquire(sys_call=sys_call)
+        order.append(index)
+        await trio.sleep(0.01)
+        scheduler.release()
+
+    async def run():
+        async with trio.open_nursery() as nursery:
+            for index, sys_call in enumerate(sys_calls):
+                nursery.start_soon(request, index, sys_call)
+                await trio.sleep(0.001)  # keep order of arrival.
+
+    trio.run(run)
+    return order
+
+
+@pytest.mark.parametrize("policy, expected", (
+    (FIFO, [0, 1, 2, 3, 4]),
+    (DEADLINE, [0, 3, 4, 1, 2]),
+    (READ_PRIORITY, [0, 3, 4, 1, 2]),
+))
+def test_policies(policy, expected):
+    scheduler = IOScheduler(queue_depth=1, policy=policy)
+    assert run_requests(scheduler, [SysCall.WRITE, SysCall.WRITE, SysCall.FSYNC, SysCall.READ, SysCall.READ]) == expected
+    stats = scheduler.get_stats()
+    assert stats["in_flight"] == 0
+    assert stats["queued"] == {"reads": 0, "writes": 0}
+    assert stats["reads"]["dispatched"] == 2
+    assert stats["writes"]["dispatched"] == 3
+    assert stats["writes"]["max_wait_time"] > 0
+
+
+def test_read_priority_starvation():
+    scheduler = IOScheduler(queue_depth=1, policy=READ_PRIORITY, write_deadline=0)
+    assert run_requests(scheduler, [SysCall.READ, SysCall.WRITE, SysCall.READ]) == [0, 1, 2]
+
+
+def test_queue_depth():
+    scheduler = IOScheduler(queue_depth=2)
+    in_flight = []
+
+    async def request():
+        await scheduler.acquire(sys_call=SysCall.READ)
+        in_flight.append(scheduler.in_flight)
+        await trio.sleep(0.01)
+        scheduler.release()
+
+    async def run():
+        async with trio.open_nursery() as nursery:
+            for _ in range(10):
+                nursery.start_soon(request)
+
+    trio.run(run)
+    assert max(in_flight) == 2
+    assert scheduler.get_stats()["reads"]["dispatched"] == 10
+
+
+def test_cancel_queued_request():
+    scheduler = IOScheduler(queue_depth=1)
+
+    async def run():
+        await scheduler.acquire(sys_call=SysCall.WRITE)
+        with trio.move_on_after(0.01):
+            await scheduler.acquire(sys_call=SysCall.WRITE)
+        assert scheduler.get_stats()["queued"] == {"reads": 0, "writes": 0}
+        scheduler.release()
+        assert scheduler.in_flight == 0
+
+    trio.run(run)
+
+
+def test_invalid_parameters():
+    with pytest.raises(ValueError):
+        IOScheduler(queue_depth=0)
+    with pytest.raises(ValueError):
+        IOScheduler(queue_depth=1, policy="cfq")
+
+
+def test_operations(tmp_path):
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path), io_scheduler=IOScheduler(queue_depth=4))
+        ctx = pyfuse3.RequestContext(uid=os.getuid(), gid=os.getgid(), umask=0o022)
+        file_info, _ = await operations.create(pyfuse3.ROOT_INODE, b"file", 0o644, os.O_RDWR, ctx)
+        await operations.write(file_info.fh, 0, b"data")
+        assert await operations.read(file_info.fh, 0, 4) == b"data"
+        await operations.release(file_info.fh)
+        stats = operations.get_stats()["io_scheduler"]
+        assert stats["in_flight"] == 0
+        assert stats["reads"]["dispatched"] == 1
+        assert stats["writes"]["dispatched"] == 1
+
+    trio.run(run)
@@ -0,0 +1,250 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import errno
+import threading
+import multiprocessing
+
+import trio
+import pytest
+
+from core.faults import ErrorFault, FaultStats, SysCall
+from core.events import EventStream, FAULT_EVENT
+from core import mounts
+from core.mounts import MountRegistry, MountProcess, MountOptions, get_shards, _become_ready, _serve_commands
+from core.operations import CharybdisOperations
+from core.readiness import Readiness
+from core.scenarios import Scenarios
+from core.configuration import Configuration, generate_fault_id
+
+
+class ChildMount:
+    mount_id = "child"
+
+    def __init__(self, faults_stats):
+        self.faults_stats = faults_stats
+
+    def get_faults_stats(self):
+        return self.faults_stats
+
+
+def test_faults_stats_of_child_mounts(configuration, monkeypatch):
+    fault_id = generate_fault_id()
+    fault = ErrorFault(sys_call=SysCall.WRITE, probability=10, error_no=errno.EIO)
+    configuration.add_fault(fault_id=fault_id, fault=fault)
+    fault.stats = FaultStats(evaluations=10, hits=1, affected_bytes=100, first_fired=2.0, last_fired=2.0)
+
+    child_stats = FaultStats(evaluations=5, hits=2, affected_bytes=10, first_fired=1.0, last_fired=3.0).to_dict()
+    monkeypatch.setattr(MountRegistry, "mounts", {
+        "child": ChildMount(faults_stats={fault_id: child_stats, generate_fault_id(): child_stats}),
+    })
+    assert MountRegistry.get_all_faults_stats() == {
+        fault_id: {"evaluations": 15, "hits": 3, "affected_bytes": 110, "first_fired": 1.0, "last_fired": 3.0},
+    }
+
+
+def test_add_mount_starts_child_without_lock(tmp_path, monkeypatch):
+    monkeypatch.setattr(MountRegistry, "mounts", {})
+    monkeypatch.setattr(MountRegistry, "events_forwarder", threading.current_thread())  # don't start it.
+    monkeypatch.setattr(Configuration, "listeners", [])
+    monkeypatch.setattr(Scenarios, "listeners", [])
+    mounts_seen_while_starting = []
+
+    def start(mount):
+        thread = threading.Thread(target=lambda: mounts_seen_while_starting.append(MountRegistry.get_all_mounts()))
+        thread.start()
+        thread.join(timeout=5)
+        with pytest.raises(ValueError):  # the target is reserved.
+            MountRegistry.add_mount(source=str(tmp_path), target=mount.target)
+
+    monkeypatch.setattr(MountProcess, "start", start)
+    mount_id = MountRegistry.add_mount(source=str(tmp_path), target=str(tmp_path / "target"))
+    assert mounts_seen_while_starting == [[]]
+    assert MountRegistry.get_mount(mount_id).target == str(tmp_path / "target")
+    assert MountRegistry.starting_targets == set()
+    mount = MountRegistry.get_mount(mount_id)
+    mount.conn.close()
+    mount.child_conn.close()
+
+
+def test_call_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(mounts, "MOUNT_CALL_TIMEOUT", 0.1)
+    mount = MountProcess(mount_id="child", source=str(tmp_path), target=str(tmp_path), options=MountOptions())
+    mount.child_conn.close()
+    mount.conn, child_conn = multiprocessing.Pipe()
+
+    with pytest.raises(RuntimeError):
+        mount.call("get_stats")
+    assert child_conn.recv() == ("get_stats", ())
+    with pytest.raises(RuntimeError):
+        mount.call("get_stats")  # isn't sent: the reply to the previous call is still expected.
+    assert not child_conn.poll(0)
+
+    child_conn.send((True, "late"))
+    child_conn.send((True, "fresh"))
+    assert mount.call("get_stats") == "fresh"
+    assert child_conn.recv() == ("get_stats", ())
+    mount.conn.close()
+    child_conn.close()
+
+
+def test_push_doesnt_wait_for_child(configuration, tmp_path, monkeypatch):
+    mount = MountProcess(mount_id="child", source=str(tmp_path), target=str(tmp_path), options=MountOptions())
+    mount.conn.close()
+    mount.child_conn.close()
+    sending, release, sent = threading.Event(), threading.Event(), []
+
+    def notify(command, *args):
+        sending.set()
+        release.wait(timeout=10)
+        sent.append(args)
+
+    monkeypatch.setattr(mount, "notify", notify)
+    monkeypatch.setattr(MountRegistry, "mounts", {mount.mount_id: mount})
+    mount.pusher.start()
+
+    MountRegistry.push_faults()
+    assert sending.wait(timeout=10)
+    for _ in range(2):  # the child hangs, but changes of the configuration don't wait for it.
+        configuration.add_fault(fault_id=generate_fault_id(),
+                                fault=ErrorFault(sys_call=SysCall.WRITE, probability=10, error_no=errno.EIO))
+        MountRegistry.push_faults()
+    release.set()
+    deadline = time.monotonic() + 10
+    while len(sent) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [len(faults) for faults, _ in sent] == [0, 2]  # the latest state only.
+
+    with mount.pushes_changed:
+        mount.stopped = True
+        mount.pushes_changed.notify()
+    mount.pusher.join(timeout=10)
+    assert not mount.pusher.is_alive()
+
+
+def test_serve_commands(tmp_path):
+    conn, child_conn = multiprocessing.Pipe()
+    big_args = (bytes(1024 * 1024), )  # doesn't fit into the pipe buffer.
+
+    def parent():
+        conn.send(("get_stats", ()))
+        replies.append(conn.recv())
+        conn.send(("unknown", big_args))
+        replies.append(conn.recv())
+        conn.send(("stop", ()))
+        replies.append(conn.recv())
+
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path))
+        with trio.fail_after(10):
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(_serve_commands, operations, child_conn, nursery.cancel_scope)
+                await trio.to_thread.run_sync(parent)
+
+    replies = []
+    trio.run(run)
+    assert [ok for ok, _ in replies] == [True, False, True]
+    assert "requests" in replies[0][1]
+    conn.close()
+    child_conn.close()
+
+
+def test_serve_events(tmp_path):
+    conn, child_conn = multiprocessing.Pipe()
+
+    def parent():
+        conn.send(("get_events", ()))
+        replies.append(conn.recv())
+        EventStream.publish(FAULT_EVENT, sys_call="write")
+        conn.send(("get_events", ()))
+        replies.append(conn.recv())
+        conn.send(("unsubscribe_events", ()))
+        replies.append(conn.recv())
+        conn.send(("stop", ()))
+        replies.append(conn.recv())
+
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path))
+        with trio.fail_after(10):
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(_serve_commands, operations, child_conn, nursery.cancel_scope)
+                await trio.to_thread.run_sync(parent)
+
+    replies = []
+    trio.run(run)
+    assert replies[0] == (True, {"events": [], "dropped": 0})
+    assert [event["sys_call"] for event in replies[1][1]["events"]] == ["write"]
+    assert EventStream.subscribers == []
+    conn.close()
+    child_conn.close()
+
+
+class EventsChildMount:
+    mount_id = "child"
+
+    def __init__(self):
+        self.events_subscribed = False
+        self.calls = []
+
+    def call(self, command):
+        self.calls.append(command)
+        if command == "get_events":
+            return {"events": [{"type": FAULT_EVENT, "timestamp": 1.0, "mount_id": self.mount_id}], "dropped": 2}
+        return None
+
+
+def test_forward_events(monkeypatch):
+    mount = EventsChildMount()
+    monkeypatch.setattr(MountRegistry, "mounts", {mount.mount_id: mount})
+
+    MountRegistry.forward_events()
+    assert mount.calls == []  # nobody is subscribed.
+
+    subscriber = EventStream.subscribe()
+    try:
+        MountRegistry.forward_events()
+        assert subscriber.get_batch(timeout=0) == {
+            "events": [{"type": FAULT_EVENT, "timestamp": 1.0, "mount_id": "child"}],
+            "dropped": 2,
+        }
+    finally:
+        EventStream.unsubscribe(subscriber)
+    MountRegistry.forward_events()
+    MountRegistry.forward_events()
+    assert mount.calls == ["get_events", "unsubscribe_events"]
+
+
+def test_get_shards(tmp_path):
+    (tmp_path / "data" / "ks1").mkdir(parents=True)
+    (tmp_path / "file").touch()
+    assert get_shards(source=str(tmp_path), target="/mnt", subdirs=["data/ks1", "data/../data"]) == [
+        (str(tmp_path / "data" / "ks1"), "/mnt/data/ks1"),
+        (str(tmp_path / "data"), "/mnt/data"),
+    ]
+    for subdir in (".", "..", "../other", "/tmp", "file", "missing"):
+        with pytest.raises(ValueError):
+            get_shards(source=str(tmp_path), target="/mnt", subdirs=[subdir])
+
+
+def test_shards_are_mounted_before_ready(monkeypatch):
+    events = []
+
+    async def become_ready():
+        events.append("ready")
+
+    monkeypatch.setattr(MountRegistry, "add_mount", lambda source, target: events.append((source, target)))
+    monkeypatch.setattr(Readiness, "become_ready", become_ready)
+    trio.run(_become_ready, [("/src/a", "/mnt/a"), ("/src/b", "/mnt/b")])
+    assert events == [("/src/a", "/mnt/a"), ("/src/b", "/mnt/b"), "ready"]
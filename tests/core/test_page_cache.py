@@ -0,0 +1,156 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import errno
+import fcntl
+
+import trio
+import pytest
+import pyfuse3
+
+from core.page_cache import PageCache
+from core.operations import CharybdisOperations
+
+
+@pytest.fixture
+def backing_fd(tmp_path):
+    fd = os.open(tmp_path / "data", os.O_RDWR | os.O_CREAT)
+    yield fd
+    os.close(fd)
+
+
+@pytest.fixture
+def cache():
+    return PageCache(max_pages=4, page_size=16)
+
+
+def test_write_is_not_flushed(cache, backing_fd):
+    assert cache.write(inode=42, fd=backing_fd, off=0, buf=b"hello") == 5
+    assert os.pread(backing_fd, 100, 0) == b""
+    assert cache.get_size(42) == 5
+    assert cache.read(inode=42, off=0, size=100, data=b"") == b"hello"
+    assert cache.read(inode=42, off=1, size=2, data=b"") == b"el"
+
+
+def test_flush(cache, backing_fd):
+    cache.write(inode=42, fd=backing_fd, off=10, buf=b"0123456789")
+    cache.write(inode=42, fd=backing_fd, off=20, buf=b"abcdefghijklmnopqrstuvwxyz")
+    cache.flush(inode=42)
+    assert os.pread(backing_fd, 100, 10) == b"0123456789abcdefghijklmnopqrstuvwxyz"
+    assert cache.get_size(42) is None
+    assert cache.backing_writes == 1  # adjacent pages coalesced into one write
+    assert cache.get_stats()["dirty_pages"] == 0
+
+
+def test_non_adjacent_writes_to_same_page(cache, backing_fd):
+    cache.write(inode=42, fd=backing_fd, off=0, buf=b"aa")
+    cache.write(inode=42, fd=backing_fd, off=8, buf=b"bb")
+    assert os.pread(backing_fd, 100, 0) == b"aa"
+    assert cache.read(inode=42, off=0, size=100, data=b"aa") == b"aa\0\0\0\0\0\0bb"
+
+
+def test_eviction(cache, backing_fd):
+    for index in range(5):
+        cache.write(inode=42, fd=backing_fd, off=index * 16, buf=bytes([index + 1]) * 16)
+    assert cache.evicted_pages == 1
+    assert os.pread(backing_fd, 100, 0) == b"\1" * 16
+    assert len(cache.pages) == 4
+
+
+def test_truncate(cache, backing_fd):
+    cache.write(inode=42, fd=backing_fd, off=0, buf=b"x" * 40)
+    cache.truncate(inode=42, length=20)
+    assert cache.get_size(42) == 20
+    assert cache.read(inode=42, off=0, size=100, data=b"") == b"x" * 20
+    cache.flush(inode=42)
+    assert os.pread(backing_fd, 100, 0) == b"x" * 20
+
+
+def test_append_writer_first(cache, tmp_path):
+    path = tmp_path / "data"
+    path.write_bytes(b"0123456789")
+    append_fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    plain_fd = os.open(path, os.O_RDWR)
+    try:
+        cache.write(inode=42, fd=append_fd, off=10, buf=b"tail")  # the kernel passes the size as an offset.
+        cache.write(inode=42, fd=plain_fd, off=2, buf=b"ab")
+        cache.flush(inode=42)
+        assert path.read_bytes() == b"01ab456789tail"
+        assert fcntl.fcntl(append_fd, fcntl.F_GETFL) & os.O_APPEND  # flags of the writer's fd aren't changed.
+    finally:
+        os.close(append_fd)
+        os.close(plain_fd)
+
+
+def failing_pwritev(fd, buffers, off):
+    raise OSError(errno.EIO, os.strerror(errno.EIO))
+
+
+def test_failed_flush_keeps_pages(cache, backing_fd, monkeypatch):
+    monkeypatch.setattr(os, "pwritev", failing_pwritev)
+    cache.write(inode=42, fd=backing_fd, off=0, buf=b"data")
+    with pytest.raises(OSError):
+        cache.flush(inode=42)
+    assert cache.get_stats()["dirty_pages"] == 1
+    assert cache.read(inode=42, off=0, size=100, data=b"") == b"data"
+    monkeypatch.undo()
+    cache.flush(inode=42)
+    assert os.pread(backing_fd, 100, 0) == b"data"
+    assert cache.get_stats()["dirty_pages"] == 0
+
+
+def test_failed_eviction_is_reported_by_flush(cache, backing_fd, monkeypatch):
+    monkeypatch.setattr(os, "pwritev", failing_pwritev)
+    for index in range(5):
+        cache.write(inode=42, fd=backing_fd, off=index * 16, buf=bytes([index + 1]) * 16)
+    assert len(cache.pages) == 4
+    assert cache.discarded_pages == 1
+    monkeypatch.undo()
+    with pytest.raises(OSError) as exc_info:
+        cache.flush(inode=42)
+    assert exc_info.value.errno == errno.EIO
+    cache.flush(inode=42)  # the error is reported once.
+    assert os.pread(backing_fd, 100, 16) == b"\2" * 16 + b"\3" * 16 + b"\4" * 16 + b"\5" * 16
+
+
+def test_crash(cache, backing_fd):
+    cache.write(inode=42, fd=backing_fd, off=0, buf=b"fsynced")
+    cache.flush(inode=42)
+    cache.write(inode=42, fd=backing_fd, off=0, buf=b"lost")
+    cache.write(inode=13, fd=backing_fd, off=100, buf=b"lost too")
+    assert cache.crash() == 2
+    assert cache.get_size(42) is None
+    assert cache.read(inode=42, off=0, size=100, data=b"fsynced") == b"fsynced"
+    assert os.pread(backing_fd, 100, 0) == b"fsynced"
+    assert not cache.fds
+
+
+def test_open_truncate(tmp_path):
+    (tmp_path / "file").write_bytes(bytes(1000))
+
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path), page_cache=PageCache(max_pages=4))
+        ctx = pyfuse3.RequestContext(uid=os.getuid(), gid=os.getgid(), umask=0o022)
+
+        entry_attrs = await operations.lookup(pyfuse3.ROOT_INODE, b"file", ctx)
+        reader = await operations.open(entry_attrs.st_ino, os.O_RDWR, ctx)
+        await operations.write(reader.fh, 0, b"dirty")
+
+        writer = await operations.open(entry_attrs.st_ino, os.O_WRONLY | os.O_TRUNC, ctx)
+        assert await operations.read(reader.fh, 0, 100) == b""
+        await operations.fsync(writer.fh, False)
+        assert (tmp_path / "file").read_bytes() == b""
+
+    trio.run(run)
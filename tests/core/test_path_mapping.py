@@ -12,9 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+
+import trio
+import trio.testing
 import pytest
+from pyfuse3 import ROOT_INODE
 
-from core.operations import PathMapping
+from core.faults import SysCall
+from core.operations import PathMapping, INodeRecord, CharybdisOperations, FORGET_BATCH_SIZE, FORGET_RECLAIM_INTERVAL
 
 
 @pytest.fixture
@@ -30,24 +36,26 @@ def test_get_from_empty(mapping):
 def test_set_one_path(mapping):
     mapping[42] = "/root"
     assert mapping[42] == "/root"
-    assert mapping.inode_lookups[42] == 1
+    assert mapping.get_nlookup(42) == 1
 
 
 def test_set_many_paths(mapping):
     mapping[42] = "/root"
     mapping[42] = "/home"
     mapping[42] = "/lib"
-    assert mapping[42] in ["/root", "/home", "/lib"]
-    assert mapping.inode_lookups[42] == 3
-    assert dict.__getitem__(mapping, 42) == {"/root", "/home", "/lib"}
+    assert mapping[42] == "/root"
+    assert mapping.get_nlookup(42) == 3
+    assert mapping.get_paths(42) == ["/root", "/home", "/lib"]
 
 
 def test_set_same_path_twice(mapping):
     mapping[42] = "/root"
     mapping[42] = "/root"
+    mapping[42] = "/home"
+    mapping[42] = "/home"
     assert mapping[42] == "/root"
-    assert mapping.inode_lookups[42] == 2
-    assert dict.__getitem__(mapping, 42) == "/root"
+    assert mapping.get_nlookup(42) == 4
+    assert mapping.get_paths(42) == ["/root", "/home"]
 
 
 def test_forget_path(mapping):
@@ -55,74 +63,94 @@ def test_forget_path(mapping):
     mapping[42] = "/home"
     mapping[42] = "/lib"
 
-    with pytest.raises(KeyError):
-        mapping.forget_path(42, "/usr")
-    assert dict.__getitem__(mapping, 42) == {"/root", "/home", "/lib"}
-    assert mapping.inode_lookups[42] == 3
-
     mapping.forget_path(100500, "/root")
-    assert dict.__getitem__(mapping, 42) == {"/root", "/home", "/lib"}
-    assert mapping.inode_lookups[42] == 3
-
-    mapping.forget_path(42, "/root")
-    assert dict.__getitem__(mapping, 42) == {"/home", "/lib"}
-    assert mapping.inode_lookups[42] == 3
+    assert mapping.get_paths(42) == ["/root", "/home", "/lib"]
+    assert mapping.get_nlookup(42) == 3
 
     mapping.forget_path(42, "/home")
-    assert dict.__getitem__(mapping, 42) == "/lib"
-    assert mapping.inode_lookups[42] == 3
+    assert mapping.get_paths(42) == ["/root", "/lib"]
+    assert mapping.get_nlookup(42) == 3
 
-    with pytest.raises(KeyError):
-        mapping.forget_path(42, "/usr")
-    assert dict.__getitem__(mapping, 42) == "/lib"
-    assert mapping.inode_lookups[42] == 3
+    mapping.forget_path(42, "/root")
+    assert mapping[42] == "/lib"
+    assert mapping.get_paths(42) == ["/lib"]
+    assert mapping.get_nlookup(42) == 3
 
     mapping.forget_path(42, "/lib")
-    assert 42 not in mapping
-    assert mapping.inode_lookups[42] == 3
+    with pytest.raises(KeyError):
+        mapping[42]
+    assert mapping.get_paths(42) == []
+    assert mapping.get_nlookup(42) == 3
 
 
 def test_forget_path_and_add_again(mapping):
     mapping[42] = "/root"
     mapping.forget_path(42, "/root")
-    assert mapping.inode_lookups[42] == 1
+    assert mapping.get_nlookup(42) == 1
     mapping[42] = "/root"
-    assert mapping.inode_lookups[42] == 2  # is it expected?
+    assert mapping.get_nlookup(42) == 2  # is it expected?
+
+
+def test_forget_path_without_lookups(mapping):
+    dict.__setitem__(mapping, 42, INodeRecord(path="/root"))
+    mapping.forget_path(42, "/root")
+    assert 42 not in mapping
+
 
+def test_forget_unknown_path(tmp_path):
+    mapping = PathMapping(str(tmp_path))
+    (tmp_path / "file").touch()
+    os.link(tmp_path / "file", tmp_path / "link")
+    inode = os.lstat(tmp_path / "file").st_ino
+    mapping[inode] = str(tmp_path / "gone")
+    mapping[inode] = str(tmp_path / "file")
+    mapping[inode] = str(tmp_path / "link")
 
-def replace_path_for_inode_with_one_path(mapping):
+    mapping.forget_path(inode, str(tmp_path / "unknown"))
+    assert mapping.get_paths(inode) == [str(tmp_path / "file"), str(tmp_path / "link")]
+    assert mapping.get_nlookup(inode) == 3
+
+
+def test_replace_path_for_inode_with_one_path(mapping):
     mapping[42] = "/root"
 
     mapping.replace_path(100500, "/root", "/usr")
-    assert dict.__getitem__(mapping, 42) == "/root"
-    assert mapping.inode_lookups[42] == 1
-
-    with pytest.raises(KeyError):
-        mapping.replace_path(42, "/lib", "/usr")
-    assert dict.__getitem__(mapping, 42) == "/root"
-    assert mapping.inode_lookups[42] == 1
+    assert mapping.get_paths(42) == ["/root"]
+    assert mapping.get_nlookup(42) == 1
 
     mapping.replace_path(42, "/root", "/usr")
-    assert dict.__getitem__(mapping, 42) == "/usr"
-    assert mapping.inode_lookups[42] == 1
+    assert mapping.get_paths(42) == ["/usr"]
+    assert mapping.get_nlookup(42) == 1
 
 
-def replace_path_for_inode_with_multiple_pathes(mapping):
+def test_replace_path_for_inode_with_multiple_paths(mapping):
     mapping[42] = "/root"
     mapping[42] = "/home"
 
-    mapping.replace_path(100500, "/root", "/usr")
-    assert dict.__getitem__(mapping, 42) == {"/root", "/home"}
-    assert mapping.inode_lookups[42] == 2
+    mapping.replace_path(42, "/home", "/usr")
+    assert mapping.get_paths(42) == ["/root", "/usr"]
 
-    with pytest.raises(KeyError):
-        mapping.replace_path(42, "/lib", "/usr")
-    assert dict.__getitem__(mapping, 42) == {"/root", "/home"}
-    assert mapping.inode_lookups[42] == 2
+    mapping.replace_path(42, "/root", "/lib")
+    assert mapping.get_paths(42) == ["/usr", "/lib"]
+    assert mapping.get_nlookup(42) == 2
 
-    mapping.replace_path(42, "/root", "/usr")
-    assert dict.__getitem__(mapping, 42) == {"/usr", "/home"}
-    assert mapping.inode_lookups[42] == 2
+
+def test_replace_unknown_path(tmp_path):
+    mapping = PathMapping(str(tmp_path))
+    (tmp_path / "file").touch()
+    os.link(tmp_path / "file", tmp_path / "link")
+    inode = os.lstat(tmp_path / "file").st_ino
+    mapping[inode] = str(tmp_path / "file")
+    mapping[inode] = str(tmp_path / "link")
+
+    # Both paths are links to the same inode, so rename(2) does nothing.
+    os.rename(tmp_path / "file", tmp_path / "link")
+    mapping.replace_path(inode, str(tmp_path / "file"), str(tmp_path / "link"))
+    assert mapping.get_paths(inode) == [str(tmp_path / "file"), str(tmp_path / "link")]
+
+    os.rename(tmp_path / "link", tmp_path / "new")
+    mapping.replace_path(inode, str(tmp_path / "unknown"), str(tmp_path / "new"))
+    assert mapping.get_paths(inode) == [str(tmp_path / "file"), str(tmp_path / "new")]
 
 
 def test_forget_inode_lookups(mapping):
@@ -132,14 +160,45 @@ def test_forget_inode_lookups(mapping):
 
     mapping.forget_inode_lookups(inode=42, nlookup=2)
     assert 42 in mapping
-    assert mapping.inode_lookups[42] == 1
+    assert mapping.get_nlookup(42) == 1
 
     mapping.forget_inode_lookups(inode=42, nlookup=1)
     assert 42 not in mapping
-    assert 42 not in mapping.inode_lookups
+    assert mapping.get_nlookup(42) == 0
 
     mapping[13] = "/lib"
 
     mapping.forget_inode_lookups(inode=13, nlookup=666)
     assert 13 not in mapping
-    assert 13 not in mapping.inode_lookups
+    assert mapping.get_nlookup(13) == 0
+
+
+def test_forget_lookups(mapping):
+    mapping[42] = "/root"
+    mapping[42] = "/root"
+    mapping[13] = "/lib"
+    mapping[666] = "/usr"
+
+    assert mapping.forget_lookups([(42, 1), (13, 1), (100500, 1)]) == [13, 100500]
+    assert mapping.get_nlookup(42) == 1
+    assert 13 not in mapping
+    assert mapping[666] == "/usr"
+
+    assert mapping.forget_lookups([(42, 1), (666, 10)]) == [42, 666]
+    assert list(mapping) == [ROOT_INODE]
+
+
+@pytest.mark.parametrize("busy, left", [(False, 0), (True, FORGET_BATCH_SIZE + 1)])
+def test_reclaim_forgotten_inodes(tmp_path, busy, left):
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path), lazy_forget=True)
+        await operations.forget([(inode, 1) for inode in range(1000, 1000 + FORGET_BATCH_SIZE * 2 + 1)])
+        if busy:
+            operations.requests.start(sys_call=SysCall.GETATTR)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(operations.reclaim_forgotten_inodes)
+            await trio.sleep(FORGET_RECLAIM_INTERVAL * 1.5)
+            assert len(operations.pending_forgets) == left
+            nursery.cancel_scope.cancel()
+
+    trio.run(run, clock=trio.testing.MockClock(autojump_threshold=0))
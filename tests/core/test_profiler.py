@@ -0,0 +1,74 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pstats
+import marshal
+import threading
+
+import trio
+import pytest
+import pyfuse3
+
+from core.faults import SysCall
+from core.profiler import Profiler, SamplingProfile, DETERMINISTIC
+from core.operations import CharybdisOperations
+
+
+def test_sampling_profile_attributes_syscalls():
+    served = threading.Event()
+    done = threading.Event()
+
+    def dispatch(sys_call):
+        served.set()
+        done.wait()
+
+    profile = SamplingProfile(dispatch_code=dispatch.__code__)
+    thread = threading.Thread(target=dispatch, args=(SysCall.READ, ), name="loop")
+    thread.start()
+    try:
+        served.wait()
+        profile.sample()
+        profile.sample()
+    finally:
+        done.set()
+        thread.join()
+
+    collapsed = profile.get_collapsed().splitlines()
+    read_stacks = [line for line in collapsed if line.startswith("read;")]
+    assert len(read_stacks) == 1
+    stack, count = read_stacks[0].rsplit(" ", 1)
+    assert count == "2"
+    assert any(frame.startswith("dispatch (test_profiler.py:") for frame in stack.split(";"))
+    assert not any(line.startswith("loop;") for line in collapsed)
+    assert not any(line.startswith("charybdisfs-profiler;") for line in collapsed)
+
+
+def test_profiler_start_stop(tmp_path):
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path))
+        operations.start_profiler(DETERMINISTIC)
+        with pytest.raises(RuntimeError):
+            operations.start_profiler()
+        await operations.getattr(pyfuse3.ROOT_INODE, pyfuse3.RequestContext())
+        return operations.stop_profiler()
+
+    stats = pstats.Stats()
+    stats.stats = marshal.loads(trio.run(run))
+    stats.get_top_level_stats()
+    assert any(func_name == "getattr" for _, _, func_name in stats.stats)
+
+    with pytest.raises(RuntimeError):
+        Profiler.stop()
+    with pytest.raises(ValueError):
+        Profiler.start(mode="unknown")
@@ -0,0 +1,98 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import socket
+import threading
+
+import trio
+import pytest
+from pyfuse3 import ROOT_INODE
+
+from core.readiness import Readiness, WarmUp
+from core.operations import CharybdisOperations
+
+
+@pytest.fixture
+def readiness():
+    Readiness.ready, Readiness.ready_fd, Readiness.warm_up = threading.Event(), None, None
+    yield Readiness
+    Readiness.ready, Readiness.ready_fd, Readiness.warm_up = threading.Event(), None, None
+    Readiness.notify_supervisor = True
+
+
+@pytest.fixture
+def source(tmp_path):
+    for directory in ("a/b", "c"):
+        (tmp_path / directory).mkdir(parents=True)
+    (tmp_path / "a" / "b" / "data").write_bytes(bytes(1000))
+    (tmp_path / "c" / "data").write_bytes(bytes(10))
+    return tmp_path
+
+
+def test_warm_up(source):
+    operations = CharybdisOperations(source=str(source))
+    warm_up = WarmUp(operations=operations, subtrees=["a", ], concurrency=2)
+    trio.run(warm_up.run)
+
+    assert warm_up.get_stats() == \
+        {"done": True, "directories": 2, "entries": 2, "prefetched_bytes": 1000, "errors": 0}
+    assert list(operations.paths) == [ROOT_INODE]  # inodes are made known by lookups of the kernel only.
+
+
+def test_warm_up_out_of_source(source):
+    with pytest.raises(ValueError):
+        WarmUp(operations=CharybdisOperations(source=str(source)), subtrees=["../"])
+
+
+def test_become_ready(readiness, source):
+    read_fd, readiness.ready_fd = os.pipe()
+    readiness.warm_up = WarmUp(operations=CharybdisOperations(source=str(source)), subtrees=["."], prefetch_data=False)
+    assert readiness.get_status()["ready"] is False
+
+    trio.run(readiness.become_ready)
+
+    assert os.read(read_fd, 100) == b"READY\n"
+    assert os.read(read_fd, 100) == b""  # closed
+    assert readiness.get_status() == {
+        "ready": True,
+        "warm_up": {"done": True, "directories": 4, "entries": 5, "prefetched_bytes": 0, "errors": 0},
+    }
+    os.close(read_fd)
+
+
+@pytest.mark.parametrize("notify_supervisor", [True, False])
+def test_only_main_process_notifies(readiness, tmp_path, monkeypatch, notify_supervisor):
+    notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    notify_socket.bind(str(tmp_path / "notify"))
+    notify_socket.setblocking(False)
+    monkeypatch.setenv("NOTIFY_SOCKET", str(tmp_path / "notify"))
+    read_fd, readiness.ready_fd = os.pipe()
+    readiness.notify_supervisor = notify_supervisor
+    try:
+        readiness.set_ready()
+        assert readiness.ready.is_set()
+        if notify_supervisor:
+            assert notify_socket.recv(100) == b"READY=1"
+            assert os.read(read_fd, 100) == b"READY\n"
+        else:  # a child process serves a mount added by the REST API.
+            with pytest.raises(BlockingIOError):
+                notify_socket.recv(100)
+            os.set_blocking(read_fd, False)
+            with pytest.raises(BlockingIOError):
+                os.read(read_fd, 100)
+            os.close(readiness.ready_fd)
+    finally:
+        notify_socket.close()
+        os.close(read_fd)
@@ -0,0 +1,113 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import errno
+
+import trio
+import pytest
+import pyfuse3
+
+from core.faults import ErrorFault, LatencyFault, SysCall
+from core.scenarios import Scenarios, Scenario, generate_scenario_id
+from core.operations import CharybdisOperations
+
+
+def error_fault(sys_call: str = "write", probability: int = 100) -> dict:
+    return ErrorFault(sys_call=sys_call, probability=probability, error_no=errno.EIO).to_dict()
+
+
+def test_advance_by_calls():
+    scenario = Scenario.from_dict({
+        "name": "dying disk",
+        "stages": [
+            {"name": "healthy", "faults": [], "until": {"calls": 2, "sys_call": "write"}},
+            {"faults": [error_fault()], "until": {"calls": 2}},
+            {"name": "recovered"},
+        ],
+    })
+
+    def faults(sys_call):
+        return [type(fault).__name__ for fault in scenario.get_faults_by_sys_call(sys_call=sys_call)]
+
+    assert faults(SysCall.WRITE) == []
+    assert faults(SysCall.READ) == []  # isn't counted
+    assert scenario.get_state()["calls_left"] == 1
+    assert faults(SysCall.WRITE) == []
+    assert scenario.get_state()["stage"] == 1
+    assert faults(SysCall.READ) == []  # counted, but there are no faults for reads
+    assert faults(SysCall.WRITE) == ["ErrorFault"]
+    assert scenario.get_state() == {"stage": 2, "stage_name": "recovered", "stage_age": pytest.approx(0, abs=1),
+                                    "finished": False}
+    assert faults(SysCall.WRITE) == []
+
+
+def test_advance_by_time():
+    scenario = Scenario.from_dict({
+        "stages": [
+            {"faults": [error_fault(sys_call="*")], "until": {"seconds": 0.05, "calls": 1000}},
+        ],
+    })
+    assert len(scenario.get_faults_by_sys_call(sys_call=SysCall.GETATTR)) == 1
+    time.sleep(0.05)
+    assert scenario.get_faults_by_sys_call(sys_call=SysCall.GETATTR) == ()
+    assert scenario.get_state() == {"stage": 1, "finished": True}
+
+
+@pytest.mark.parametrize("data", [
+    {},
+    {"stages": []},
+    {"stages": [{"faults": []}, {"faults": [error_fault()]}]},  # the first stage lasts forever
+    {"stages": [{"faults": [error_fault(probability=60), error_fault(sys_call="*", probability=60)]}]},
+    {"stages": [{"faults": [{"fault_type": "UnknownFault"}]}]},
+    {"stages": [{"faults": [], "until": {"calls": 0}}]},
+    {"stages": [{"faults": [], "until": {"calls": 1, "sys_call": "unknown"}}]},
+])
+def test_invalid_scenario(data):
+    with pytest.raises(ValueError):
+        Scenario.from_dict(data)
+
+
+def test_compiled_table():
+    latency_fault = LatencyFault(sys_call=SysCall.ALL, probability=50, delay=100).to_dict()
+    scenario = Scenario.from_dict({"stages": [{"faults": [error_fault(probability=50), latency_fault]}]})
+    table = scenario.stages[0].table
+    assert [type(fault) for fault in table[SysCall.WRITE]] == [ErrorFault, LatencyFault]
+    assert [type(fault) for fault in table[SysCall.READ]] == [LatencyFault]
+    assert SysCall.ALL not in table
+
+
+def test_scenario_in_operations(tmp_path):
+    scenario_id = generate_scenario_id()
+    Scenarios.add_scenario(scenario_id=scenario_id, scenario=Scenario.from_dict({
+        "stages": [{"faults": [error_fault(sys_call="getattr")], "until": {"calls": 2}}, {"faults": []}],
+    }))
+
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path))
+        errors = []
+        for _ in range(3):
+            try:
+                await operations.getattr(pyfuse3.ROOT_INODE, pyfuse3.RequestContext())
+            except pyfuse3.FUSEError as exc:
+                errors.append(exc.errno)
+        assert errors == [errno.EIO] * 2
+        assert operations.get_stats()["scenarios"][scenario_id]["stage"] == 1
+
+    try:
+        trio.run(run)
+        assert Scenarios.get_scenario(scenario_id=scenario_id).stages[0].faults[0].stats.hits == 2
+    finally:
+        Scenarios.remove_scenario(scenario_id=scenario_id)
+    assert Scenarios.get_all_scenarios_ids() == []
@@ -0,0 +1,141 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import errno
+import shutil
+
+import trio
+import pytest
+import pyfuse3
+
+from core.faults import ErrorFault, SysCall
+from core.trace import TraceRecorder, TraceReplayer, read_trace, read_inode_paths, read_names
+from core.operations import CharybdisOperations
+from core.configuration import generate_fault_id
+
+
+def test_ring(tmp_path):
+    recorder = TraceRecorder(path=str(tmp_path / "trace"), capacity=3)
+    for start in range(5):
+        recorder.record(sys_call=SysCall.GETATTR, start=start, duration=1, inode=start + 1)
+    recorder.record(sys_call=SysCall.READ, start=5, duration=1, fault=ErrorFault(SysCall.READ, 1, 5), error_no=5)
+    recorder.close()
+
+    records = read_trace(path=recorder.path)
+    assert [record.start for record in records] == [3, 4, 5, ]
+    assert records[-1].sys_call == SysCall.READ
+    assert records[-1].fault_type == "ErrorFault"
+    assert records[-1].errno == 5
+
+
+def test_not_a_trace(tmp_path):
+    path = tmp_path / "garbage"
+    path.write_bytes(bytes(4096))
+    with pytest.raises(ValueError):
+        read_trace(path=str(path))
+
+
+def test_record_and_replay(configuration, tmp_path):
+    source, replay_source, trace = tmp_path / "source", tmp_path / "replay", str(tmp_path / "trace")
+    source.mkdir()
+    (source / "data").write_bytes(bytes(8192))
+
+    async def workload(operations):
+        ctx = pyfuse3.RequestContext()
+        inode = (await operations.lookup(pyfuse3.ROOT_INODE, b"data", ctx)).st_ino
+        fh = (await operations.open(inode, os.O_RDWR, ctx)).fh
+        await operations.write(fh, 0, b"x" * 100)
+        assert len(await operations.read(fh, 4096, 4096)) == 4096
+        with pytest.raises(pyfuse3.FUSEError):
+            await operations.read(fh, 0, 10)
+        await operations.release(fh)
+
+    operations = CharybdisOperations(source=str(source))
+    operations.recorder = TraceRecorder(path=trace, capacity=100)
+    configuration.add_fault(fault_id=generate_fault_id(),
+                            fault=ErrorFault(sys_call=SysCall.READ, probability=100, error_no=errno.EIO))
+    trio.run(lambda: _without_faults_for_first_read(configuration, workload, operations))
+    operations.recorder.close()
+
+    records = read_trace(path=trace)
+    assert [record.sys_call for record in records] == \
+        [SysCall.LOOKUP, SysCall.OPEN, SysCall.WRITE, SysCall.READ, SysCall.READ, SysCall.RELEASE, ]
+    assert [(record.off, record.size) for record in records[2:5]] == [(0, 100), (4096, 4096), (0, 10), ]
+    assert records[4].fault_type == "ErrorFault" and records[4].errno == errno.EIO
+    assert read_inode_paths(path=trace)[records[1].inode] == "data"
+
+    shutil.copytree(source, replay_source)
+    replayer = TraceReplayer(operations=CharybdisOperations(source=str(replay_source)),
+                             inode_paths=read_inode_paths(path=trace),
+                             names=read_names(path=trace))
+    result = trio.run(replayer.replay, records)
+    assert result["replayed"] == 6
+    assert result["skipped"] == 0
+    assert result["calls"]["read"]["count"] == 2
+    assert result["calls"]["read"]["errors"] == 2  # the fault is still active.
+    assert not replayer.file_handles
+
+
+def test_replay_namespace_calls(tmp_path):
+    source, replay_source, trace = tmp_path / "source", tmp_path / "replay", str(tmp_path / "trace")
+    source.mkdir()
+    replay_source.mkdir()
+
+    async def workload(operations):
+        ctx = pyfuse3.RequestContext(uid=os.getuid(), gid=os.getgid(), umask=0o022)
+        dir_inode = (await operations.mkdir(pyfuse3.ROOT_INODE, b"dir", 0o755, ctx)).st_ino
+        file_info, _ = await operations.create(dir_inode, b"new", 0o644, os.O_WRONLY, ctx)
+        await operations.write(file_info.fh, 0, b"x" * 100)
+        await operations.release(file_info.fh)
+        await operations.rename(dir_inode, b"new", pyfuse3.ROOT_INODE, b"moved", 0, ctx)
+        file_info, _ = await operations.create(pyfuse3.ROOT_INODE, b"tmp", 0o644, os.O_WRONLY, ctx)
+        await operations.release(file_info.fh)
+        await operations.unlink(pyfuse3.ROOT_INODE, b"tmp", ctx)
+
+    operations = CharybdisOperations(source=str(source))
+    operations.recorder = TraceRecorder(path=trace, capacity=100)
+    trio.run(workload, operations)
+    operations.recorder.close()
+
+    records = read_trace(path=trace)
+    names = read_names(path=trace)
+    assert [names[record.name] for record in records if record.sys_call == SysCall.CREATE] == [b"new", b"tmp", ]
+    assert names[records[4].new_name] == b"moved"
+
+    replayer = TraceReplayer(operations=CharybdisOperations(source=str(replay_source)),
+                             inode_paths=read_inode_paths(path=trace),
+                             names=names)
+    result = trio.run(replayer.replay, records)
+    assert result["replayed"] == 8
+    assert result["skipped"] == 0
+    assert not any(stats["errors"] for stats in result["calls"].values())
+    assert sorted(os.listdir(replay_source)) == ["dir", "moved", ]
+    assert (replay_source / "moved").read_bytes() == b"\0" * 100
+    assert not os.listdir(replay_source / "dir")
+    assert not replayer.file_handles
+
+
+async def _without_faults_for_first_read(configuration, workload, operations):
+    fault_id, fault = next(iter(configuration.syscalls_conf.items()))
+    fault.probability = 0
+    original_read = operations.read
+
+    async def read(fh, off, size):
+        fault.probability = 100 if off == 0 else 0
+        return await original_read(fh, off, size)
+
+    operations.read = read
+    await workload(operations)
+    del operations.read
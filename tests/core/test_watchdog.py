@@ -0,0 +1,83 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import logging
+
+import trio
+import pytest
+import pyfuse3
+
+from core.faults import LatencyFault, SysCall
+from core.watchdog import Watchdog
+from core.inflight import InFlightRequests
+from core.operations import CharybdisOperations
+from core.configuration import Configuration, generate_fault_id
+
+
+@pytest.fixture
+def latency_fault():
+    fault_id = generate_fault_id()
+    Configuration.add_fault(fault_id=fault_id, fault=LatencyFault(sys_call=SysCall.GETATTR, probability=100, delay=60e6))
+    yield
+    Configuration.remove_fault(fault_id=fault_id)
+
+
+def test_slow_requests(tmp_path, latency_fault, caplog):
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path), slow_request_threshold=0.05)
+        operations.watchdog.tick_interval = 0.01
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(operations.watchdog.run)
+            nursery.start_soon(operations.getattr, pyfuse3.ROOT_INODE, pyfuse3.RequestContext())
+            await trio.sleep(0.2)
+            stats = operations.get_stats()["watchdog"]
+            nursery.cancel_scope.cancel()
+        assert stats["slow_requests"] == 1  # reported once
+        assert stats["stalls"] == 0
+        slow_request, = stats["slow_in_flight"]
+        assert slow_request["sys_call"] == "getattr"
+        assert slow_request["inode"] == pyfuse3.ROOT_INODE
+        assert slow_request["age"] >= 0.05
+        assert "ctx" not in slow_request["args"]
+        assert slow_request["fault"]["delay"] == 60e6
+
+    with caplog.at_level(logging.WARNING, logger="core.watchdog"):
+        trio.run(run)
+    assert sum("Slow request" in message for message in caplog.messages) == 1
+
+
+def test_loop_stall(caplog):
+    watchdog = Watchdog(requests=InFlightRequests(), loop_stall_threshold=0.05, tick_interval=0.01)
+
+    def blocking_call():
+        time.sleep(0.3)
+
+    async def run():
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(watchdog.run)
+            await trio.sleep(0.05)
+            blocking_call()
+            await trio.sleep(0.05)
+            nursery.cancel_scope.cancel()
+
+    with caplog.at_level(logging.WARNING, logger="core.watchdog"):
+        trio.run(run)
+    assert watchdog.stopped.is_set()
+    stats = watchdog.get_stats()
+    assert stats["stalls"] == 1
+    assert stats["loop_lag"]["max"] >= 0.2
+    stall_messages = [message for message in caplog.messages if "Event loop is stalled" in message]
+    assert len(stall_messages) == 1
+    assert "blocking_call" in stall_messages[0]
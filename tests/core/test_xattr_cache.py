@@ -0,0 +1,135 @@
+# Copyright 2020 ScyllaDB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import errno
+import time
+
+import trio
+import pytest
+import pyfuse3
+
+from core.operations import CharybdisOperations
+from core.xattr_cache import XattrCache, NO_ATTRIBUTE
+
+
+def test_get_and_put():
+    cache = XattrCache(ttl=60)
+    assert cache.get(42, "user.a") is None
+    cache.put(42, "user.a", b"value")
+    cache.put(42, "user.b", NO_ATTRIBUTE)
+    assert cache.get(42, "user.a") == b"value"
+    assert cache.get(42, "user.b") is NO_ATTRIBUTE
+    assert cache.get(13, "user.a") is None
+    assert cache.get_stats() == {"hits": 1, "negative_hits": 1, "misses": 2, "evicted_inodes": 0, "cached_inodes": 1}
+
+
+def test_names_and_invalidate():
+    cache = XattrCache(ttl=60)
+    cache.put_names(42, [b"user.a", ])
+    cache.put(42, "user.a", b"value")
+    assert cache.get_names(42) == [b"user.a", ]
+    cache.invalidate(42)
+    assert cache.get_names(42) is None
+    assert cache.get(42, "user.a") is None
+
+
+def test_expiration():
+    cache = XattrCache(ttl=0.01)
+    cache.put(42, "user.a", b"value")
+    cache.put_names(42, [b"user.a", ])
+    time.sleep(0.02)
+    assert cache.get(42, "user.a") is None
+    assert cache.get_names(42) is None
+
+
+def test_eviction():
+    cache = XattrCache(ttl=60, max_inodes=2)
+    cache.put(1, "user.a", b"1")
+    cache.put(2, "user.a", b"2")
+    assert cache.get(1, "user.a") == b"1"
+    cache.put(3, "user.a", b"3")
+    assert cache.get(2, "user.a") is None
+    assert cache.get(1, "user.a") == b"1"
+    assert cache.get_stats()["evicted_inodes"] == 1
+
+
+def test_operations(tmp_path):
+    path = tmp_path / "file"
+    path.touch()
+    try:
+        os.setxattr(path, "user.a", b"value")
+    except OSError as exc:
+        pytest.skip(f"no user xattrs support: {exc}")
+    inode = os.lstat(path).st_ino
+
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path), xattr_cache=XattrCache(ttl=60))
+        operations.paths[inode] = str(path)
+        ctx = pyfuse3.RequestContext()
+
+        assert await operations.getxattr(inode, b"user.a", ctx) == b"value"
+        with pytest.raises(pyfuse3.FUSEError) as exc_info:
+            await operations.getxattr(inode, b"user.b", ctx)
+        assert exc_info.value.errno == errno.ENODATA
+
+        os.setxattr(path, "user.b", b"hidden")  # not visible until the cached entry expires.
+        with pytest.raises(pyfuse3.FUSEError):
+            await operations.getxattr(inode, b"user.b", ctx)
+        assert await operations.getxattr(inode, b"user.a", ctx) == b"value"
+
+        await operations.setxattr(inode, b"user.a", b"new", ctx)
+        assert await operations.getxattr(inode, b"user.a", ctx) == b"new"
+        assert await operations.getxattr(inode, b"user.b", ctx) == b"hidden"
+        assert sorted(await operations.listxattr(inode, ctx)) == [b"user.a", b"user.b"]
+
+        await operations.removexattr(inode, b"user.b", ctx)
+        assert await operations.listxattr(inode, ctx) == [b"user.a", ]
+        assert operations.get_stats()["xattr_cache"]["negative_hits"] == 1
+
+    trio.run(run)
+
+
+def test_invalidated_by_setattr_and_first_write(tmp_path):
+    path = tmp_path / "file"
+    path.touch()
+    try:
+        os.setxattr(path, "user.a", b"0")
+    except OSError as exc:
+        pytest.skip(f"no user xattrs support: {exc}")
+    inode = os.lstat(path).st_ino
+
+    async def run():
+        operations = CharybdisOperations(source=str(tmp_path), xattr_cache=XattrCache(ttl=60))
+        operations.paths[inode] = str(path)
+        ctx = pyfuse3.RequestContext()
+
+        async def change_behind(value):
+            assert await operations.getxattr(inode, b"user.a", ctx) != value  # cached now.
+            os.setxattr(path, "user.a", value)
+
+        await change_behind(b"1")
+        await operations.setattr(inode, pyfuse3.EntryAttributes(st_mode=0o600), pyfuse3.SetattrFields(update_mode=True),
+                                 None, ctx)
+        assert await operations.getxattr(inode, b"user.a", ctx) == b"1"
+
+        fh = (await operations.open(inode, os.O_WRONLY, ctx)).fh
+        await change_behind(b"2")
+        await operations.write(fh, 0, b"data")
+        assert await operations.getxattr(inode, b"user.a", ctx) == b"2"
+        await change_behind(b"3")
+        await operations.write(fh, 4, b"data")
+        assert await operations.getxattr(inode, b"user.a", ctx) == b"2"  # only the first write drops the cache.
+
+    trio.run(run)